@@ -11,8 +11,12 @@ command line in this way: python blade.zip
 
 
 import sys
-from blade.blade_main import main
+from blade import fast_build
 
 
 if __name__ == '__main__':
+    # The fast path doesn't return if it succeeded, it is tried before
+    # importing other modules to be fast.
+    fast_build.try_exec(sys.argv[0], sys.argv[1:])
+    from blade.blade_main import main
     sys.exit(main(sys.argv[0], sys.argv[1:]))
@@ -0,0 +1,382 @@
+# Copyright (c) 2020 Tencent Inc.
+# All rights reserved.
+#
+# Date:   April 2, 2020
+
+
+"""
+ This is the action cache module. Build actions such as compiling and linking
+ are wrapped by it in the ninja rules, the outputs of an action are saved into
+ a content addressed cache dir, and restored without running the action again
+ if the same action has been ran before, even in another workspace.
+
+ The key of an action is calculated from its command line, the identities of
+ the tools it runs and the content of the input files in the command line.
+ Like the ccache manifest, headers which are only known after compiling are
+ recorded from the depfile into a manifest of the action, and are verified
+ when looking up the cache.
+
+ Layout of the cache dir:
+   cas/xx/<digest>       content of output files
+   ac/xx/<key>           result of actions, the outputs and console output
+   manifests/xx/<key>    dependencies recorded from the depfile -> result key
+
+ All files are written into a temporary file and then renamed, which is also
+ atomic on NFS, so the cache dir can be shared by multiple hosts.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shlex
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+from blade.blade_util import blade_code_identity
+
+try:
+    import hashlib as md5
+except ImportError:
+    import md5
+
+
+# Max number of dependency sets kept in the manifest of an action
+_MAX_MANIFEST_ENTRIES = 16
+
+# Evict the cache to this ratio of the max size, avoid evicting on every build
+_EVICT_TARGET_RATIO = 0.9
+
+# The modification time of this file in the cache dir is the time of the last eviction
+_EVICT_STAMP_FILE = 'evict.stamp'
+
+_SHELL_OPERATORS = frozenset(['&&', '||', ';', '|'])
+
+
+def _file_digest(path):
+    m = md5.md5()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            m.update(data)
+    return m.hexdigest()
+
+
+def _find_executable(name):
+    if os.path.sep in name:
+        return os.path.abspath(name) if os.path.isfile(name) else None
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        path = os.path.join(path, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+def _blade_identity():
+    """The identity of the code of blade itself, which runs the toolchain actions. """
+    path = os.path.dirname(os.path.abspath(__file__))
+    while not os.path.exists(path):  # Inside the blade.zip
+        path = os.path.dirname(path)
+    return ['blade', blade_code_identity(path)]
+
+
+def _key_command(command):
+    """The command line in the key.
+
+    The prefix maps of reproducible builds contain the path of the workspace,
+    but remove it from the outputs, so it is replaced to match across workspaces.
+    """
+    for option in ('-fdebug-prefix-map', '-ffile-prefix-map'):
+        command = command.replace('%s=%s=.' % (option, os.getcwd()),
+                                  '%s=<workspace>=.' % option)
+    return command
+
+
+def _split_paths(token):
+    """Split paths from the token, such as `-Wl,a.a`, `--classpath=a.jar:b.jar`. """
+    for sep in '=,:':
+        token = token.replace(sep, ' ')
+    return token.split()
+
+
+def parse_depfile(path):
+    """Return the dependencies in the makefile style depfile generated by the compiler. """
+    with open(path) as f:
+        content = f.read().replace('\\\n', ' ')
+    deps = []
+    for line in content.splitlines():
+        if ':' not in line:
+            continue
+        for dep in line.split(':', 1)[1].split():
+            if dep not in deps:
+                deps.append(dep)
+    return deps
+
+
+class ActionCache(object):
+    """Lookup and save outputs of an action in the cache dir. """
+
+    def __init__(self, cache_dir, command, outputs, depfile=None):
+        self.cache_dir = cache_dir
+        self.command = command
+        self.outputs = outputs
+        self.depfile = depfile
+        self._digests = {}
+
+    def _path(self, kind, key):
+        return os.path.join(self.cache_dir, kind, key[:2], key)
+
+    def _digest(self, path):
+        """Digest of the file content, None if it does not exist. """
+        if path not in self._digests:
+            try:
+                self._digests[path] = _file_digest(path)
+            except EnvironmentError:
+                self._digests[path] = None
+        return self._digests[path]
+
+    def _write_file(self, path, write):
+        """Write the file by `write(file object)` atomically. """
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                pass  # Created by others concurrently
+        fd, temp_path = tempfile.mkstemp(prefix='.tmp.', dir=dirname)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.chmod(temp_path, 0o644)  # Readable by other users sharing the cache
+            os.rename(temp_path, path)
+        except EnvironmentError:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _write_json(self, path, obj):
+        self._write_file(path, lambda f: f.write(json.dumps(obj).encode('utf-8')))
+
+    def _read_json(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def _scan_command(self, command, excluded, tools, inputs):
+        """Collect the tools and input files of the command line. """
+        expect_tool, wrapper = True, False
+        for token in shlex.split(command):
+            if token in _SHELL_OPERATORS:
+                expect_tool, wrapper = True, False
+                continue
+            end_of_command = token.endswith(';')
+            token = token.rstrip(';')
+            if expect_tool:
+                if '=' in token and not token.startswith('-'):
+                    continue  # Environment variable assignment
+                expect_tool = end_of_command
+                path = _find_executable(token)
+                if path:
+                    st = os.stat(path)
+                    tools.append([token, path, st.st_size, st.st_mtime])
+                continue
+            expect_tool = end_of_command
+            if token.startswith('blade.'):  # Modules of blade, such as blade.toolchain
+                tools.append(_blade_identity())
+                wrapper = True
+                continue
+            if token == '--' and wrapper:
+                # The command wrapped by blade follows, such as the linking command
+                expect_tool = True
+                continue
+            for path in _split_paths(token):
+                if path not in excluded and not path.startswith('-') and os.path.isfile(path):
+                    inputs.append([path, self._digest(path)])
+
+    def base_key(self):
+        """Calculate the key from the command line, tools and input files. """
+        excluded = set(self.outputs)
+        if self.depfile:
+            excluded.add(self.depfile)
+        tools, inputs = [], []
+        self._scan_command(self.command, excluded, tools, inputs)
+        m = md5.md5()
+        m.update(json.dumps([_key_command(self.command), tools, sorted(inputs)]).encode('utf-8'))
+        return m.hexdigest()
+
+    def _result_key(self, base_key, deps):
+        m = md5.md5()
+        m.update(json.dumps([base_key, sorted(deps.items())]).encode('utf-8'))
+        return m.hexdigest()
+
+    def _match_manifest(self, base_key):
+        """Find the result key whose recorded dependencies are not changed. """
+        manifest = self._read_json(self._path('manifests', base_key)) or []
+        for entry in manifest:
+            deps = entry['deps']
+            if all(self._digest(path) == digest for path, digest in deps.items()):
+                return entry['result']
+        return None
+
+    def _update_manifest(self, base_key, deps, result_key):
+        path = self._path('manifests', base_key)
+        manifest = self._read_json(path) or []
+        manifest = [e for e in manifest if e['result'] != result_key]
+        manifest.append({'deps': deps, 'result': result_key})
+        self._write_json(path, manifest[-_MAX_MANIFEST_ENTRIES:])
+
+    def lookup(self, base_key):
+        """Return the result key if the action is in the cache. """
+        if self.depfile:
+            return self._match_manifest(base_key)
+        return base_key
+
+    def restore(self, result_key):
+        """Restore outputs of the action, return its console output or None if missed. """
+        result_path = self._path('ac', result_key)
+        result = self._read_json(result_path)
+        if not result:
+            return None
+        blobs = [self._path('cas', digest) for output, digest, mode in result['outputs']]
+        if not all(os.path.exists(blob) for blob in blobs):
+            return None  # Evicted
+        try:
+            for (output, digest, mode), blob in zip(result['outputs'], blobs):
+                self._write_file(output, lambda f: _copy_to(blob, f))
+                os.chmod(output, mode)
+                os.utime(blob, None)  # Keep it in the cache
+            os.utime(result_path, None)
+        except EnvironmentError:
+            return None
+        return result['output']
+
+    def save(self, base_key, output):
+        """Save outputs of the succeeded action into the cache. """
+        outputs = list(self.outputs)
+        result_key = base_key
+        deps = None
+        if self.depfile:
+            deps = dict((dep, self._digest(dep)) for dep in parse_depfile(self.depfile))
+            result_key = self._result_key(base_key, deps)
+            outputs.append(self.depfile)
+        entries = []
+        for path in outputs:
+            digest = _file_digest(path)
+            blob = self._path('cas', digest)
+            if not os.path.exists(blob):
+                self._write_file(blob, lambda f: _copy_to(path, f))
+            entries.append([path, digest, stat.S_IMODE(os.stat(path).st_mode)])
+        self._write_json(self._path('ac', result_key),
+                         {'outputs': entries, 'output': output})
+        if deps is not None:
+            self._update_manifest(base_key, deps, result_key)
+
+
+def _copy_to(path, f):
+    with open(path, 'rb') as src:
+        shutil.copyfileobj(src, f)
+
+
+def _write_output(output):
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    out.write(output)
+    out.flush()
+
+
+def run_action(cache_dir, command, outputs, depfile=None):
+    """Run the action, or restore its outputs from the cache. """
+    cache = ActionCache(cache_dir, command, outputs, depfile)
+    try:
+        base_key = cache.base_key()
+        result_key = cache.lookup(base_key)
+        output = cache.restore(result_key) if result_key else None
+        if output is not None:
+            _write_output(output.encode('utf-8'))
+            return 0
+    except EnvironmentError as e:
+        print('blade: Failed to lookup the action cache: %s' % e, file=sys.stderr)
+        base_key = None
+
+    p = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = p.communicate()[0]
+    _write_output(output)
+    if p.returncode != 0 or base_key is None:
+        return p.returncode
+    try:
+        cache.save(base_key, output.decode('utf-8', 'replace'))
+    except EnvironmentError as e:
+        print('blade: Failed to save into the action cache: %s' % e, file=sys.stderr)
+    return 0
+
+
+def evict(cache_dir, max_size, interval):
+    """Remove the least recently used files if the cache exceeds the max size.
+
+    Walking a large cache is slow, so it is only checked if the last eviction,
+    by any workspace sharing the cache, is older than the interval in seconds.
+
+    Return (number of removed files, size of removed files).
+    """
+    stamp_file = os.path.join(cache_dir, _EVICT_STAMP_FILE)
+    try:
+        if time.time() - os.path.getmtime(stamp_file) < interval:
+            return 0, 0
+    except OSError:
+        if not os.path.isdir(cache_dir):
+            return 0, 0
+    # Update the stamp before walking to avoid concurrent evictions
+    with open(stamp_file, 'a'):
+        os.utime(stamp_file, None)
+    files = []
+    total_size = 0
+    for kind in ('cas', 'ac', 'manifests'):
+        for root, dirs, names in os.walk(os.path.join(cache_dir, kind)):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue  # Removed by others concurrently
+                files.append((st.st_mtime, st.st_size, path))
+                total_size += st.st_size
+    if total_size <= max_size:
+        return 0, 0
+    removed_count, removed_size = 0, 0
+    for mtime, size, path in sorted(files):
+        if total_size - removed_size <= max_size * _EVICT_TARGET_RATIO:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        removed_count += 1
+        removed_size += size
+    return removed_count, removed_size
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='blade.action_cache')
+    parser.add_argument('--cache-dir', required=True)
+    parser.add_argument('--depfile')
+    parser.add_argument('--outputs', nargs='+', required=True)
+    # The command is written into the rspfile by ninja verbatim, never quote it again
+    parser.add_argument('--command-file', required=True)
+    options = parser.parse_args()
+    with open(options.command_file) as f:
+        command = f.read()
+    sys.exit(run_action(options.cache_dir, command, options.outputs, options.depfile))
+
+
+if __name__ == '__main__':
+    main()
@@ -15,14 +15,119 @@
 
 from __future__ import absolute_import
 
+import errno
+import fcntl
+import json
 import os
 import shutil
+import stat
 import subprocess
 import sys
 
 from blade import config
 from blade import console
-from blade.blade_util import environ_add_path
+from blade.blade_util import environ_add_path, iteritems, md5sum
+
+
+_RUNFILES_MANIFEST_VERSION = 2
+
+# How to place a testdata into the runfiles dir:
+# copy: copy the source, by reflink (copy-on-write) if the file system supports it
+# hardlink: make hard links to the source files, fallback to copy across file systems
+# link: make a tree of real directories and symbolic links to the source files
+# The files are shared with the source tree in the later two modes, so tests which
+# modify their testdata should use the copy mode.
+_TESTDATA_MODES = ('copy', 'hardlink', 'link')
+
+# ioctl request code of FICLONE on linux, see ioctl_ficlone(2)
+_FICLONE = 0x40049409
+
+
+def _source_signature(path):
+    """Return a string which changes if the file or any file under the dir changes. """
+    if not os.path.isdir(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return 'missing'
+        return '%s:%s' % (st.st_mtime, st.st_size)
+    signatures = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            f = os.path.join(root, name)
+            signatures.append('%s %s' % (os.path.relpath(f, path), _source_signature(f)))
+    return md5sum('\n'.join(signatures))
+
+
+def _copy_file(src, dst):
+    """Copy file by reflink if possible, otherwise do a normal copy. """
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+        shutil.copystat(src, dst)
+        return
+    except (IOError, OSError):
+        pass
+    shutil.copy2(src, dst)
+
+
+def _link_file(src, dst):
+    os.symlink(src, dst)
+
+
+def _hardlink_file(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError as e:
+        if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+            raise
+        _copy_file(src, dst)
+
+
+_FILE_MATERIALIZERS = {
+    'symlink': _link_file,
+    'link': _link_file,
+    'hardlink': _hardlink_file,
+    'copy': _copy_file,
+}
+
+
+def _placed_identity(path):
+    """Return the identity of a placed path, which changes if it is replaced or modified. """
+    st = os.lstat(path)
+    if stat.S_ISLNK(st.st_mode):
+        return ['symlink', os.readlink(path)]
+    if stat.S_ISDIR(st.st_mode):
+        return ['dir']
+    return ['file', st.st_ino, st.st_size, st.st_mtime]
+
+
+def _materialize(src, dst, mode, files):
+    """Place src at dst according to mode.
+
+    All generated paths are added into the files dict, as {dst: [src, mode]}.
+    Directories are always made as real directories, so a test can create new files
+    in them without polluting the source tree.
+    """
+    if mode == 'symlink':
+        os.symlink(src, dst)
+        files[dst] = [src, mode]
+        return
+    materialize_file = _FILE_MATERIALIZERS[mode]
+    if not os.path.isdir(src):
+        if os.path.exists(src):
+            materialize_file(src, dst)
+            files[dst] = [src, mode]
+        return
+    for root, dirs, filenames in os.walk(src):
+        dst_root = os.path.normpath(os.path.join(dst, os.path.relpath(root, src)))
+        os.mkdir(dst_root)
+        files[dst_root] = [root, 'dir']
+        for name in filenames:
+            dst_file = os.path.join(dst_root, name)
+            materialize_file(os.path.join(root, name), dst_file)
+            files[dst_file] = [os.path.join(root, name), mode]
 
 
 class BinaryRunner(object):
@@ -43,6 +148,8 @@ class BinaryRunner(object):
                          'scala_test',
                          'sh_test']
         self.target_database = target_database
+        # Keys of targets whose runfiles have been prepared
+        self._prepared_targets = set()
 
     def _executable(self, target):
         """Returns the executable path. """
@@ -80,57 +187,50 @@ class BinaryRunner(object):
                 console.error_exit('%s could not exist with %s in testdata of %s' % (
                     dest, item, target.fullname))
 
-    def _prepare_env(self, target):
-        """Prepare the test environment. """
-        runfiles_dir = self._runfiles_dir(target)
-        shutil.rmtree(runfiles_dir, ignore_errors=True)
-        os.mkdir(runfiles_dir)
-        # Build profile symlink
-        profile_link_name = os.path.basename(self.build_dir)
-        os.symlink(os.path.abspath(self.build_dir),
-                   os.path.join(runfiles_dir, profile_link_name))
+    def _runfiles_manifest_path(self, target):
+        """Returns the path of the manifest file of the runfiles dir. """
+        return '%s.manifest' % self._runfiles_dir(target)
 
-        # Prebuilt library symlink
+    def _prebuilt_runfiles_entries(self, target):
+        """Returns the runfiles entries of prebuilt library symlinks. """
+        entries = []
+        dest_set = set()
         for prebuilt_file in self._get_prebuilt_files(target):
             src = os.path.abspath(prebuilt_file[0])
-            dst = os.path.join(runfiles_dir, prebuilt_file[1])
-            if os.path.lexists(dst):
+            dest = prebuilt_file[1]
+            if dest in dest_set:
                 console.warning('trying to make duplicate prebuilt symlink:\n'
                                 '%s -> %s\n'
-                                '%s -> %s already exists\n'
                                 'skipped, should check duplicate prebuilt '
-                                'libraries'
-                                % (dst, src, dst, os.path.realpath(dst)))
+                                'libraries' % (dest, src))
                 continue
-            os.symlink(src, dst)
-
-        self._prepare_test_data(target)
-        run_env = dict(os.environ)
-        environ_add_path(run_env, 'LD_LIBRARY_PATH', runfiles_dir)
-        run_lib_paths = config.get_item('cc_binary_config', 'run_lib_paths')
-        if run_lib_paths:
-            for path in run_lib_paths:
-                if path.startswith('//'):
-                    path = path[2:]
-                path = os.path.abspath(path)
-                environ_add_path(run_env, 'LD_LIBRARY_PATH', path)
-        java_home = config.get_item('java_config', 'java_home')
-        if java_home:
-            java_home = os.path.abspath(java_home)
-            environ_add_path(run_env, 'PATH', os.path.join(java_home, 'bin'))
+            dest_set.add(dest)
+            entries.append((src, dest, 'symlink'))
+        return entries
 
-        return run_env
+    def _test_data_entries(self, target):
+        """Returns the runfiles entries of the testdata of the target.
 
-    def _prepare_test_data(self, target):
+        Each testdata can be either a path, a (src, dest) tuple, or a (src, dest, mode)
+        tuple, where mode can be 'copy', 'hardlink' or 'link'.
+        """
+        entries = []
         if 'testdata' not in target.data:
-            return
-        runfiles_dir = self._runfiles_dir(target)
+            return entries
+        default_mode = config.get_item('global_config', 'testdata_mode')
         dest_list = []
         for i in target.data['testdata']:
             if isinstance(i, tuple):
-                src, dest = i
+                src, dest = i[0], i[1]
+                mode = i[2] if len(i) > 2 else default_mode
             else:
                 src = dest = i
+                mode = default_mode
+            if mode not in _TESTDATA_MODES:
+                console.warning('//%s: Invalid testdata mode "%s" of %s, can only be in %s. '
+                                'Use "%s" instead.' % (target.fullname, mode, src,
+                                                       _TESTDATA_MODES, default_mode))
+                mode = default_mode
             if '..' in src:
                 console.warning('//%s: Relative path is not allowed in testdata source. '
                                 'Ignored %s.' % (target.fullname, src))
@@ -144,52 +244,187 @@ class BinaryRunner(object):
             dest = os.path.normpath(dest)
             self.__check_test_data_dest(target, dest, dest_list)
             dest_list.append(dest)
-            dest_path = os.path.join(runfiles_dir, dest)
-            if os.path.exists(dest_path):
-                console.warning('//%s: %s already existed, could not prepare testdata.' %
-                                (target.fullname, dest))
-                continue
-            try:
-                os.makedirs(os.path.dirname(dest_path))
-            except OSError:
-                pass
-
-            if os.path.isfile(src):
-                shutil.copy2(src, dest_path)
-            elif os.path.isdir(src):
-                shutil.copytree(src, dest_path)
-
-        self._prepare_extra_test_data(target)
+            entries.append((os.path.abspath(src), dest, mode))
+        return entries
 
-    def _prepare_extra_test_data(self, target):
-        """Prepare extra test data specified in the .testdata file if it exists. """
+    def _extra_test_data_entries(self, target):
+        """Returns entries of extra test data specified in the .testdata file if it exists. """
+        entries = []
         testdata = os.path.join(self.build_dir, target.path,
                                 '%s.testdata' % target.name)
         if os.path.isfile(testdata):
-            runfiles_dir = self._runfiles_dir(target)
+            default_mode = config.get_item('global_config', 'testdata_mode')
             for line in open(testdata):
                 data = line.strip().split()
                 if len(data) == 1:
-                    src, dst = data[0], ''
+                    src, dest = data[0], os.path.basename(data[0])
                 else:
-                    src, dst = data[0], data[1]
-                dst = os.path.join(runfiles_dir, dst)
-                dst_dir = os.path.dirname(dst)
-                if not os.path.isdir(dst_dir):
-                    os.makedirs(dst_dir)
-                shutil.copy2(src, dst)
+                    src, dest = data[0], data[1]
+                mode = data[2] if len(data) > 2 else default_mode
+                if mode not in _TESTDATA_MODES:
+                    console.warning('//%s: Invalid testdata mode "%s" of %s, can only be in %s. '
+                                    'Use "%s" instead.' % (target.fullname, mode, src,
+                                                           _TESTDATA_MODES, default_mode))
+                    mode = default_mode
+                entries.append((src, os.path.normpath(dest), mode))
+        return entries
+
+    def _runfiles_entries(self, target):
+        """All entries should be placed into the runfiles dir, as (src, dest, mode) list. """
+        return (self._prebuilt_runfiles_entries(target) +
+                self._test_data_entries(target) +
+                self._extra_test_data_entries(target))
+
+    def _runfiles_manifest(self, entries):
+        """Calculate the manifest of the runfiles dir from its entries.
+
+        The signature changes if any source file is added, removed or modified.
+        """
+        signatures = []
+        for src, dest, mode in entries:
+            if mode == 'symlink':
+                signatures.append('%s %s' % (src, dest))
+            else:
+                signatures.append('%s %s %s %s' % (src, dest, mode, _source_signature(src)))
+        return {
+            'version': _RUNFILES_MANIFEST_VERSION,
+            'entries': entries,
+            'signature': md5sum('\n'.join(signatures)),
+        }
+
+    def _load_runfiles_manifest(self, target):
+        path = self._runfiles_manifest_path(target)
+        if os.path.exists(path) and os.path.isdir(self._runfiles_dir(target)):
+            try:
+                with open(path) as f:
+                    return json.load(f)
+            except (IOError, ValueError) as e:
+                console.debug('//%s: Error loading runfiles manifest: %s' % (target.fullname, e))
+        return {}
+
+    def _materialize_runfiles(self, runfiles_dir, entries):
+        """Build the runfiles dir from scratch.
+
+        Return all generated paths, as {path: [src, mode, identity]}.
+        """
+        shutil.rmtree(runfiles_dir, ignore_errors=True)
+        os.mkdir(runfiles_dir)
+        files = {}
+        for src, dest, mode in entries:
+            dest_path = os.path.join(runfiles_dir, dest)
+            if os.path.lexists(dest_path):
+                console.warning('%s already existed, could not prepare runfiles.' % dest_path)
+                continue
+            parent_dirs = []
+            dest_dir = os.path.dirname(dest_path)
+            while not os.path.isdir(dest_dir):
+                parent_dirs.append(dest_dir)
+                dest_dir = os.path.dirname(dest_dir)
+            for parent_dir in reversed(parent_dirs):
+                os.mkdir(parent_dir)
+                files[parent_dir] = [None, 'dir']
+            _materialize(src, dest_path, mode, files)
+        for path, placed in iteritems(files):
+            placed.append(_placed_identity(path))
+        return files
+
+    def _restore_runfiles(self, runfiles_dir, files):
+        """Restore a reused runfiles dir to the state just after it was materialized.
+
+        Files created by the last run are removed. The placed paths which are removed,
+        replaced or modified by the last run are placed again, others are kept as is.
+        Return whether any path is placed again.
+        """
+        for root, dirs, filenames in os.walk(runfiles_dir):
+            for name in filenames + dirs:
+                path = os.path.join(root, name)
+                if path in files:
+                    continue
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    os.remove(path)
+            dirs[:] = [d for d in dirs if os.path.join(root, d) in files and
+                       not os.path.islink(os.path.join(root, d))]
+        restored = False
+        # Parent dirs are sorted before the paths in them
+        for path in sorted(files):
+            src, mode, identity = files[path]
+            try:
+                if _placed_identity(path) == identity:
+                    continue
+            except OSError:
+                pass  # Removed
+            restored = True
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+            elif os.path.lexists(path):
+                os.remove(path)
+            if mode == 'dir':
+                os.mkdir(path)
+            else:
+                _FILE_MATERIALIZERS[mode](src, path)
+            files[path][2] = _placed_identity(path)
+        return restored
+
+    def _prepare_runfiles(self, target):
+        """Prepare the runfiles dir, reuse it if nothing changed since the last time. """
+        runfiles_dir = self._runfiles_dir(target)
+        entries = self._runfiles_entries(target)
+        manifest = self._runfiles_manifest(entries)
+        old_manifest = self._load_runfiles_manifest(target)
+        manifest_path = self._runfiles_manifest_path(target)
+        if (old_manifest.get('version') == manifest['version'] and
+                old_manifest.get('signature') == manifest['signature']):
+            console.debug('//%s: Reuse runfiles' % target.fullname)
+            manifest = old_manifest
+            if not self._restore_runfiles(runfiles_dir, manifest['files']):
+                return
+        else:
+            if os.path.exists(manifest_path):
+                os.remove(manifest_path)
+            manifest['files'] = self._materialize_runfiles(runfiles_dir, entries)
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f)
+
+    def _prepare_env(self, target):
+        """Prepare the test environment. """
+        runfiles_dir = self._runfiles_dir(target)
+        self._prepare_runfiles(target)
+        self._prepared_targets.add(target.key)
+        # Build profile symlink
+        profile_link_name = os.path.basename(self.build_dir)
+        profile_link_path = os.path.join(runfiles_dir, profile_link_name)
+        if not os.path.lexists(profile_link_path):
+            os.symlink(os.path.abspath(self.build_dir), profile_link_path)
+
+        run_env = dict(os.environ)
+        environ_add_path(run_env, 'LD_LIBRARY_PATH', runfiles_dir)
+        run_lib_paths = config.get_item('cc_binary_config', 'run_lib_paths')
+        if run_lib_paths:
+            for path in run_lib_paths:
+                if path.startswith('//'):
+                    path = path[2:]
+                path = os.path.abspath(path)
+                environ_add_path(run_env, 'LD_LIBRARY_PATH', path)
+        java_home = config.get_item('java_config', 'java_home')
+        if java_home:
+            java_home = os.path.abspath(java_home)
+            environ_add_path(run_env, 'PATH', os.path.join(java_home, 'bin'))
+
+        return run_env
 
     def _clean_target(self, target):
         """clean the test target environment. """
         profile_link_name = os.path.basename(self.build_dir)
         profile_link_path = os.path.join(self._runfiles_dir(target), profile_link_name)
-        if os.path.exists(profile_link_path):
+        if os.path.lexists(profile_link_path):
             os.remove(profile_link_path)
 
     def _clean_env(self):
         """clean test environment. """
-        for target in self.targets.values():
-            self._clean_target(target)
+        for key in self._prepared_targets:
+            self._clean_target(self.targets[key])
 
     def run_target(self, target_name):
         """Run one single target. """
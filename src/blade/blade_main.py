@@ -72,10 +72,11 @@ from __future__ import print_function
 
 import cProfile
 import errno
+import fcntl
 import json
 import os
 import pstats
-import re
+import select
 import signal
 import subprocess
 import sys
@@ -83,6 +84,7 @@ import time
 import traceback
 from string import Template
 
+from blade import action_cache
 from blade import build_attributes
 from blade import build_manager
 from blade import config
@@ -90,8 +92,11 @@ from blade import console
 from blade import target
 from blade.blade_util import find_blade_root_dir, find_file_bottom_up
 from blade.blade_util import get_cwd, iteritems, to_string
-from blade.blade_util import lock_file, unlock_file
+from blade.blade_util import file_stat, lock_file, scm_state_files, unlock_file
 from blade.command_args import CmdArguments
+from blade import fast_build
+from blade.load_build_files import get_globbed_dirs, get_included_files, get_scanned_dirs
+from blade.watcher import FileWatcher
 
 # Run target
 _TARGETS = None
@@ -99,6 +104,9 @@ _TARGETS = None
 _BLADE_ROOT_DIR = None
 _WORKING_DIR = None
 
+# The command line arguments
+_ARGV = None
+
 
 # For our open source projects (toft, thirdparty, foxy etc.), we make a project
 # dir , add subdirs are github repos, here we need to fix out the git ROOT for
@@ -231,57 +239,143 @@ def _show_slow_builds(build_start_time, show_builds_slower_than):
                 console.notice('%.4gs\t%s' % (cost_time, target), prefix=False)
 
 
-def _show_progress(p, rf):
-    # Convert description message such as '[1/123] CC xxx.cc' into progress bar
-    progress_re = re.compile(r'^\[(\d+)/(\d+)\]\s+')
+# Status of ninja: [finished/total/running/elapsed seconds]
+_NINJA_STATUS = '[%f/%t/%r/%e] '
+
+
+def _parse_ninja_status(line):
+    """Parse the status of the line, such as '[1/123/4/0.501] CXX xxx.cc'.
+
+    Return (finished, total, running, elapsed) or None if the line doesn't have a status.
+    """
+    if not line.startswith('['):
+        return None
+    status = line[1:].split('] ', 1)[0].split('/')
+    if len(status) != 4:
+        return None
+    try:
+        return int(status[0]), int(status[1]), int(status[2]), float(status[3])
+    except ValueError:
+        return None
+
+
+def _show_ninja_output(line):
+    """Convert status lines into the progress bar, output other lines as is. """
+    status = _parse_ninja_status(line)
+    if status:
+        console.show_progress_bar(*status)
+    elif line:
+        console.clear_progress_bar()
+        console.output(line)
+
+
+def _show_progress(p, log_file):
+    """Read the output of ninja from the pipe as soon as it is available, and tee it into the log. """
+    fd = p.stdout.fileno()
+    fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    pending = b''
     try:
         while True:
-            p.poll()
-            line = rf.readline().strip()
-            if line:
-                m = progress_re.match(line)
-                if m:
-                    console.show_progress_bar(int(m.group(1)), int(m.group(2)))
-                else:
-                    console.clear_progress_bar()
-                    console.output(line)
-            elif p.returncode is not None:
+            select.select([fd], [], [])
+            try:
+                data = os.read(fd, 64 * 1024)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            if not data:
                 break
-            else:
-                # Avoid cost too much cpu
-                time.sleep(0.1)
+            log_file.write(data)
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                _show_ninja_output(_decode_output(line).rstrip())
+        _show_ninja_output(_decode_output(pending).rstrip())
     finally:
         console.clear_progress_bar()
+        _drain_output(p, fd)
+        p.wait()
+
+
+def _decode_output(data):
+    """Decode the output of commands, which may be not in utf-8, such as gbk. """
+    if isinstance(data, str):  # Python 2
+        return data
+    return data.decode('utf-8', 'replace')
+
+
+def _drain_output(p, fd):
+    """Discard the remaining output of the child until it exits.
+
+    If reading is broken by an exception, the child may be blocked by the full pipe
+    and never exit. Kill it if it is interrupted again while draining.
+    """
+    try:
+        while p.poll() is None:
+            select.select([fd], [], [], 1.0)
+            try:
+                if not os.read(fd, 64 * 1024):
+                    break
+            except OSError as e:
+                if e.errno not in (errno.EAGAIN, errno.EINTR):
+                    raise
+    except (KeyboardInterrupt, EnvironmentError, select.error):
+        p.kill()
 
 
 def _run_ninja(cmd, options):
     cmdstr = subprocess.list2cmdline(cmd)
     if console.verbosity_compare(options.verbosity, 'quiet') > 0:
         return _run_backend_builder(cmdstr)
-    ninja_output = 'blade-bin/ninja_output.log'
-    with open(ninja_output, 'w', buffering=1) as wf, open(ninja_output, 'r', buffering=1) as rf:
-        os.environ['NINJA_STATUS'] = '[%f/%t] '  # The progress depends on this format
-        p = subprocess.Popen(cmdstr, shell=True, stdout=wf, stderr=subprocess.STDOUT)
-        _show_progress(p, rf)
+    os.environ['NINJA_STATUS'] = _NINJA_STATUS  # The progress depends on this format
+    with open('blade-bin/ninja_output.log', 'wb') as log_file:
+        p = subprocess.Popen(cmdstr, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        _show_progress(p, log_file)
     return p.returncode
 
 
-def _ninja_build(options):
+def _ninja_command(options):
     cmd = ['ninja']
     cmd += backend_builder_options(options)
     # Ninja enable parallel building defaultly, but we still set it explicitly.
     cmd.append('-j%s' % (options.jobs or build_manager.instance.parallel_jobs_num()))
+    load_limit = build_manager.instance.parallel_load_limit()
+    if load_limit:
+        # Throttle new jobs dynamically when the machine is overloaded
+        cmd.append('-l%s' % load_limit)
     if options.keep_going:
         cmd.append('-k0')
     if console.verbosity_compare(options.verbosity, 'verbose') >= 0:
         cmd.append('-v')
+    return cmd
+
+
+def _ninja_build(options):
+    cmd = _ninja_command(options)
     build_start_time = time.time()
     ret = _run_ninja(cmd, options)
+    jobs_num = options.jobs or build_manager.instance.parallel_jobs_num()
+    build_manager.instance.job_controller.update_history(build_start_time, jobs_num)
     if options.show_builds_slower_than is not None:
         _show_slow_builds(build_start_time, options.show_builds_slower_than)
+    if config.get_item('action_cache_config', 'enabled'):
+        _evict_action_cache()
     return ret
 
 
+def _evict_action_cache():
+    cache_dir = os.path.expanduser(config.get_item('action_cache_config', 'dir'))
+    try:
+        count, size = action_cache.evict(cache_dir,
+                                         config.get_item('action_cache_config', 'max_size'),
+                                         config.get_item('action_cache_config', 'evict_interval'))
+    except EnvironmentError as e:
+        console.warning('Failed to evict the action cache: %s' % e)
+        return
+    if count:
+        console.info('Evicted %d files (%.1fMB) from the action cache' % (count, size / 1048576.0))
+
+
 def build(options):
     _check_code_style(_TARGETS)
     console.info('building...')
@@ -461,24 +555,51 @@ def generate_scm_git():
     return url, revision
 
 
+def _load_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
 def generate_scm(build_dir):
+    """Generate the scm info into the build dir.
+
+    Probing the scm is slow, so it is skipped if the state files of the scm are not
+    changed, and the scm.json is only rewritten when its content is changed.
+    """
     if os.path.isdir('.git'):
-        url, revision = generate_scm_git()
+        generator = generate_scm_git
     elif os.path.isdir('.svn'):
-        url, revision = generate_scm_svn()
+        generator = generate_scm_svn
     else:
         console.debug('Unknown scm.')
         return
     path = os.path.join(build_dir, 'scm.json')
-    with open(path, 'w') as f:
-        json.dump({
-            'revision': revision,
-            'url': url,
-        }, f)
+    stamp_path = os.path.join(build_dir, 'scm.stamp')
+    stamp = [[f, file_stat(f)] for f in scm_state_files()]
+    scm = _load_json(path)
+    if scm is not None and _load_json(stamp_path) == stamp:
+        return
+    url, revision = generator()
+    if scm != {'revision': revision, 'url': url}:
+        with open(path, 'w') as f:
+            json.dump({
+                'revision': revision,
+                'url': url,
+            }, f)
+    with open(stamp_path, 'w') as f:
+        json.dump(stamp, f)
+
+
+def _embeds_scm(command):
+    """Whether the command builds targets which may embed the scm info. """
+    return command in ('build', 'run', 'test')
 
 
 def adjust_config_by_options(config, options):
-    for name in ('debug_info_level', 'backend_builder'):
+    for name in ('debug_info_level', 'backend_builder', 'reproducible'):
         value = getattr(options, name, None)
         if value:
             config.global_config(**{name: value})
@@ -494,6 +615,36 @@ def clear_build_script():
             pass
 
 
+def _save_fast_build(options, returncode):
+    """Retain the build script for the fast path of the following builds. """
+    if getattr(options, 'watch', False):
+        return  # Only the affected targets are in the build script
+    fast_build.clear()
+    if returncode != 0 or not config.get_item('global_config', 'build_fast_path'):
+        return
+    if (config.get_item('cc_config', 'cpplint') or
+            config.get_item('cc_config', 'header_inclusion_dependencies')):
+        # They have to check the changed files in every build
+        return
+    instance = build_manager.instance
+    source_dirs = instance.get_loaded_source_dirs()
+    files = config.config_files(_BLADE_ROOT_DIR) + scm_state_files()
+    files += [os.path.join(d, 'BUILD') for d in source_dirs]
+    files += get_included_files()
+    dirs = set(source_dirs) | get_scanned_dirs()
+    expires = None
+    if config.get_item('action_cache_config', 'enabled'):
+        # The action cache is only evicted by the whole pipeline
+        expires = time.time() + config.get_item('action_cache_config', 'evict_interval')
+    try:
+        fast_build.save(instance.get_blade_path(), _ARGV,
+                        os.path.normpath(os.path.join(_BLADE_ROOT_DIR, _WORKING_DIR)),
+                        instance.get_build_path(), files, dirs, _ninja_command(options),
+                        expires)
+    except (IOError, OSError) as e:
+        console.debug('Failed to save the fast build record: %s' % e)
+
+
 def run_subcommand(command, options, targets, blade_path, build_dir):
     """Run particular commands before loading"""
     # The 'dump' command is special, some kind of dump items should be ran before loading.
@@ -502,23 +653,38 @@ def run_subcommand(command, options, targets, blade_path, build_dir):
         config.dump(output_file_name)
         return 0
 
+    load_command_targets(command, options, targets, blade_path, build_dir)
+    if options.stop_after == 'load':
+        return 0
+    return run_loaded_subcommand(command, options)
+
+
+def load_command_targets(command, options, targets, blade_path, build_dir):
+    """Initialize the build manager and load the targets of the command.
+
+    If the build manager exists, which is kept by the resident server, it is reused
+    and only BUILD files not loaded yet are loaded.
+    """
     load_targets = targets
     if command == 'query' and options.dependents:
         # In query dependents mode, we must load all targets in workspace to get a whole view
         load_targets = ['.:...']
-    build_manager.initialize(targets,
-                             load_targets,
-                             blade_path,
-                             _WORKING_DIR,
-                             build_dir,
-                             _BLADE_ROOT_DIR,
-                             options,
-                             command)
-
-    # Build the targets
+    if build_manager.instance is None:
+        build_manager.initialize(targets,
+                                 load_targets,
+                                 blade_path,
+                                 _WORKING_DIR,
+                                 build_dir,
+                                 _BLADE_ROOT_DIR,
+                                 options,
+                                 command)
+    else:
+        build_manager.instance.update_command(targets, load_targets, _WORKING_DIR, options, command)
     build_manager.instance.load_targets()
-    if options.stop_after == 'load':
-        return 0
+
+
+def run_loaded_subcommand(command, options):
+    """Analyze and build the loaded targets. """
     build_manager.instance.analyze_targets()
     if options.stop_after == 'analyze':
         return 0
@@ -537,6 +703,8 @@ def run_subcommand(command, options, targets, blade_path, build_dir):
     }[command]
     try:
         returncode = action(options)
+        if command == 'build':
+            _save_fast_build(options, returncode)
     finally:
         clear_build_script()
 
@@ -562,11 +730,14 @@ def run_subcommand_profile(command, options, targets, blade_path, build_dir):
     return exit_code[0]
 
 
-def _main(blade_path, argv):
-    """The main entry of blade. """
+def setup_command(argv):
+    """Parse the command line and enter the root dir of the workspace. """
     command, options, targets = parse_command_line(argv)
     setup_console(options)
 
+    global _ARGV
+    _ARGV = argv
+
     global _BLADE_ROOT_DIR
     global _WORKING_DIR
     _BLADE_ROOT_DIR, _WORKING_DIR = get_source_dirs()
@@ -577,19 +748,29 @@ def _main(blade_path, argv):
             print("Blade: Entering directory `%s'" % _BLADE_ROOT_DIR)
         os.chdir(_BLADE_ROOT_DIR)
 
-    load_config(options, _BLADE_ROOT_DIR)
-    adjust_config_by_options(config, options)
-
     global _TARGETS
     if not targets:
         targets = ['.']
     targets = target.normalize(targets, _WORKING_DIR)
     _TARGETS = targets
+    return command, options, targets
+
+
+def _main(blade_path, argv):
+    """The main entry of blade. """
+    command, options, targets = setup_command(argv)
+
+    load_config(options, _BLADE_ROOT_DIR)
+    adjust_config_by_options(config, options)
 
     build_dir = setup_build_dir(options)
     setup_log(build_dir, options)
 
-    generate_scm(build_dir)
+    if _embeds_scm(command):
+        generate_scm(build_dir)
+
+    if getattr(options, 'watch', False):
+        return watch(command, options, targets, blade_path, build_dir)
 
     lock_file_fd = lock_workspace()
     try:
@@ -600,6 +781,152 @@ def _main(blade_path, argv):
         unlock_workspace(lock_file_fd)
 
 
+def run_loaded_command(command, options, build_dir):
+    """Run the command whose targets are loaded by the resident server. """
+    setup_log(build_dir, options)
+    if _embeds_scm(command):
+        generate_scm(build_dir)
+    lock_file_fd = lock_workspace()
+    try:
+        if options.stop_after == 'load':
+            return 0
+        return run_loaded_subcommand(command, options)
+    finally:
+        unlock_workspace(lock_file_fd)
+
+
+def _watched_dirs(build_dir):
+    """Dirs of the BUILD files, sources, headers, include dirs, globs and included files. """
+    dirs = set(['.'])
+    for t in build_manager.instance.get_target_database().values():
+        dirs.add(t.path)
+        for src in t.srcs + t.data.get('hdrs', []):
+            dirs.add(os.path.dirname(os.path.join(t.path, src)))
+        dirs.update(t.data.get('incs', []))
+        dirs.update(t.data.get('export_incs', []))
+    for globbed_dirs in get_globbed_dirs().values():
+        dirs.update(globbed_dirs)
+    for path in get_included_files():
+        dirs.add(os.path.dirname(path))
+    return [d for d in dirs if not _target_in_dir(os.path.normpath(d), build_dir)]
+
+
+def _globbed_dir_stats():
+    """Return {source dir: {globbed dir: stat}}, see `_changed_glob_source_dirs`. """
+    return dict((source_dir, dict((d, file_stat(d)) for d in dirs))
+                for source_dir, dirs in get_globbed_dirs().items())
+
+
+def _changed_glob_source_dirs(globbed_dir_stats):
+    """Source dirs whose glob results may be changed.
+
+    The stat of a dir changes when any entry is created or removed in it, but not
+    when an entry is modified.
+    """
+    return [source_dir for source_dir, stats in globbed_dir_stats.items()
+            if any(file_stat(d) != stat for d, stat in stats.items())]
+
+
+def _reload_targets(command, options, targets, blade_path, build_dir, source_dirs):
+    """Load the changed BUILD files again, return whether it is successful. """
+    build_manager.instance.invalidate_source_dirs(source_dirs)
+    for source_dir in source_dirs:
+        get_globbed_dirs().pop(source_dir, None)
+    lock_file_fd = lock_workspace()
+    try:
+        load_command_targets(command, options, targets, blade_path, build_dir)
+    except SystemExit:  # The errors have been reported
+        return False
+    finally:
+        unlock_workspace(lock_file_fd)
+    return True
+
+
+def _run_watched_command(command, options, build_dir, changed_files):
+    """Run the command in a child process to keep the loaded targets unmodified. """
+    build_manager.instance.set_changed_files(changed_files)
+    pid = os.fork()
+    if pid == 0:
+        exit_code = run_main(run_loaded_command, command, options, build_dir)
+        console.flush()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit((exit_code or 0) & 0xff)
+    interrupted = False
+    while True:
+        try:
+            status = os.waitpid(pid, 0)[1]
+            break
+        except KeyboardInterrupt:
+            interrupted = True  # The child is interrupted too
+    if interrupted:
+        raise KeyboardInterrupt()
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def watch(command, options, targets, blade_path, build_dir):
+    """Run the command, then run it again for the affected targets when files are changed.
+
+    The loaded targets are kept between runs, only the changed BUILD files are loaded again.
+    Changing the config files restarts the whole command.
+    """
+    lock_file_fd = lock_workspace()
+    try:
+        load_command_targets(command, options, targets, blade_path, build_dir)
+    finally:
+        unlock_workspace(lock_file_fd)
+    exit_code = _run_watched_command(command, options, build_dir, None)
+    console.notice('Watching for changes, press Ctrl-C to exit')
+    watcher = FileWatcher()
+    globbed_dir_stats = _globbed_dir_stats()
+    # Changes not built yet because of loading errors
+    pending_files = set()
+    try:
+        while True:
+            watcher.set_dirs(_watched_dirs(build_dir))
+            changed_files = watcher.wait()
+            if changed_files is not None:
+                # Ignore the outputs of blade itself
+                changed_files = set(f for f in changed_files
+                                    if f not in ('build.ninja', 'blade-bin') and
+                                    not _target_in_dir(f, build_dir))
+                if not changed_files:
+                    continue
+            if changed_files is None or (changed_files & set(['BLADE_ROOT', 'BLADE_ROOT.local'])):
+                console.notice('Config or too many files are changed, restart')
+                watcher.close()
+                os.chdir(os.path.join(_BLADE_ROOT_DIR, _WORKING_DIR))
+                os.execv(sys.executable, [sys.executable] + sys.argv)
+            console.info('Changed: %s' % ', '.join(sorted(changed_files)))
+            changed_files |= pending_files
+            included_files = set(os.path.normpath(f) for f in get_included_files())
+            if pending_files or changed_files & included_files:
+                # Reload all BUILD files
+                source_dirs = list(build_manager.instance.get_loaded_source_dirs())
+            else:
+                source_dirs = set(os.path.dirname(f) or '.' for f in changed_files
+                                  if os.path.basename(f) == 'BUILD')
+                # Entries are created or removed in dirs walked by globs
+                source_dirs.update(_changed_glob_source_dirs(globbed_dir_stats))
+                source_dirs = sorted(source_dirs)
+            if source_dirs and not _reload_targets(command, options, targets, blade_path,
+                                                   build_dir, source_dirs):
+                pending_files = changed_files
+                console.notice('Watching for changes, press Ctrl-C to exit')
+                continue
+            pending_files = set()
+            globbed_dir_stats = _globbed_dir_stats()
+            exit_code = _run_watched_command(command, options, build_dir, changed_files)
+            console.notice('Watching for changes, press Ctrl-C to exit')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()
+    return exit_code
+
+
 def format_timedelta(seconds):
     """
     Format the time delta as human readable format such as '1h20m5s' or '5s' if it is short.
@@ -620,10 +947,22 @@ def format_timedelta(seconds):
 
 
 def main(blade_path, argv):
+    from blade import server
+    if server.is_server_process():
+        return server.serve(blade_path)
+    if server.use_server(argv):
+        exit_code = server.run_client(blade_path, argv)
+        if exit_code is not None:
+            return exit_code
+    return run_main(_main, blade_path, argv)
+
+
+def run_main(function, *args):
+    """Run the main function, report the cost time and errors, return the exit code. """
     exit_code = 0
     try:
         start_time = time.time()
-        exit_code = _main(blade_path, argv)
+        exit_code = function(*args)
         cost_time = int(time.time() - start_time)
         if cost_time > 1:
             console.info('cost time %s' % format_timedelta(cost_time))
@@ -20,6 +20,12 @@ from blade import console
 from blade.blade_util import var_to_list, iteritems, to_string
 
 
+def split_dwarf_enabled():
+    """Whether the debug info is split into .dwo files. """
+    return (config.get_item('cc_config', 'split_dwarf') and
+            config.get_item('global_config', 'debug_info_level') != 'no')
+
+
 class BuildArchitecture(object):
     """
     The BuildArchitecture class manages architecture/bits configuration
@@ -320,6 +326,15 @@ class CcFlagsManager(object):
         debug_info_level = global_config['debug_info_level']
         debug_info_options = cc_config['debug_info_levels'][debug_info_level]
         flags_except_warning += debug_info_options
+        if debug_info_level != 'no':
+            if cc_config['compress_debug_sections']:
+                # Objects are small when the debug info is split, and dwp may not
+                # support compressed .dwo files
+                if not split_dwarf_enabled():
+                    flags_except_warning.append('-gz')
+                linkflags.append('-gz')
+            if cc_config['gdb_index']:
+                linkflags.append('-Wl,--gdb-index')
 
         # Option debugging flags
         if self.options.profile == 'debug':
@@ -334,6 +349,13 @@ class CcFlagsManager(object):
             '-D__STDC_LIMIT_MACROS',
         ]
 
+        if global_config['reproducible']:
+            # Don't embed the absolute path of the workspace into the debug info, and
+            # also into __FILE__ if the compiler supports -ffile-prefix-map (gcc 8+),
+            # the path is also ignored in the keys of the action cache
+            flags_except_warning.append('-fdebug-prefix-map=%s=.' % os.getcwd())
+            flags_except_warning.append('-ffile-prefix-map=%s=.' % os.getcwd())
+
         if getattr(self.options, 'gprof', False):
             flags_except_warning.append('-pg')
             linkflags.append('-pg')
@@ -351,6 +373,9 @@ class CcFlagsManager(object):
                               '-Wl,--no-whole-archive']
 
         flags_except_warning = self._filter_out_invalid_flags(flags_except_warning)
+        if split_dwarf_enabled():
+            # Not checked by compiling, which leaves a .dwo file
+            flags_except_warning.append('-gsplit-dwarf')
         return flags_except_warning, linkflags
 
     def get_warning_flags(self):
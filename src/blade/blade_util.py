@@ -23,6 +23,8 @@ import sys
 import string
 import signal
 import subprocess
+import time
+import zipfile
 
 from blade import console
 
@@ -125,6 +127,41 @@ def get_cwd():
     return to_string(p.communicate()[0].strip())
 
 
+def file_stat(path):
+    """Return the modification time and the size of the file, or None if it doesn't exist. """
+    try:
+        st = os.stat(path)
+        return [st.st_mtime, st.st_size]
+    except OSError:
+        return None
+
+
+def blade_code_identity(blade_path):
+    """The modification time of the code of blade, it changes when blade is upgraded. """
+    if os.path.isfile(blade_path):  # blade.zip
+        return os.path.getmtime(blade_path)
+    code_dir = os.path.dirname(os.path.abspath(__file__))
+    return max(os.path.getmtime(os.path.join(code_dir, name))
+               for name in os.listdir(code_dir) if name.endswith('.py'))
+
+
+def scm_state_files():
+    """Files in the scm dir which are changed when the revision of the workspace is changed. """
+    if os.path.isdir('.git'):
+        files = ['.git/HEAD', '.git/packed-refs', '.git/config']
+        try:
+            with open('.git/HEAD') as f:
+                head = f.read().strip()
+            if head.startswith('ref: '):
+                files.append(os.path.join('.git', head[len('ref: '):]))
+        except IOError:
+            pass
+        return files
+    if os.path.isdir('.svn'):
+        return ['.svn/wc.db']
+    return []
+
+
 def find_file_bottom_up(name, from_dir=None):
     """Find the specified file/dir from from_dir bottom up until found or failed.
        Returns abspath if found, or empty if failed.
@@ -200,6 +237,69 @@ def load_scm(build_dir):
     return revision, url
 
 
+# The earliest time can be represented in zip files, 1980-01-01 00:00:00,
+# it is also the default timestamp of reproducible builds
+ZIP_MIN_EPOCH = 315532800
+
+
+def source_date_epoch():
+    """Return the fixed timestamp of reproducible builds, None if it is not reproducible.
+
+    It is passed from blade to the build actions by the `SOURCE_DATE_EPOCH` environment,
+    see https://reproducible-builds.org/specs/source-date-epoch/
+    """
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if epoch:
+        return int(epoch)
+    return None
+
+
+def _zip_info(name, epoch, mode):
+    info = zipfile.ZipInfo(name, time.gmtime(max(epoch, ZIP_MIN_EPOCH))[:6])
+    info.external_attr = (mode & 0xFFFF) << 16
+    return info
+
+
+def zip_writestr(zip_file, name, data):
+    """Write data into the zip file, the timestamp is fixed in reproducible builds. """
+    epoch = source_date_epoch()
+    if epoch is None:
+        zip_file.writestr(name, data)
+        return
+    info = _zip_info(name, epoch, 0o40755 if name.endswith('/') else 0o100644)
+    info.compress_type = zip_file.compression
+    zip_file.writestr(info, data)
+
+
+def zip_write(zip_file, path, arcname):
+    """Write file into the zip file, the timestamp is fixed in reproducible builds. """
+    epoch = source_date_epoch()
+    if epoch is None:
+        zip_file.write(path, arcname)
+        return
+    info = _zip_info(arcname, epoch, os.stat(path).st_mode)
+    info.compress_type = zip_file.compression
+    with open(path, 'rb') as f:
+        zip_file.writestr(info, f.read())
+
+
+def _zip_entry_order(entry):
+    # The manifest should be the first entries of a jar
+    name = entry.filename
+    return (name not in ('META-INF/', 'META-INF/MANIFEST.MF'), name)
+
+
+def normalize_zip(path, epoch):
+    """Rewrite the zip file with the fixed timestamp and sorted entries. """
+    temp_path = path + '.tmp'
+    with zipfile.ZipFile(path, 'r') as src, zipfile.ZipFile(temp_path, 'w') as dst:
+        for entry in sorted(src.infolist(), key=_zip_entry_order):
+            info = _zip_info(entry.filename, epoch, entry.external_attr >> 16)
+            info.compress_type = entry.compress_type
+            dst.writestr(info, src.read(entry.filename))
+    os.rename(temp_path, path)
+
+
 def environ_add_path(env, key, path):
     """Add path to PATH link environments, such as PATH, LD_LIBRARY_PATH, etc"""
     old = env.get(key)
@@ -24,9 +24,11 @@ from blade import console
 from blade import target
 from blade.binary_runner import BinaryRunner
 from blade.blade_platform import BuildPlatform
-from blade.blade_util import cpu_count
 from blade.build_environment import BuildEnvironment
 from blade.dependency_analyzer import analyze_deps
+from blade.impact_analyzer import analyze_affected_targets
+from blade.impact_analyzer import get_changed_files_since, load_changed_files
+from blade.job_controller import JobController
 from blade.load_build_files import load_targets
 from blade.rules_generator import NinjaRulesGenerator
 from blade.test_runner import TestRunner
@@ -79,6 +81,9 @@ class Blade(object):
         # command line targets.
         self.__target_database = {}
 
+        # Source dirs whose BUILD files have been loaded into the target database
+        self.__loaded_source_dirs = set()
+
         # targets to build after loading the build files.
         self.__build_targets = {}
 
@@ -92,6 +97,14 @@ class Blade(object):
         # Indicate whether the deps list is expanded by expander or not
         self.__targets_expanded = False
 
+        # Tests affected by the changed files and the targets they depend on.
+        # None means no impact analysis.
+        self.__affected_tests = None
+        self.__affected_build_targets = None
+
+        # Files changed since the last build in the watch mode, None means unknown.
+        self.__changed_files = None
+
         self.__build_time = time.time()
 
         self.__build_platform = BuildPlatform()
@@ -104,6 +117,15 @@ class Blade(object):
             'header_inclusion_dependencies': {},  # path(.H) -> mtime(modification time)
         }
 
+        self.job_controller = JobController(build_path,
+                                            config.get_item('build_jobs_config', 'max_jobs'),
+                                            config.get_item('build_jobs_config', 'job_memory'),
+                                            config.get_item('build_jobs_config', 'max_load'))
+        self._parallel_jobs_num = None
+
+        # Precompiled headers generated by targets, shared by targets with same flags
+        self._pch_files = set()
+
     def load_targets(self):
         """Load the targets. """
         console.info('loading BUILDs...')
@@ -118,6 +140,43 @@ class Blade(object):
         console.info('loading done.')
         return self.__direct_targets, self.__all_command_targets  # For test
 
+    def update_command(self, command_targets, load_targets, working_dir, blade_options, command):
+        """Reset the state for a new command, keep the loaded targets and the platform.
+
+        It is used by the resident server to run commands with the same build manager.
+        """
+        self.__command_targets = command_targets
+        self.__load_targets = load_targets
+        self.__working_dir = working_dir
+        self.__options = blade_options
+        self.__command = command
+        self.__current_source_path = self.__root_dir
+        self.__direct_targets = []
+        self.__all_command_targets = []
+        self.__build_targets = {}
+        self.__sorted_targets_keys = []
+        self.__depended_targets = {}
+        self.__targets_expanded = False
+        self.__affected_tests = None
+        self.__affected_build_targets = None
+        self.__changed_files = None
+        self.__build_time = time.time()
+        self.svn_root_dirs = []
+        self.job_controller = JobController(self.__build_path,
+                                            config.get_item('build_jobs_config', 'max_jobs'),
+                                            config.get_item('build_jobs_config', 'job_memory'),
+                                            config.get_item('build_jobs_config', 'max_load'))
+        self._parallel_jobs_num = None
+        self._pch_files = set()
+
+    def invalidate_source_dirs(self, source_dirs):
+        """Remove targets in the source dirs, their BUILD files will be loaded again. """
+        source_dirs = set(source_dirs)
+        for key in list(self.__target_database):
+            if key[0] in source_dirs:
+                del self.__target_database[key]
+        self.__loaded_source_dirs -= source_dirs
+
     def _expand_command_targets(self):
         """Expand command line targets to targets list"""
         all_targets = self.__build_targets
@@ -142,10 +201,46 @@ class Blade(object):
         (self.__sorted_targets_keys,
          self.__depended_targets) = analyze_deps(self.__build_targets)
         self.__targets_expanded = True
+        if self.__command == 'test' or self.__changed_files is not None:
+            self._analyze_affected_targets()
 
         console.info('analyzing done.')
         return self.__build_targets  # For test
 
+    def set_changed_files(self, changed_files):
+        """Set the files changed since the last build, which are used by the watch mode
+        to only build the affected targets and run the affected tests.
+        """
+        self.__changed_files = changed_files
+
+    def _analyze_affected_targets(self):
+        """Restrict the tests and the targets to build to the ones affected by changed files. """
+        options = self.__options
+        if self.__changed_files is not None:
+            changed_files = self.__changed_files
+        elif options.affected_by:
+            changed_files = get_changed_files_since(options.affected_by)
+        elif options.changed_files:
+            changed_files = load_changed_files(options.changed_files)
+        else:
+            return
+        console.info('%d files changed' % len(changed_files))
+        affected = analyze_affected_targets(changed_files,
+                                            self.__build_targets,
+                                            self.__depended_targets)
+        command_targets = set(self.__all_command_targets)
+        affected = set(key for key in affected if key in command_targets)
+        if self.__command == 'test':
+            self.__affected_tests = set(
+                key for key in affected if self.__build_targets[key].type.endswith('_test'))
+            affected = self.__affected_tests
+            console.notice('%d tests are affected by the changed files' % len(affected))
+        else:
+            console.notice('%d targets are affected by the changed files' % len(affected))
+        self.__affected_build_targets = set(affected)
+        for key in affected:
+            self.__affected_build_targets.update(self.__build_targets[key].expanded_deps)
+
     def new_build_rules_generator(self):
         return NinjaRulesGenerator('build.ninja', self.__blade_path, self)
 
@@ -195,7 +290,8 @@ class Blade(object):
                                  self.__options,
                                  self.__target_database,
                                  self.__direct_targets,
-                                 skip_tests)
+                                 skip_tests,
+                                 self.__affected_tests)
         return test_runner.run()
 
     def query(self):
@@ -322,6 +418,10 @@ class Blade(object):
         """The current building path. """
         return self.__build_path
 
+    def get_blade_path(self):
+        """The path of blade itself. """
+        return self.__blade_path
+
     def get_root_dir(self):
         """Return the blade root path. """
         return self.__root_dir
@@ -342,6 +442,10 @@ class Blade(object):
         """Get the whole target database that haven't been expanded. """
         return self.__target_database
 
+    def get_loaded_source_dirs(self):
+        """Source dirs whose BUILD files have been loaded. """
+        return self.__loaded_source_dirs
+
     def get_direct_targets(self):
         """Return the direct targets. """
         return self.__direct_targets
@@ -404,6 +508,9 @@ class Blade(object):
             if (skip_package and target.type == 'package'
                     and k not in self.__direct_targets):
                 continue
+            if (self.__affected_build_targets is not None and
+                    k not in self.__affected_build_targets):
+                continue
 
             blade_object.ninja_rules()
             rules = blade_object.get_rules()
@@ -412,6 +519,13 @@ class Blade(object):
                 rules_buf += rules
         return rules_buf
 
+    def register_pch(self, pch):
+        """Return whether the precompiled header is not generated by other targets. """
+        if pch in self._pch_files:
+            return False
+        self._pch_files.add(pch)
+        return True
+
     def get_build_platform(self):
         """Return build platform instance. """
         return self.__build_platform
@@ -444,20 +558,32 @@ class Blade(object):
         if user_jobs_num > 0:
             return user_jobs_num
 
+        if self._parallel_jobs_num is not None:
+            return self._parallel_jobs_num
+
         # Calculate job numbers smartly
-        distcc_enabled = config.get_item('distcc_config', 'enabled')
-        if distcc_enabled and self.build_environment.distcc_env_prepared:
+        if self._distcc_enabled():
             # Distcc doesn't cost much local cpu, jobs can be quite large.
             distcc_num = len(self.build_environment.get_distcc_hosts_list())
             jobs_num = min(max(int(1.5 * distcc_num), 1), 20)
         else:
-            cpu_core_num = cpu_count()
-            # machines with cpu_core_num > 4 is usually shared by multiple users,
-            # set an upper bound to avoid interfering other users
-            jobs_num = min(2 * cpu_core_num, 8)
+            # Machines may be shared by multiple users, the load of others and
+            # the free memory are also considered
+            jobs_num = self.job_controller.jobs_num()
         console.info('tunes the parallel jobs number(-j N) to be %d' % jobs_num)
+        self._parallel_jobs_num = jobs_num
         return jobs_num
 
+    def parallel_load_limit(self):
+        """Max load average for starting new jobs, 0 means unlimited. """
+        if self.__options.jobs > 0 or self._distcc_enabled():
+            return 0
+        return self.job_controller.load_limit()
+
+    def _distcc_enabled(self):
+        return (config.get_item('distcc_config', 'enabled') and
+                self.build_environment.distcc_env_prepared)
+
     def get_all_rule_names(self):
         return self.__all_rule_names
 
@@ -0,0 +1,151 @@
+# Copyright (c) 2020 Tencent Inc.
+# All rights reserved.
+#
+# Date:   March 25, 2020
+
+
+"""
+ This is the c/c++ coverage module which collects the gcov data of the
+ tests and generates the coverage report by lcov.
+
+ The coverage data of each object dir is captured in parallel, and the
+ tracefile is cached in the object dir until any .gcno or .gcda file in
+ it is changed.
+
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+from blade import console
+from blade.blade_util import to_string
+
+
+_TRACEFILE = 'blade_coverage.info'
+_TRACEFILE_STAMP = 'blade_coverage.stamp'
+
+# Number of tracefiles to be merged by each lcov command
+_MERGE_BATCH_SIZE = 32
+
+
+def _coverage_files_stamp(objs_dir):
+    """Return the {path: [mtime, size]} of all .gcno and .gcda files in the dir. """
+    stamp = {}
+    for root, dirs, files in os.walk(objs_dir):
+        for name in files:
+            if name.endswith('.gcno') or name.endswith('.gcda'):
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                stamp[os.path.relpath(path, objs_dir)] = [st.st_mtime, st.st_size]
+    return stamp
+
+
+def reset_counters(objs_dirs):
+    """Remove the existed .gcda files, so the report only contains the tests to be ran. """
+    for objs_dir in objs_dirs:
+        for root, dirs, files in os.walk(objs_dir):
+            for name in files:
+                if name.endswith('.gcda'):
+                    os.remove(os.path.join(root, name))
+
+
+class CcCoverageReporter(object):
+    """Generate coverage report of c/c++ code from the gcov data in object dirs. """
+
+    def __init__(self, lcov, genhtml, root_dir, jobs):
+        self.lcov = lcov
+        self.genhtml = genhtml
+        self.root_dir = root_dir
+        self.jobs = jobs
+
+    def _run(self, cmd):
+        """Run command, return whether it succeeded. """
+        console.debug(subprocess.list2cmdline(cmd))
+        try:
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as e:
+            console.warning('Failed to run %s: %s' % (cmd[0], e))
+            return False
+        stdout = p.communicate()[0]
+        if p.returncode != 0:
+            console.warning('%s failed:\n%s' % (cmd[0], to_string(stdout)))
+        return p.returncode == 0
+
+    def _capture(self, objs_dir):
+        """Capture the coverage data of the object dir, return the tracefile or None. """
+        stamp = _coverage_files_stamp(objs_dir)
+        if not any(path.endswith('.gcda') for path in stamp):
+            return None
+        tracefile = os.path.join(objs_dir, _TRACEFILE)
+        stamp_file = os.path.join(objs_dir, _TRACEFILE_STAMP)
+        if os.path.exists(tracefile) and os.path.exists(stamp_file):
+            try:
+                with open(stamp_file) as f:
+                    if json.load(f) == stamp:
+                        console.debug('Reuse coverage tracefile of %s' % objs_dir)
+                        return tracefile
+            except (IOError, ValueError):
+                pass
+        temp_tracefile = tracefile + '.tmp'
+        cmd = [self.lcov, '--quiet', '--capture', '--no-external',
+               '--directory', objs_dir,
+               '--base-directory', self.root_dir,
+               '--output-file', temp_tracefile]
+        if not self._run(cmd):
+            return None
+        os.rename(temp_tracefile, tracefile)
+        with open(stamp_file, 'w') as f:
+            json.dump(stamp, f)
+        return tracefile
+
+    def _merge(self, tracefiles, output):
+        """Merge tracefiles into output, which is also an input if it exists. """
+        if os.path.exists(output):
+            tracefiles = [output] + tracefiles
+        if len(tracefiles) == 1:
+            if tracefiles[0] != output:
+                shutil.copyfile(tracefiles[0], output)
+            return True
+        temp_output = output + '.tmp'
+        cmd = [self.lcov, '--quiet']
+        for tracefile in tracefiles:
+            cmd += ['--add-tracefile', tracefile]
+        cmd += ['--output-file', temp_output]
+        if not self._run(cmd):
+            return False
+        os.rename(temp_output, output)
+        return True
+
+    def generate_report(self, objs_dirs, tracefile, report_dir):
+        """Generate the html report of all object dirs. """
+        if os.path.exists(tracefile):
+            os.remove(tracefile)
+        console.info('Collecting c/c++ coverage data of %d object dirs' % len(objs_dirs))
+        pool = ThreadPool(self.jobs)
+        merged = 0
+        try:
+            # Merge tracefiles while capturing others
+            batch = []
+            for result in pool.imap_unordered(self._capture, objs_dirs):
+                if not result:
+                    continue
+                batch.append(result)
+                if len(batch) >= _MERGE_BATCH_SIZE:
+                    if self._merge(batch, tracefile):
+                        merged += len(batch)
+                    batch = []
+            if batch and self._merge(batch, tracefile):
+                merged += len(batch)
+        finally:
+            pool.close()
+            pool.join()
+        if not merged:
+            console.warning('No c/c++ coverage data is collected')
+            return
+        console.info('Generating c/c++ coverage report `%s`' % report_dir)
+        self._run([self.genhtml, '--quiet', tracefile, '--output-directory', report_dir])
@@ -14,6 +14,7 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import fnmatch
 import os
 import subprocess
 from string import Template
@@ -26,8 +27,10 @@ except ImportError:
 from blade import build_manager
 from blade import config
 from blade import console
+from blade import job_controller
 from blade import build_rules
-from blade.blade_util import var_to_list, stable_unique
+from blade.blade_platform import split_dwarf_enabled
+from blade.blade_util import md5sum, var_to_list, stable_unique
 from blade.constants import HEAP_CHECK_VALUES
 from blade.target import Target
 
@@ -572,8 +575,12 @@ class CcTarget(Target):
         and user libraries.
         User libraries consist of normal libraries and libraries which should
         be linked all symbols within them using whole-archive option of gnu linker.
+
+        If `cc_library_config.link_objects` is enabled, objects of the in-tree
+        libraries are linked directly instead of their archives.
         """
         targets = self.blade.get_build_targets()
+        link_objects = config.get_item('cc_library_config', 'link_objects')
         sys_libs, usr_libs, link_all_symbols_libs = [], [], []
         for key in self.expanded_deps:
             dep = targets[key]
@@ -581,6 +588,9 @@ class CcTarget(Target):
                 continue
             if key[0] == '#':
                 sys_libs.append(key[1])
+            elif link_objects and dep.type == 'cc_library' and dep.data.get('objs'):
+                # All objects are linked, same as the whole-archive
+                usr_libs += dep.data['objs']
             else:
                 lib = dep._get_target_file('a')
                 if lib:
@@ -617,6 +627,85 @@ class CcTarget(Target):
                          implicit_deps=implicit_deps, variables=vars)
         self.ninja_build('securecc', obj, inputs=secure_obj)
 
+    def _unity_build_enabled(self):
+        unity_build = self.data.get('unity_build')
+        if unity_build is None:
+            return config.get_item('cc_library_config', 'unity_build')
+        return unity_build
+
+    def _unity_batches(self, sources):
+        """Split sources into (sources to be compiled separately, batches of unity build).
+
+        Only existed C++ sources which are not excluded are compiled in batches.
+        """
+        cc_library_config = config.get_section('cc_library_config')
+        batch_size = cc_library_config['unity_batch_size']
+        if not self._unity_build_enabled() or batch_size < 2:
+            return sources, []
+        excludes = cc_library_config['unity_excludes']
+        separate, unity = [], []
+        for src in sources:
+            path = self._source_file_path(src)
+            if (self._get_ninja_rule_from_suffix(src) == 'cxx' and os.path.exists(path) and
+                    not any(fnmatch.fnmatch(path, pattern) for pattern in excludes)):
+                unity.append(src)
+            else:
+                separate.append(src)
+        batches = [unity[i:i + batch_size] for i in range(0, len(unity), batch_size)]
+        if batches and len(batches[-1]) == 1:
+            separate += batches.pop()
+        return separate, batches
+
+    def _unity_object_ninja(self, objs_dir, index, batch, implicit_deps, vars):
+        """Compile the batch of sources by including them in one unity source. """
+        unity = os.path.join(objs_dir, '__unity_%d.cc' % index)
+        obj = unity + '.o'
+        paths = ' '.join(self._source_file_path(src) for src in batch)
+        self.ninja_build('unity', unity, variables={'unity_srcs': paths})
+        obj_vars, implicit_outputs = dict(vars, unity_srcs=paths), None
+        if split_dwarf_enabled():
+            obj_vars['dwo'] = obj[:-len('.o')] + '.dwo'
+            implicit_outputs = [obj_vars['dwo']]
+        self.ninja_build('cxxunity', obj, inputs=unity,
+                         implicit_deps=implicit_deps,
+                         variables=obj_vars,
+                         implicit_outputs=implicit_outputs)
+        return obj
+
+    def _cc_pch_ninja(self, vars, implicit_deps):
+        """Generate the precompiled header of the `pch` attribute.
+
+        Return (stub header, pch file) or None. The stub header includes the header,
+        and is included by `-include`, the compiler uses the pch file next to it.
+        The stub has the same name as the header, so it includes the header by the
+        path relative to itself, never by the name which may resolve to the stub.
+        The pch is shared by targets with the same flags, its dir is keyed by the
+        compile variables, so a pch built with mismatched flags is never used.
+        """
+        pch = self.data.get('pch')
+        if not pch:
+            return None
+        header = self._source_file_path(pch)
+        key = md5sum('%s %s' % (header, sorted(vars.items())))
+        stub = os.path.join(self.build_path, 'pch', key, header)
+        if self.blade.get_build_platform().clang_in_use():
+            pch_file = stub + '.pch'
+        else:
+            pch_file = stub + '.gch'
+        if self.blade.register_pch(pch_file):
+            self.ninja_build('pchstub', stub, variables={
+                'header': os.path.relpath(header, os.path.dirname(stub))})
+            self.ninja_build('cxxpch', pch_file, inputs=stub,
+                             implicit_deps=implicit_deps,
+                             variables=dict(vars, header=header))
+        return stub, pch_file
+
+    def _pch_compile_vars(self, vars, implicit_deps, pch):
+        """Return variables and implicit dependencies to compile with the pch. """
+        stub, pch_file = pch
+        cppflags = '-Winvalid-pch -include %s %s' % (stub, vars.get('cppflags', ''))
+        return dict(vars, cppflags=cppflags.rstrip()), implicit_deps + [pch_file]
+
     def _cc_objects_ninja(self, sources, generated=False, generated_headers=None):
         """Generate cc objects build rules in ninja. """
         # pylint: disable=too-many-locals
@@ -629,9 +718,13 @@ class CcTarget(Target):
         secure = self.data.get('secure')
         if secure:
             implicit_deps.append('__securecc_phony__')
+        pch = None if secure else self._cc_pch_ninja(vars, implicit_deps)
 
         objs_dir = self._target_file_path(self.name + '.objs')
         objs, hdrs_inclusion_srcs = [], []
+        unity_batches = []
+        if not generated and not secure:
+            sources, unity_batches = self._unity_batches(sources)
         for src in sources:
             obj = '%s.o' % os.path.join(objs_dir, src)
             if secure:
@@ -646,13 +739,30 @@ class CcTarget(Target):
                     path = self._source_file_path(src)
                     if os.path.exists(path):
                         input = path
-                        hdrs_inclusion_srcs.append((path, obj, rule))
+                        hdrs_inclusion_srcs.append((path, obj, rule, obj))
                     else:
                         input = self._target_file_path(src)
+                obj_vars, obj_deps, implicit_outputs = vars, implicit_deps, None
+                if pch and rule == 'cxx':
+                    obj_vars, obj_deps = self._pch_compile_vars(vars, implicit_deps, pch)
+                if split_dwarf_enabled():
+                    dwo = obj[:-len('.o')] + '.dwo'
+                    obj_vars = dict(obj_vars, dwo=dwo)
+                    implicit_outputs = [dwo]
                 self.ninja_build(rule, obj, inputs=input,
-                                 implicit_deps=implicit_deps,
-                                 variables=vars)
+                                 implicit_deps=obj_deps,
+                                 variables=obj_vars,
+                                 implicit_outputs=implicit_outputs)
             objs.append(obj)
+        unity_vars, unity_deps = vars, implicit_deps
+        if pch:
+            unity_vars, unity_deps = self._pch_compile_vars(vars, implicit_deps, pch)
+        for index, batch in enumerate(unity_batches):
+            unity_obj = self._unity_object_ninja(objs_dir, index, batch, unity_deps, unity_vars)
+            for src in batch:
+                obj = '%s.o' % os.path.join(objs_dir, src)
+                hdrs_inclusion_srcs.append((self._source_file_path(src), obj, 'cxx', unity_obj))
+            objs.append(unity_obj)
 
         self.data['objs'] = objs
         if (config.get_item('cc_config', 'header_inclusion_dependencies') and
@@ -679,6 +789,12 @@ class CcTarget(Target):
         if self._need_dynamic_library():
             self._dynamic_cc_library_ninja()
 
+    def _dwp_ninja(self, linked, output):
+        """Package the split debug info of the linked file, for deploying or stripping. """
+        if split_dwarf_enabled():
+            self.ninja_build('dwp', output, inputs=linked)
+            self._add_target_file('dwp', output)
+
     def _cc_link_ninja(self, output, rule, deps,
                        ldflags=None, extra_ldflags=None,
                        implicit_deps=None, order_only_deps=None):
@@ -688,6 +804,8 @@ class CcTarget(Target):
             vars['ldflags'] = ' '.join(ldflags)
         if extra_ldflags:
             vars['extra_ldflags'] = ' '.join(extra_ldflags)
+        if build_manager.instance.job_controller.is_heavy_link(output):
+            vars['pool'] = job_controller.HEAVY_LINK_POOL
         self.ninja_build(rule, output,
                          inputs=objs + deps,
                          implicit_deps=implicit_deps,
@@ -710,6 +828,7 @@ class CcLibrary(CcTarget):
                  defs,
                  incs,
                  export_incs,
+                 hdrs,
                  optimize,
                  always_optimize,
                  prebuilt,
@@ -720,6 +839,8 @@ class CcLibrary(CcTarget):
                  extra_linkflags,
                  allow_undefined,
                  secure,
+                 unity_build,
+                 pch,
                  blade,
                  kwargs):
         """Init method.
@@ -753,6 +874,9 @@ class CcLibrary(CcTarget):
         self.data['deprecated'] = deprecated
         self.data['allow_undefined'] = allow_undefined
         self.data['secure'] = secure
+        self.data['unity_build'] = unity_build
+        self.data['pch'] = pch
+        self.data['hdrs'] = var_to_list(hdrs)
 
     def _rpath_link(self, dynamic):
         path = self._prebuilt_cc_library_path(dynamic)[1]
@@ -961,10 +1085,11 @@ class CcLibrary(CcTarget):
         for key in ('c_warnings', 'cxx_warnings'):
             if key in vars:
                 del vars[key]
-        for src, obj, rule in hdrs_inclusion_srcs:
+        for src, obj, rule, compiled_obj in hdrs_inclusion_srcs:
             output = '%s.H' % obj
             rule = '%shdrs' % rule
-            self.ninja_build(rule, output, inputs=src, implicit_deps=[obj], variables=vars)
+            self.ninja_build(rule, output, inputs=src, implicit_deps=[compiled_obj],
+                             variables=vars)
 
     def ninja_rules(self):
         """Generate ninja build rules for cc object/library. """
@@ -996,6 +1121,8 @@ def cc_library(name,
                extra_linkflags=[],
                allow_undefined=False,
                secure=False,
+               unity_build=None,
+               pch=None,
                **kwargs):
     """cc_library target. """
     # pylint: disable=too-many-locals
@@ -1007,6 +1134,7 @@ def cc_library(name,
                        defs,
                        incs,
                        export_incs,
+                       hdrs,
                        optimize,
                        always_optimize,
                        prebuilt or pre_build,
@@ -1017,6 +1145,8 @@ def cc_library(name,
                        extra_linkflags,
                        allow_undefined,
                        secure,
+                       unity_build,
+                       pch,
                        build_manager.instance,
                        kwargs)
     if pre_build:
@@ -1075,6 +1205,8 @@ class CcBinary(CcTarget):
                  extra_cppflags,
                  extra_linkflags,
                  export_dynamic,
+                 unity_build,
+                 pch,
                  blade,
                  kwargs):
         """Init method.
@@ -1101,6 +1233,8 @@ class CcBinary(CcTarget):
         self.data['embed_version'] = embed_version
         self.data['dynamic_link'] = dynamic_link
         self.data['export_dynamic'] = export_dynamic
+        self.data['unity_build'] = unity_build
+        self.data['pch'] = pch
 
         # add extra link library
         link_libs = var_to_list(config.get_item('cc_binary_config', 'extra_libs'))
@@ -1153,16 +1287,29 @@ class CcBinary(CcTarget):
                 implicit_deps = link_all_symbols_libs
 
         extra_ldflags, order_only_deps = [], []
+        late_stamping = (self.data['embed_version'] and
+                         config.get_item('cc_binary_config', 'version_stamping') == 'late')
         if self.data['embed_version']:
-            scm = os.path.join(self.build_path, 'scm.cc.o')
+            scm = 'scm_placeholder.cc.o' if late_stamping else 'scm.cc.o'
+            scm = os.path.join(self.build_path, scm)
             extra_ldflags.append(scm)
             order_only_deps.append(scm)
         extra_ldflags += ['-l%s' % lib for lib in sys_libs]
         output = self._target_file_path(self.name)
-        self._cc_link_ninja(output, 'link', deps=usr_libs,
+        # In the late stamping mode, link an unstamped binary and patch the scm info
+        # into a copy of it, see `version_stamping`
+        linked = output + '.unstamped' if late_stamping else output
+        self._cc_link_ninja(linked, 'link', deps=usr_libs,
                             ldflags=ldflags, extra_ldflags=extra_ldflags,
                             implicit_deps=implicit_deps,
                             order_only_deps=order_only_deps)
+        if late_stamping:
+            self.ninja_build('stampversion', output, inputs=linked,
+                             implicit_deps=[os.path.join(self.build_path, 'scm.section')])
+        # Tests are only ran in place where the .dwo files are, and are never deployed,
+        # so packaging them is just a waste of build time
+        if self.type == 'cc_binary':
+            self._dwp_ninja(linked, output + '.dwp')
         self._add_default_target_file('bin', output)
 
     def ninja_rules(self):
@@ -1184,6 +1331,8 @@ def cc_binary(name,
               extra_cppflags=[],
               extra_linkflags=[],
               export_dynamic=False,
+              unity_build=None,
+              pch=None,
               **kwargs):
     """cc_binary target. """
     cc_binary_target = CcBinary(name,
@@ -1198,6 +1347,8 @@ def cc_binary(name,
                                 extra_cppflags,
                                 extra_linkflags,
                                 export_dynamic,
+                                unity_build,
+                                pch,
                                 build_manager.instance,
                                 kwargs)
     build_manager.instance.register_target(cc_binary_target)
@@ -1291,6 +1442,7 @@ class CcPlugin(CcTarget):
                                 implicit_deps=implicit_deps)
             if self.data['strip']:
                 self.ninja_build('strip', output, inputs=link_output)
+                self._dwp_ninja(link_output, output + '.dwp')
             self._add_default_target_file('so', output)
 
 
@@ -1354,6 +1506,8 @@ class CcTest(CcBinary):
                  exclusive,
                  heap_check,
                  heap_check_debug,
+                 unity_build,
+                 pch,
                  blade,
                  kwargs):
         """Init method.
@@ -1379,6 +1533,8 @@ class CcTest(CcBinary):
                           extra_cppflags,
                           extra_linkflags,
                           export_dynamic,
+                          unity_build,
+                          pch,
                           blade,
                           kwargs)
         self.type = 'cc_test'
@@ -1429,6 +1585,8 @@ def cc_test(name,
             exclusive=False,
             heap_check=None,
             heap_check_debug=False,
+            unity_build=None,
+            pch=None,
             **kwargs):
     """cc_test target. """
     # pylint: disable=too-many-locals
@@ -1449,6 +1607,8 @@ def cc_test(name,
                             exclusive,
                             heap_check,
                             heap_check_debug,
+                            unity_build,
+                            pch,
                             build_manager.instance,
                             kwargs)
     build_manager.instance.register_target(cc_test_target)
@@ -234,6 +234,10 @@ class CmdArguments(object):
             '--show-builds-slower-than', dest='show_builds_slower_than', metavar='SECONDS', type=float,
             help='Show build commands which are slower than specified seconds')
 
+        parser.add_argument(
+            '--reproducible', dest='reproducible', action='store_true', default=False,
+            help='Generate reproducible outputs, the default is global_config.reproducible')
+
     def __add_coverage_arguments(self, parser):
         """Add coverage arguments. """
         parser.add_argument(
@@ -310,6 +314,32 @@ class CmdArguments(object):
             '--skip-tests', dest='skip_tests', default='', metavar='TARGET_LIST',
             help='Skip tests which matches this comma seperated target list')
 
+        parser.add_argument(
+            '--max-retries', dest='max_retries', type=int, default=0, metavar='N',
+            help='Retry a failed test at most N times, tests passed after retries are '
+                 'reported as flaky')
+
+        parser.add_argument(
+            '--fail-fast', dest='fail_fast', action='store_true', default=False,
+            help='Stop running tests once a test failed')
+
+        parser.add_argument(
+            '--max-failures', dest='max_failures', type=int, default=0, metavar='N',
+            help='Stop running tests after N tests failed')
+
+        parser.add_argument(
+            '--prioritize', dest='prioritize', action='store_true', default=False,
+            help='Run historically failing tests first, then recently changed tests')
+
+        parser.add_argument(
+            '--affected-by', dest='affected_by', default='', metavar='REVISION',
+            help='Only build and run tests affected by the files changed since the git revision')
+
+        parser.add_argument(
+            '--changed-files', dest='changed_files', default='', metavar='FILE',
+            help='Only build and run tests affected by the changed files listed in FILE, '
+                 'one path relative to the workspace root per line, "-" means stdin')
+
     def _add_run_arguments(self, parser):
         """Add run command arguments. """
         pass
@@ -322,11 +352,24 @@ class CmdArguments(object):
             self.__add_generate_arguments(parser)
             self.__add_coverage_arguments(parser)
 
+    def _add_watch_arguments(self, *parsers):
+        """Add watch mode arguments. """
+        for parser in parsers:
+            parser.add_argument(
+                '--watch', dest='watch', action='store_true', default=False,
+                help='Keep watching the files of the loaded targets, build the affected targets '
+                     'and run the affected tests again when they are changed')
+
     def _add_common_arguments(self, *parsers):
         for parser in parsers:
             parser.add_argument(
                 '--profiling', dest='profiling', action='store_true',
                 help='Blade performance profiling, for blade developing')
+            parser.add_argument(
+                '--server', dest='server', action='store_true',
+                help='Run the command by the resident server of the workspace, '
+                     'which keeps the loaded BUILD files in memory, '
+                     'start it if it is not running')
             parser.add_argument(
                 '--stop-after', dest='stop_after', type=str,
                 choices=['load', 'analyze', 'generate', 'build', 'all'], default='all',
@@ -406,6 +449,7 @@ class CmdArguments(object):
         self._add_common_arguments(build_parser, run_parser, test_parser,
                                    clean_parser, query_parser, dump_parser)
         self._add_build_arguments(build_parser, run_parser, test_parser, dump_parser)
+        self._add_watch_arguments(build_parser, test_parser)
         self._add_run_arguments(run_parser)
         self._add_test_arguments(test_parser)
         self._add_clean_arguments(clean_parser)
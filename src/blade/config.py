@@ -46,11 +46,26 @@ class BladeConfig(object):
                 'duplicated_source_action__doc__': "Can be 'warning', 'error', 'none'",
                 'test_timeout': None,
                 'test_timeout__doc__': 'In seconds',
+                'test_log_tail_lines': 100,
+                'test_log_tail_lines__doc__':
+                    'Number of lines at the end of the log to be shown when a test failed',
                 'test_ignored_envs__doc__':
                     'Ignored environments when run incremental tests, support regex',
                 'test_ignored_envs': [],
+                'testdata_mode': 'link',
+                'testdata_mode__doc__':
+                    "How to place testdata into the runfiles dir, can be 'link', 'hardlink', 'copy'",
                 'backend_builder': 'ninja',
                 'debug_info_level': 'mid',
+                'reproducible': False,
+                'reproducible__doc__':
+                    'Normalize timestamps, ownership and paths in outputs to maximize cache hits',
+                'build_fast_path': True,
+                'build_fast_path__doc__':
+                    'Run ninja with the last build script directly if nothing affects it',
+                'server_idle_timeout': 3 * 3600,
+                'server_idle_timeout__doc__':
+                    'In seconds, the resident server exits after it is idle for so long',
             },
 
             'cc_test_config': {
@@ -61,20 +76,72 @@ class BladeConfig(object):
                 'gtest_libs': [],
                 'gtest_main_libs': [],
                 'pprof_path': '',
+                'lcov_path': 'lcov',
+                'genhtml_path': 'genhtml',
+                'coverage_jobs': 0,
+                'coverage_jobs__doc__':
+                    'Number of gcov data dirs to be captured in parallel, 0 means the number of cpus',
             },
 
             'cc_binary_config': {
                 'extra_libs': [],
                 'run_lib_paths': [],
+                'version_stamping': 'link',
+                'version_stamping__doc__':
+                    "How to embed the scm info, can be 'link' or 'late'. 'late' patches it into "
+                    "linked binaries by objcopy, so a new commit doesn't relink them",
+                'objcopy': 'objcopy',
+            },
+
+            'test_cache_config': {
+                '__doc__': 'Cache of passed test results, which can be shared between workspaces',
+                'backend': '',
+                'backend__doc__': "Empty means disabled, can be 'dir'",
+                'dir': '',
+                'dir__doc__': 'Directory of the cache for the dir backend, can be on a shared file system',
+                'envs': ['PATH', 'LD_LIBRARY_PATH', 'LD_PRELOAD', 'LANG', 'LC_ALL', 'TZ'],
+                'envs__doc__': 'Environments which affect tests, only they are in the cache key',
+            },
+
+            'action_cache_config': {
+                '__doc__': 'Cache of outputs of build actions, which can be shared between workspaces',
+                'enabled': False,
+                'dir': '~/.cache/blade/action_cache',
+                'dir__doc__': 'Directory of the cache, can be on a shared file system such as NFS',
+                'max_size': 10 * 1024 ** 3,
+                'max_size__doc__': 'Max size of the cache in bytes, '
+                                   'least recently used files are evicted after build',
+                'evict_interval': 3600,
+                'evict_interval__doc__': 'Min interval of checking the size of the cache in seconds',
             },
 
             'distcc_config': {
                 'enabled': False
             },
 
+            'build_jobs_config': {
+                '__doc__': 'Adaptive number of parallel build jobs, when -j is not specified',
+                'max_jobs': 0,
+                'max_jobs__doc__': 'Upper bound of the number of jobs, 0 means unlimited',
+                'job_memory': 0,
+                'job_memory__doc__':
+                    'Memory cost of a job in bytes, 0 means learned from past builds',
+                'max_load': None,
+                'max_load__doc__':
+                    "Don't start new jobs if the load average is greater than it, "
+                    "None means the number of cpus, 0 means unlimited",
+            },
+
             'link_config': {
                 'link_on_tmp': False,
+                'link_on_tmp__doc__':
+                    'Write link outputs into link_tmp_dir and then move them into the build dir',
+                'link_tmp_dir': '/dev/shm',
                 'link_jobs': None,
+                'heavy_link_memory': 4 * 1024 ** 3,
+                'heavy_link_memory__doc__':
+                    'Links whose recorded peak memory in bytes is not less than it '
+                    'are put into the heavy link pool',
             },
 
             'java_config': {
@@ -175,6 +242,14 @@ class BladeConfig(object):
                     'mid': ['-g'],
                     'high': ['-g3'],
                 },
+                'split_dwarf': False,
+                'split_dwarf__doc__':
+                    'Put the debug info into .dwo files to reduce the size of objects to be linked',
+                'dwp': 'dwp',
+                'dwp__doc__': 'The dwp tool to package .dwo files of binaries with split debug info',
+                'compress_debug_sections': False,
+                'gdb_index': False,
+                'gdb_index__doc__': 'Generate .gdb_index by the linker, requires gold or lld',
                 'header_inclusion_dependencies': False,
             },
             'cc_library_config': {
@@ -185,6 +260,20 @@ class BladeConfig(object):
                 # in deterministic mode discarding timestamps
                 'arflags': ['rcs'],
                 'ranlibflags': [],
+                'thin_archive': False,
+                'thin_archive__doc__':
+                    'Generate thin archives which only reference the objects rather than copy them',
+                'link_objects': False,
+                'link_objects__doc__':
+                    'Link objects of in-tree libraries into binaries directly rather than archives',
+                'unity_build': False,
+                'unity_build__doc__':
+                    'Compile C++ sources of a target in batches by including them in unity sources',
+                'unity_batch_size': 8,
+                'unity_batch_size__doc__': 'Max number of sources in a unity source',
+                'unity_excludes': [],
+                'unity_excludes__doc__':
+                    'Patterns of source paths which are always compiled separately',
             }
         }
 
@@ -276,13 +365,21 @@ class BladeConfig(object):
 _blade_config = BladeConfig()
 
 
+def config_files(blade_root_dir):
+    """Paths of all config files, in the loading order. """
+    return [os.path.join(os.path.dirname(sys.argv[0]), 'blade.conf'),
+            os.path.expanduser('~/.bladerc'),
+            os.path.join(blade_root_dir, 'BLADE_ROOT'),
+            os.path.join(blade_root_dir, 'BLADE_ROOT.local')]
+
+
 def load_files(blade_root_dir, load_local_config):
     _config_globals['build_target'] = build_attributes.attributes
-    _blade_config.try_parse_file(os.path.join(os.path.dirname(sys.argv[0]), 'blade.conf'))
-    _blade_config.try_parse_file(os.path.expanduser('~/.bladerc'))
-    _blade_config.try_parse_file(os.path.join(blade_root_dir, 'BLADE_ROOT'))
-    if load_local_config:
-        _blade_config.try_parse_file(os.path.join(blade_root_dir, 'BLADE_ROOT.local'))
+    files = config_files(blade_root_dir)
+    if not load_local_config:
+        files = files[:-1]
+    for path in files:
+        _blade_config.try_parse_file(path)
 
 
 def dump(output_file_name):
@@ -338,6 +435,7 @@ def cc_test_config(append=None, **kwargs):
 @config_rule
 def cc_binary_config(append=None, **kwargs):
     """cc_binary_config section. """
+    _check_kwarg_enum_value(kwargs, 'version_stamping', __VERSION_STAMPING_VALUES)
     _blade_config.update_config('cc_binary_config', append, kwargs)
 
 
@@ -348,6 +446,8 @@ def cc_library_config(append=None, **kwargs):
 
 
 __DUPLICATED_SOURCE_ACTION_VALUES = set(['warning', 'error', 'none', None])
+__TESTDATA_MODE_VALUES = set(['link', 'hardlink', 'copy'])
+__VERSION_STAMPING_VALUES = set(['link', 'late'])
 
 
 @config_rule
@@ -356,16 +456,35 @@ def global_config(append=None, **kwargs):
     _check_kwarg_enum_value(kwargs, 'duplicated_source_action', __DUPLICATED_SOURCE_ACTION_VALUES)
     debug_info_levels = _blade_config.get_section('cc_config')['debug_info_levels'].keys()
     _check_kwarg_enum_value(kwargs, 'debug_info_level', debug_info_levels)
+    _check_kwarg_enum_value(kwargs, 'testdata_mode', __TESTDATA_MODE_VALUES)
     _check_test_ignored_envs(kwargs)
     _blade_config.update_config('global_config', append, kwargs)
 
 
+@config_rule
+def test_cache_config(append=None, **kwargs):
+    """test_cache_config section. """
+    _blade_config.update_config('test_cache_config', append, kwargs)
+
+
+@config_rule
+def action_cache_config(append=None, **kwargs):
+    """action_cache_config section. """
+    _blade_config.update_config('action_cache_config', append, kwargs)
+
+
 @config_rule
 def distcc_config(append=None, **kwargs):
     """distcc_config. """
     _blade_config.update_config('distcc_config', append, kwargs)
 
 
+@config_rule
+def build_jobs_config(append=None, **kwargs):
+    """build_jobs_config section. """
+    _blade_config.update_config('build_jobs_config', append, kwargs)
+
+
 @config_rule
 def link_config(append=None, **kwargs):
     """link_config. """
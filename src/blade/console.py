@@ -175,13 +175,24 @@ def _progress_bar(progress, current, total):
                                   current, total, progress)
 
 
-def show_progress_bar(current, total):
+def show_progress_bar(current, total, running=None, elapsed=None):
+    """Show the progress bar, with the number of running jobs and the elapsed seconds if they
+    are specified. Without color, it is only shown when the progress is changed.
+    """
     global _need_clear_line, _last_progress
     progress = current * 100 // total
-    if progress != _last_progress:
+    if progress != _last_progress or (_color_enabled and running is not None):
         bar = _progress_bar(progress, current, total)
-        bar += '\r' if _color_enabled else '\n'
+        if running is not None:
+            bar += ' %d running' % running
+        if elapsed is not None:
+            bar += ' %.1fs' % elapsed
+        if _color_enabled:
+            bar = _CLEAR_LINE + bar + '\r'
+        else:
+            bar += '\n'
         print(bar, end='')
+        sys.stdout.flush()
         _last_progress = progress
         _need_clear_line = True
 
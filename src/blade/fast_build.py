@@ -0,0 +1,162 @@
+# Copyright (c) 2020 Tencent Inc.
+# All rights reserved.
+#
+# Date:   April 22, 2020
+
+
+"""
+ This is the fast build module. After a successful build, its build script
+ is retained with a record of everything which affects it, such as the
+ command line, the config files, the BUILD files and the included files.
+
+ When the next build finds nothing in the record changed, the retained build
+ script is still valid, so ninja is executed with it directly, the probing,
+ loading, analyzing and generating are all skipped. Changes of the source
+ files are handled by ninja as usual.
+
+ The workspace is locked as a normal build, and the lock is inherited by ninja
+ to be held until it exits. Nothing is done after ninja, so such builds don't
+ update the job history, and the record expires when the action cache is due
+ to be evicted, to let the whole pipeline evict it.
+
+ This module is imported before all other modules of blade, so it should
+ import as few modules as possible to make the fast path fast.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import fcntl
+import json
+import os
+import sys
+import time
+
+from blade.blade_util import blade_code_identity, file_stat
+from blade.blade_util import find_file_bottom_up, get_cwd
+
+
+_RECORD_FILE = '.blade_fast_build.json'
+
+# The retained build script in the build dir
+_BUILD_SCRIPT = 'fast_build.ninja'
+
+# Environment variables which affect the generated build script
+BUILD_ENVS = (
+    'PATH', 'CC', 'CXX', 'LD', 'TOOLCHAIN_DIR', 'NVCC', 'JAVA_HOME', 'CUDA_PATH',
+    'DISTCC_HOSTS', 'DISTCC_LOG', 'SOURCE_DATE_EPOCH', 'GO111MODULE', 'go_module_relpath',
+)
+
+_LOCK_FILE = '.Building.lock'
+
+# Options which need the whole pipeline
+_SLOW_OPTIONS = ('--watch', '--profiling', '--stop-after')
+
+
+def _command_state(blade_path, argv, working_dir):
+    return {
+        'argv': argv,
+        'cwd': working_dir,
+        'blade': blade_code_identity(blade_path),
+        'env': [os.environ.get(name) for name in BUILD_ENVS],
+    }
+
+
+def save(blade_path, argv, working_dir, build_dir, files, dirs, ninja_command, expires=None):
+    """Retain the build script of the successful build and record what affects it.
+
+    Args:
+        argv: the command line of blade
+        working_dir: the absolute dir where the command is ran
+        files: files affect the build script, such as the BUILD files
+        dirs: dirs whose new or removed entries affect the build script
+        ninja_command: the ninja command without the build script
+        expires: the time after which the whole pipeline is required, or None
+    """
+    script = os.path.join(build_dir, _BUILD_SCRIPT)
+    record = _command_state(blade_path, argv, working_dir)
+    record['files'] = dict((path, file_stat(path)) for path in files)
+    record['dirs'] = dict((path, file_stat(path)) for path in dirs)
+    record['ninja'] = ninja_command + ['-f', script]
+    record['expires'] = expires
+    os.rename('build.ninja', script)
+    temp_file = _RECORD_FILE + '.tmp'
+    with open(temp_file, 'w') as f:
+        json.dump(record, f)
+    os.rename(temp_file, _RECORD_FILE)
+
+
+def clear():
+    """Remove the record, the next build will go through the whole pipeline. """
+    try:
+        os.remove(_RECORD_FILE)
+    except OSError:
+        pass
+
+
+def _is_fast_command(argv):
+    if not argv or argv[0] != 'build':
+        return False
+    return not any(arg.split('=')[0] in _SLOW_OPTIONS for arg in argv)
+
+
+def _lock_workspace():
+    """Lock the workspace as a normal build, return the fd or None if it is locked.
+
+    Unlike `blade_util.lock_file`, the fd is inheritable, so the lock is held by
+    the executed ninja until it exits.
+    """
+    try:
+        fd = os.open(_LOCK_FILE, os.O_CREAT | os.O_RDWR)
+    except OSError:
+        return None
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except (IOError, OSError):
+        os.close(fd)
+        return None
+    if hasattr(os, 'set_inheritable'):
+        os.set_inheritable(fd, True)
+    return fd
+
+
+def try_exec(blade_path, argv):
+    """Exec ninja with the retained build script if nothing affects it, otherwise return. """
+    if not _is_fast_command(argv):
+        return
+    working_dir = get_cwd()
+    blade_root = find_file_bottom_up('BLADE_ROOT', working_dir)
+    if not blade_root:
+        return
+    blade_root_dir = os.path.dirname(blade_root)
+    try:
+        with open(os.path.join(blade_root_dir, _RECORD_FILE)) as f:
+            record = json.load(f)
+    except (IOError, ValueError):
+        return
+    state = _command_state(blade_path, argv, working_dir)
+    if any(record.get(key) != value for key, value in state.items()):
+        return
+    if record.get('expires') and time.time() >= record['expires']:
+        return
+    os.chdir(blade_root_dir)
+    # A locked workspace is reported by the whole pipeline
+    lock_fd = _lock_workspace()
+    if lock_fd is None:
+        os.chdir(working_dir)
+        return
+    for path, stat in list(record['files'].items()) + list(record['dirs'].items()):
+        if file_stat(path) != stat:
+            os.close(lock_fd)
+            os.chdir(working_dir)
+            return
+    if blade_root_dir != working_dir:
+        print("Blade: Entering directory `%s'" % blade_root_dir)
+    sys.stdout.flush()
+    command = record['ninja']
+    try:
+        os.execvp(command[0], command)
+    except OSError:
+        os.close(lock_fd)
+        os.chdir(working_dir)
@@ -57,9 +57,9 @@ def _manifest_scm(build_dir):
 
 def generate_fat_jar_metadata(jar, dependencies, conflicts):
     metadata_path = 'META-INF/blade'
-    jar.writestr('%s/JAR.LIST' % metadata_path, '\n'.join(dependencies))
+    blade_util.zip_writestr(jar, '%s/JAR.LIST' % metadata_path, '\n'.join(dependencies))
     content = ['[conflict]'] + conflicts
-    jar.writestr('%s/MERGE-INFO' % metadata_path, '\n'.join(content))
+    blade_util.zip_writestr(jar, '%s/MERGE-INFO' % metadata_path, '\n'.join(content))
 
 
 def generate_fat_jar(target, jars):
@@ -79,7 +79,7 @@ def generate_fat_jar(target, jars):
         for name in name_list:
             if name.endswith('/') or not _is_fat_jar_excluded(name):
                 if name not in path_jar_dict:
-                    target_fat_jar.writestr(name, jar.read(name))
+                    blade_util.zip_writestr(target_fat_jar, name, jar.read(name))
                     path_jar_dict[name] = dep_jar
                 else:
                     if name.endswith('/'):
@@ -107,12 +107,16 @@ def generate_fat_jar(target, jars):
     contents = [
         'Manifest-Version: 1.0',
         'Created-By: Python.Zipfile (Blade)',
-        'Built-By: %s' % os.getenv('USER'),
-        'Build-Time: %s' % time.asctime(),
     ]
+    # Don't embed volatile information in reproducible builds
+    if blade_util.source_date_epoch() is None:
+        contents += [
+            'Built-By: %s' % os.getenv('USER'),
+            'Build-Time: %s' % time.asctime(),
+        ]
     contents += _manifest_scm(target.split(os.sep)[0])
     contents.append('\n')
-    target_fat_jar.writestr(_JAR_MANIFEST, '\n'.join(contents))
+    blade_util.zip_writestr(target_fat_jar, _JAR_MANIFEST, '\n'.join(contents))
     target_fat_jar.close()
 
 
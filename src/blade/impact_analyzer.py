@@ -0,0 +1,151 @@
+# Copyright (c) 2020 Tencent Inc.
+# All rights reserved.
+#
+# Date:   March 12, 2020
+
+
+"""
+ This is the impact analyzer module which finds out the targets affected
+ by the changed files, so only the affected tests need to be built and ran.
+
+"""
+
+from __future__ import absolute_import
+
+import os
+import subprocess
+import sys
+
+from blade import console
+from blade.blade_util import to_string
+
+
+def _git(args):
+    """Run git command and return the output lines. """
+    p = subprocess.Popen(['git'] + args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate()
+    if p.returncode != 0:
+        console.error_exit('Failed to get changed files by "git %s": %s' % (
+            ' '.join(args), to_string(stderr).strip()))
+    return to_string(stdout).splitlines()
+
+
+def get_changed_files_since(revision):
+    """Get files changed since the revision, include uncommitted and untracked files.
+
+    The returned paths are relative to the current dir, which is the blade root dir.
+    """
+    files = _git(['diff', '--name-only', '--relative', revision, '--'])
+    files += _git(['ls-files', '--others', '--exclude-standard'])
+    return _normalize_paths(files)
+
+
+def load_changed_files(path):
+    """Load changed files from a file, one path per line, '-' means stdin. """
+    if path == '-':
+        return _normalize_paths(sys.stdin.readlines())
+    try:
+        with open(path) as f:
+            return _normalize_paths(f.readlines())
+    except IOError as e:
+        console.error_exit('Failed to load changed files list: %s' % e)
+    return set()
+
+
+def _normalize_paths(paths):
+    result = set()
+    for path in paths:
+        path = path.strip()
+        if not path or path.startswith('#'):
+            continue
+        if path.startswith('//'):
+            path = path[2:]
+        result.add(os.path.normpath(path))
+    return result
+
+
+def _build_owner_map(targets):
+    """Build the map of source file -> owner targets.
+
+    Unlike the source map in the target module, which only keeps one owner for
+    duplication checking, all owners of a source file are kept here.
+    """
+    owners = {}
+    for key, target in targets.items():
+        for src in target.srcs:
+            path = os.path.normpath(os.path.join(target.path, src))
+            owners.setdefault(path, set()).add(key)
+    return owners
+
+
+def _testdata_sources(target):
+    """Return the normalized source paths of the testdata of the target. """
+    for td in target.data.get('testdata', []):
+        src = td[0] if isinstance(td, tuple) else td
+        if not isinstance(src, str) or '..' in src:
+            continue
+        if src.startswith('//'):
+            yield os.path.normpath(src[2:])
+        else:
+            yield os.path.normpath(os.path.join(target.path, src))
+
+
+def _find_dir_owners(path, dir_targets):
+    """Targets in the nearest dir which has a BUILD file are treated as the owners. """
+    dirname = os.path.dirname(path)
+    while True:
+        targets = dir_targets.get(os.path.normpath(dirname))
+        if targets:
+            return targets
+        if not dirname:
+            return set()
+        dirname = os.path.dirname(dirname)
+
+
+def _is_under(path, dirname):
+    return path == dirname or path.startswith(dirname + os.path.sep)
+
+
+def find_owner_targets(changed_files, targets):
+    """Map changed files to the targets own them directly.
+
+    A file belongs to the targets who have it in their srcs or testdata. Other files,
+    such as headers and BUILD files, belong to all targets in the nearest BUILD dir.
+    """
+    owners = _build_owner_map(targets)
+    dir_targets = {}
+    testdata = []
+    for key, target in targets.items():
+        dir_targets.setdefault(os.path.normpath(target.path), set()).add(key)
+        for src in _testdata_sources(target):
+            testdata.append((src, key))
+
+    result = set()
+    for path in changed_files:
+        found = owners.get(path, set())
+        found = found.union(key for src, key in testdata if _is_under(path, src))
+        if not found:
+            found = _find_dir_owners(path, dir_targets)
+        if found:
+            console.debug('%s is owned by %s' % (path, ', '.join(
+                '%s:%s' % key for key in sorted(found))))
+        result |= found
+    return result
+
+
+def analyze_affected_targets(changed_files, targets, depended_targets):
+    """Return all targets affected by the changed files.
+
+    Which are the owners of the changed files and all targets depend on them
+    directly or indirectly.
+
+    Input:
+        changed_files: paths relative to the blade root dir
+        targets: the analyzed targets, {key: target}
+        depended_targets: the transposed dependency graph, {key: [all dependents]}
+    """
+    affected = set()
+    for key in find_owner_targets(changed_files, targets):
+        affected.add(key)
+        affected.update(depended_targets.get(key, []))
+    return affected
@@ -709,13 +709,16 @@ class JavaTest(JavaBinary):
     """JavaTest"""
 
     def __init__(self, name, srcs, deps, resources, source_encoding,
-                 warnings, main_class, exclusions, testdata, target_under_test, kwargs):
+                 warnings, main_class, exclusions, testdata, target_under_test, shards, kwargs):
         JavaBinary.__init__(self, name, srcs, deps, resources,
                             source_encoding, warnings, main_class, exclusions, kwargs)
         if target_under_test:
             self.warning('"target_under_test" is deprecated, you can remove it safely')
         self.type = 'java_test'
         self.data['testdata'] = var_to_list(testdata)
+        if not isinstance(shards, int) or shards < 0:
+            self.error_exit('"shards" must be a non-negative integer')
+        self.data['shards'] = shards
 
     def ninja_java_test_vars(self):
         vars = {
@@ -732,7 +735,8 @@ class JavaTest(JavaBinary):
         jar = self.ninja_generate_jar()
         output = self._target_file_path(self.name)
         dep_jars, maven_jars = self._get_test_deps()
-        self.ninja_build('javatest', output, inputs=[jar] + dep_jars + maven_jars, variables=vars)
+        self.ninja_build('javatest', output, inputs=[jar] + dep_jars + maven_jars,
+                         implicit_outputs=output + '.test_classes', variables=vars)
 
 
 def maven_jar(name, id, classifier='', transitive=True):
@@ -805,8 +809,14 @@ def java_test(name,
               exclusions=[],
               testdata=[],
               target_under_test=None,
+              shards=0,
               **kwargs):
-    """Build a java test target"""
+    """Build a java test target
+
+    Args:
+        shards: int, split test classes into so many shards, which are run
+            in parallel by different JVMs.
+    """
     target = JavaTest(name=name,
                       srcs=srcs,
                       deps=deps,
@@ -817,6 +827,7 @@ def java_test(name,
                       exclusions=exclusions,
                       testdata=testdata,
                       target_under_test=target_under_test,
+                      shards=shards,
                       kwargs=kwargs)
     build_manager.instance.register_target(target)
 
@@ -0,0 +1,396 @@
+# Copyright (c) 2020 Tencent Inc.
+# All rights reserved.
+#
+# Date:   April 10, 2020
+
+
+"""
+ This is the job controller module which sizes the parallel building jobs
+ by the available cpus, the free memory and the current load of the machine.
+
+ The memory cost of a job is learned from the peak memory of the compile
+ actions in past builds, and the number of jobs is also throttled by ninja
+ dynamically when the load average of the machine grows too high. The load
+ average left by the last build is not counted as the load of others.
+
+ Linking costs much more memory than compiling, the link actions are wrapped
+ by this module to record their peak memory, which is used to size the link
+ pools in the following builds. Links cost too much memory are put into a
+ separate heavy link pool.
+
+ The wrapper can also write the link output into a fast temporary dir, such
+ as a tmpfs, and move it into the build dir after the link succeeded.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import argparse
+import errno
+import hashlib
+import json
+import math
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from blade import console
+from blade.blade_util import cpu_count
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Memory cost of a job when there is no history yet
+_DEFAULT_JOB_MEMORY = 512 * 1024 ** 2
+
+# Let the learned memory cost of a job fall slowly when actions become smaller
+_JOB_MEMORY_DECAY = 0.95
+
+# Extra jobs per machine to overlap the io of actions, same as ninja
+_EXTRA_JOBS = 2
+
+# Time constant in seconds of the exponential decay of the 1 minute load average
+_LOAD_AVERAGE_PERIOD = 60.0
+
+_HISTORY_FILE = '.blade_jobs.json'
+
+# Dir of link memory records, one file per link output
+_LINK_MEMORY_DIR = '.blade_link_memory'
+
+LINK_POOL = 'link_pool'
+HEAVY_LINK_POOL = 'heavy_link_pool'
+
+# Free space to be kept in the temporary dir when linking on it
+_LINK_TMP_RESERVED_SPACE = 64 * 1024 ** 2
+
+
+def available_cpus():
+    """Number of cpus this process can run on. """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return cpu_count()
+
+
+def available_memory():
+    """Available memory in bytes, or None if it is unknown. """
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except (IOError, ValueError):
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def load_average():
+    """Load average of the last minute. """
+    try:
+        return os.getloadavg()[0]
+    except (AttributeError, OSError):
+        return 0.0
+
+
+def children_peak_memory():
+    """Peak memory in bytes of the largest finished child process, or None. """
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+
+def link_memory_dir(build_dir):
+    return os.path.join(build_dir, _LINK_MEMORY_DIR)
+
+
+def _link_memory_record(record_dir, output):
+    return os.path.join(record_dir, hashlib.md5(output.encode('utf-8')).hexdigest())
+
+
+def _run_command(command, capture_output=False):
+    """Run the command arguments, return (returncode, output, peak memory). """
+    stdout = subprocess.PIPE if capture_output else None
+    try:
+        p = subprocess.Popen(command, stdout=stdout, stderr=subprocess.STDOUT)
+    except OSError as e:
+        print('blade: Failed to run %s: %s' % (command[0], e), file=sys.stderr)
+        return 127, b'', 0
+    output = p.stdout.read() if capture_output else b''
+    pid, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else 1
+    # The maxrss of the waited child includes its descendants, such as the real linker
+    peak = rusage.ru_maxrss if sys.platform == 'darwin' else rusage.ru_maxrss * 1024
+    return p.returncode, output, peak
+
+
+def _free_space(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+def _estimate_link_size(output, command):
+    """Estimate the size of the link output by the last output or the input files. """
+    if os.path.exists(output):
+        return os.path.getsize(output) * 3 // 2
+    size = 0
+    for token in command:
+        if token.endswith(('.o', '.a', '.so')) and os.path.isfile(token):
+            size += os.path.getsize(token)
+    return size
+
+
+def _move_file(src, dst):
+    """Move the file into the dst atomically, even across file systems. """
+    try:
+        os.rename(src, dst)
+        return
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+    temp_dst = dst + '.tmp'
+    shutil.copy2(src, temp_dst)
+    os.rename(temp_dst, dst)
+
+
+def _write_output(output):
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    out.write(output)
+    out.flush()
+
+
+def _run_link_on_tmp(tmp_dir, output, command):
+    """Link into the tmp dir and move the output into the build dir.
+
+    Return (returncode, peak memory), or None if the link should be done directly,
+    because the tmp dir doesn't have enough space.
+    """
+    try:
+        if _free_space(tmp_dir) < (_estimate_link_size(output, command) +
+                                   _LINK_TMP_RESERVED_SPACE):
+            return None
+        link_dir = tempfile.mkdtemp(prefix='blade_link_', dir=tmp_dir)
+    except (IOError, OSError):
+        return None
+    try:
+        tmp_output = os.path.join(link_dir, os.path.basename(output))
+        tmp_command = list(command)
+        for i in range(len(command) - 1):
+            if command[i] == '-o' and command[i + 1] == output:
+                tmp_command[i + 1] = tmp_output
+                break
+        returncode, stdout, peak = _run_command(tmp_command, capture_output=True)
+        if returncode != 0:
+            if _free_space(tmp_dir) < _LINK_TMP_RESERVED_SPACE:
+                return None  # Maybe failed for the tmp dir is full
+            _write_output(stdout)
+            return returncode, peak
+        _write_output(stdout)
+        _move_file(tmp_output, output)
+        return 0, peak
+    finally:
+        shutil.rmtree(link_dir, ignore_errors=True)
+
+
+def run_link(record_dir, output, command, tmp_dir=None):
+    """Run the link command and record its peak memory.
+
+    If the tmp_dir is specified, link on it if it has enough space.
+    """
+    result = None
+    if tmp_dir:
+        result = _run_link_on_tmp(tmp_dir, output, command)
+    if result is None:
+        returncode, stdout, peak = _run_command(command)
+    else:
+        returncode, peak = result
+    if returncode != 0:
+        return returncode
+    try:
+        if not os.path.isdir(record_dir):
+            os.makedirs(record_dir)
+        with open(_link_memory_record(record_dir, output), 'w') as f:
+            json.dump([output, peak], f)
+    except (IOError, OSError) as e:
+        print('blade: Failed to record the link memory: %s' % e, file=sys.stderr)
+    return 0
+
+
+class JobController(object):
+    """Calculate the number of parallel jobs and learn the memory cost of jobs.
+
+    The history is saved in a json file in the build dir.
+    """
+
+    def __init__(self, build_dir, max_jobs, job_memory, max_load):
+        self._history_path = os.path.join(build_dir, _HISTORY_FILE)
+        self._link_memory_dir = link_memory_dir(build_dir)
+        self._max_jobs = max_jobs
+        self._job_memory = job_memory
+        self._max_load = max_load
+        self._history = {}
+        try:
+            with open(self._history_path) as f:
+                self._history = json.load(f)
+        except (IOError, ValueError):
+            pass
+        self._history.setdefault('link_memory', {})
+        self._load_link_memory()
+        self._heavy_links = set()
+
+    def job_memory(self):
+        """Memory cost of a job, configured or learned. """
+        if self._job_memory:
+            return self._job_memory
+        return self._history.get('job_memory', _DEFAULT_JOB_MEMORY)
+
+    def _external_load(self, load):
+        """The load average from other processes.
+
+        The jobs of the last build raised the load average while it was running,
+        and still remain in it for a while after it finished, as the load average
+        decays exponentially, so they should not be counted.
+        """
+        last_build = self._history.get('last_build')
+        if not last_build:
+            return load
+        start_time, end_time, jobs_num = last_build
+        duration = max(end_time - start_time, 0)
+        elapsed = max(time.time() - end_time, 0)
+        remained = (jobs_num * (1 - math.exp(-duration / _LOAD_AVERAGE_PERIOD)) *
+                    math.exp(-elapsed / _LOAD_AVERAGE_PERIOD))
+        return max(load - remained, 0.0)
+
+    def jobs_num(self):
+        """Number of jobs can be ran without overloading the machine. """
+        cpus = available_cpus()
+        load = self._external_load(load_average())
+        # The load from other processes occupies the cpus
+        jobs_num = max(cpus + _EXTRA_JOBS - int(load), 1)
+        reason = '%d cpus, external load %.1f' % (cpus, load)
+        memory = available_memory()
+        if memory is not None:
+            job_memory = self.job_memory()
+            memory_jobs_num = max(int(memory // job_memory), 1)
+            reason += ', %dMB free memory, %dMB per job' % (memory // 1024 ** 2,
+                                                          job_memory // 1024 ** 2)
+            jobs_num = min(jobs_num, memory_jobs_num)
+        if self._max_jobs:
+            jobs_num = min(jobs_num, self._max_jobs)
+        console.debug('Parallel jobs: %d (%s)' % (jobs_num, reason))
+        return jobs_num
+
+    def load_limit(self):
+        """Max load average for starting new jobs, 0 means unlimited. """
+        if self._max_load is None:
+            return available_cpus()
+        return self._max_load
+
+    def _load_link_memory(self):
+        """Merge the link memory records of finished links into the history.
+
+        Return the names of the records and the max peak memory in them.
+        """
+        records = []
+        try:
+            records = os.listdir(self._link_memory_dir)
+        except OSError:
+            pass
+        max_peak = 0
+        for name in records:
+            path = os.path.join(self._link_memory_dir, name)
+            try:
+                with open(path) as f:
+                    output, peak = json.load(f)
+                self._history['link_memory'][output] = peak
+                max_peak = max(max_peak, peak)
+            except (IOError, ValueError):
+                pass
+        return records, max_peak
+
+    def link_pool_depths(self, jobs_num, link_jobs, heavy_link_memory):
+        """Return depths of the link pool and the heavy link pool, None means no pool.
+
+        Without enough history, only the configured `link_jobs` is applied.
+        When there are heavy links, each pool can use half of the free memory.
+        A pool is not needed if it doesn't limit the jobs.
+        """
+        link_memory = self._history['link_memory']
+        heavy = [m for m in link_memory.values() if m >= heavy_link_memory]
+        light = [m for m in link_memory.values() if m < heavy_link_memory]
+        memory = available_memory()
+        link_depth = min(link_jobs, jobs_num) if link_jobs else None
+        heavy_depth = None
+        if memory is not None and link_memory:
+            if heavy:
+                memory //= 2
+                depth = max(int(memory // max(heavy)), 1)
+                if depth < jobs_num:
+                    heavy_depth = depth
+                    self._heavy_links = set(output for output, m in link_memory.items()
+                                            if m >= heavy_link_memory)
+            if light:
+                depth = max(int(memory // max(light)), 1)
+                if depth < (link_depth or jobs_num):
+                    link_depth = depth
+        return link_depth, heavy_depth
+
+    def is_heavy_link(self, output):
+        return output in self._heavy_links
+
+    def update_history(self, start_time, jobs_num):
+        """Learn the memory cost of jobs and record the load of the finished build.
+
+        The peak memory of all children is usually from a link, which is recorded
+        and learned separately for the link pools, so it is learned as the memory
+        cost of general jobs only if it is larger than the peak memory of links.
+        """
+        records, link_peak = self._load_link_memory()
+        peak = children_peak_memory()
+        if peak and peak > link_peak:
+            job_memory = max(peak, int(self._history.get('job_memory', 0) * _JOB_MEMORY_DECAY))
+            self._history['job_memory'] = job_memory
+        self._history['last_build'] = [start_time, time.time(), jobs_num]
+        try:
+            with open(self._history_path, 'w') as f:
+                json.dump(self._history, f)
+        except IOError as e:
+            console.debug('Failed to save the job history: %s' % e)
+            return
+        for name in records:
+            try:
+                os.remove(os.path.join(self._link_memory_dir, name))
+            except OSError:
+                pass
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='blade.job_controller')
+    parser.add_argument('--record-dir', required=True)
+    parser.add_argument('--output', required=True)
+    parser.add_argument('--tmp-dir')
+    # The link command follows `--` as arguments, which are already parsed by the shell
+    # of ninja, so they are ran directly and never quoted or parsed again
+    args = sys.argv[1:]
+    if '--' not in args:
+        parser.error('the link command after -- is required')
+    separator = args.index('--')
+    options = parser.parse_args(args[:separator])
+    command = args[separator + 1:]
+    sys.exit(run_link(options.record_dir, options.output, command, options.tmp_dir))
+
+
+if __name__ == '__main__':
+    main()
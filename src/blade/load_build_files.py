@@ -119,6 +119,22 @@ def glob(include, exclude=None, excludes=None, allow_empty=False):
         else:
             non_special_excludes.add(pattern)
 
+    def walked_dirs(pattern):
+        """Dirs whose new or removed entries may change the result of the pattern. """
+        parts = pattern.split('/')
+        if parts[-1] != '**':
+            parts.pop()  # The file name part
+        base = str(source_dir)
+        for part in parts:
+            if is_special(part):
+                dirs = set([os.path.normpath(base)])  # Recorded even if it doesn't exist
+                for root, subdirs, _ in os.walk(base):
+                    subdirs[:] = [d for d in subdirs if not _is_load_excluded(d)]
+                    dirs.add(os.path.normpath(root))
+                return dirs
+            base = os.path.join(base, part)
+        return [os.path.normpath(base)]
+
     def exclusion(path):
         if str(path) in non_special_excludes:
             return True
@@ -129,6 +145,10 @@ def glob(include, exclude=None, excludes=None, allow_empty=False):
         return False
 
     result = sorted(set([str(p) for p in includes_iterator() if not exclusion(p)]))
+    globbed_dirs = _globbed_dirs.setdefault(str(source_dir), set())
+    for pattern in include:
+        globbed_dirs.update(walked_dirs(pattern))
+    _scanned_dirs.update(globbed_dirs)
     if not result and not allow_empty:
         args = repr(include)
         if exclude:
@@ -142,6 +162,30 @@ def glob(include, exclude=None, excludes=None, allow_empty=False):
 # Each include in a BUILD file can only affect itself
 __current_globles = None
 
+# Files included by BUILD files
+_included_files = set()
+
+# Dirs whose entries affect the loaded targets, by the `...` target patterns or globs
+_scanned_dirs = set()
+
+# Dirs walked by the globs of each source dir
+_globbed_dirs = {}
+
+
+def get_included_files():
+    """Return files included by the loaded BUILD files. """
+    return _included_files
+
+
+def get_scanned_dirs():
+    """Return dirs whose new or removed entries may change the loaded targets. """
+    return _scanned_dirs
+
+
+def get_globbed_dirs():
+    """Return {source dir: dirs walked by the globs in its BUILD file}. """
+    return _globbed_dirs
+
 
 # Include a defination file in a BUILD file
 def include(name):
@@ -151,7 +195,9 @@ def include(name):
         name = name[2:]
     else:
         dir = build_manager.instance.get_current_source_path()
-    exec_(os.path.join(dir, name), __current_globles, None)
+    path = os.path.join(dir, name)
+    _included_files.add(path)
+    exec_(path, __current_globles, None)
 
 
 build_rules.register_function(enable_if)
@@ -249,8 +295,9 @@ def load_targets(target_ids, blade_root_dir, blade):
     related_targets = {}
     # source dirs mentioned in command line
     source_dirs = []
-    # to prevent duplicated loading of BUILD files
-    processed_source_dirs = set()
+    # to prevent duplicated loading of BUILD files, they may be loaded before
+    # if the blade manager is reused
+    processed_source_dirs = blade.get_loaded_source_dirs()
 
     direct_targets = []
     all_command_targets = []
@@ -268,6 +315,7 @@ def load_targets(target_ids, blade_root_dir, blade):
                 # elements in dirs (and not the list referred to by dirs) so
                 # that os.walk() will not process deleted directories.
                 dirs[:] = [d for d in dirs if not _is_load_excluded(d)]
+                _scanned_dirs.add(os.path.normpath(root))
                 if 'BUILD' in files:
                     source_dirs.append(root)
         else:
@@ -283,8 +331,10 @@ def load_targets(target_ids, blade_root_dir, blade):
                          processed_source_dirs,
                          blade)
 
+    loaded_source_dirs = set(os.path.normpath(d) for d in source_dirs)
     for key in target_database:
-        cited_targets.add(key)
+        if key[0] in loaded_source_dirs:
+            cited_targets.add(key)
     all_command_targets = list(cited_targets)
 
     # Starting from targets specified in command line, breath-first
@@ -23,7 +23,8 @@ import time
 from blade import blade_util
 from blade import config
 from blade import console
-from blade.blade_platform import CcFlagsManager
+from blade import job_controller
+from blade.blade_platform import CcFlagsManager, split_dwarf_enabled
 
 
 def _incs_list_to_string(incs):
@@ -84,6 +85,14 @@ class NinjaScriptHeaderGenerator(ScriptHeaderGenerator):
         self.blade = blade
         self.blade_path = blade_path
         self.__all_rule_names = set()
+        self.source_date_epoch = None
+        if config.get_item('global_config', 'reproducible'):
+            self.source_date_epoch = int(os.environ.get('SOURCE_DATE_EPOCH',
+                                                        blade_util.ZIP_MIN_EPOCH))
+        self.action_cache_dir = None
+        if config.get_item('action_cache_config', 'enabled'):
+            self.action_cache_dir = os.path.abspath(os.path.expanduser(
+                config.get_item('action_cache_config', 'dir')))
 
     def get_all_rule_names(self):
         return list(self.__all_rule_names)
@@ -157,28 +166,68 @@ class NinjaScriptHeaderGenerator(ScriptHeaderGenerator):
         cppflags, ldflags = self.ccflags_manager.get_flags_except_warning()
         cppflags = cc_config['cppflags'] + cppflags
         arflags = ''.join(cc_library_config['arflags'])
+        if cc_library_config['thin_archive'] and 'T' not in arflags:
+            arflags += 'T'  # Only reference the objects rather than copy them
+        if self.source_date_epoch is not None and 'D' not in arflags:
+            arflags += 'D'  # Use zero for timestamps and uids/gids
         ldflags = cc_config['linkflags'] + ldflags
         includes = cc_config['extra_incs']
         includes = includes + ['.', self.build_dir]
         includes = ' '.join(['-I%s' % inc for inc in includes])
 
+        compile_prefix, compile_flags = '', ''
+        if self.source_date_epoch is not None:
+            # Make __DATE__, __TIME__ and names generated by the compiler deterministic
+            compile_prefix = 'SOURCE_DATE_EPOCH=%d ' % self.source_date_epoch
+            compile_flags = '-frandom-seed=${out} '
+
+        # The .dwo file is an implicit output of the compiling, in the `dwo` variable
+        compile_outputs = '${out} ${dwo}' if split_dwarf_enabled() else '${out}'
+
         self.generate_cc_warning_vars()
         self.generate_rule(name='cc',
-                           command='%s -o ${out} -MMD -MF ${out}.d '
-                                   '-c -fPIC %s %s ${c_warnings} ${cppflags} '
-                                   '%s ${includes} ${in}' % (
-                                       cc, ' '.join(cflags), ' '.join(cppflags), includes),
                            description='CC ${in}',
                            depfile='${out}.d',
-                           deps='gcc')
+                           deps='gcc',
+                           **self._cached_command_args(
+                               '%s%s -o ${out} -MMD -MF ${out}.d '
+                               '-c -fPIC %s%s %s ${c_warnings} ${cppflags} '
+                               '%s ${includes} ${in}' % (
+                                   compile_prefix, cc, compile_flags,
+                                   ' '.join(cflags), ' '.join(cppflags), includes),
+                               depfile='${out}.d', outputs=compile_outputs))
         self.generate_rule(name='cxx',
-                           command='%s -o ${out} -MMD -MF ${out}.d '
-                                   '-c -fPIC %s %s ${cxx_warnings} ${cppflags} '
-                                   '%s ${includes} ${in}' % (
-                                       cxx, ' '.join(cxxflags), ' '.join(cppflags), includes),
                            description='CXX ${in}',
                            depfile='${out}.d',
-                           deps='gcc')
+                           deps='gcc',
+                           **self._cached_command_args(
+                               '%s%s -o ${out} -MMD -MF ${out}.d '
+                               '-c -fPIC %s%s %s ${cxx_warnings} ${cppflags} '
+                               '%s ${includes} ${in}' % (
+                                   compile_prefix, cxx, compile_flags,
+                                   ' '.join(cxxflags), ' '.join(cppflags), includes),
+                               depfile='${out}.d', outputs=compile_outputs))
+        self._generate_unity_rules(compile_prefix + cxx, ld,
+                                   '-c -fPIC %s%s %s ${cxx_warnings} ${cppflags} '
+                                   '%s ${includes}' % (
+                                       compile_flags, ' '.join(cxxflags), ' '.join(cppflags),
+                                       includes),
+                                   compile_outputs)
+        self.generate_rule(name='cxxpch',
+                           description='CXX PCH ${header}',
+                           depfile='${out}.d',
+                           deps='gcc',
+                           **self._cached_command_args(
+                               '%s%s -x c++-header -o ${out} -MMD -MF ${out}.d '
+                               '-c -fPIC %s%s %s ${cxx_warnings} ${cppflags} '
+                               '%s ${includes} ${in}' % (
+                                   compile_prefix, cxx, compile_flags,
+                                   ' '.join(cxxflags), ' '.join(cppflags), includes),
+                               depfile='${out}.d'))
+        self.generate_rule(name='pchstub',
+                           command=self._toolchain_command('unity', suffix='${out} ${header}'),
+                           description='PCH STUB ${out}',
+                           restat=True)
         if config.get_item('cc_config', 'header_inclusion_dependencies'):
             preprocess = '%s -o /dev/null -E -H %s %s -w ${cppflags} %s ${includes} ${in} 2>${out}'
             self.generate_rule(name='cchdrs',
@@ -202,31 +251,100 @@ class NinjaScriptHeaderGenerator(ScriptHeaderGenerator):
                            restat=True)
 
         self.generate_rule(name='ar',
-                           command='rm -f $out; ar %s $out $in' % arflags,
-                           description='AR ${out}')
-        link_jobs = config.get_item('link_config', 'link_jobs')
-        if link_jobs:
-            link_jobs = min(link_jobs, self.blade.parallel_jobs_num())
-            console.info('tunes the parallel link jobs to be %s' % link_jobs)
-            pool = 'link_pool'
-            self._add_rule(textwrap.dedent('''\
-                    pool %s
-                      depth = %s''') % (pool, link_jobs))
-        else:
-            pool = None
+                           description='AR ${out}',
+                           **self._cached_command_args('rm -f $out; ar %s $out $in' % arflags))
+        pool = self._generate_link_pools()
         self.generate_rule(name='link',
-                           command='%s -o ${out} %s ${ldflags} ${in} ${extra_ldflags}' % (
-                               ld, ' '.join(ldflags)),
                            description='LINK ${out}',
-                           pool=pool)
+                           pool=pool,
+                           **self._cached_command_args(self._link_memory_command(
+                               '%s -o ${out} %s ${ldflags} ${in} ${extra_ldflags}' % (
+                                   ld, ' '.join(ldflags)))))
         self.generate_rule(name='solink',
-                           command='%s -o ${out} -shared %s ${ldflags} ${in} ${extra_ldflags}' % (
-                               ld, ' '.join(ldflags)),
                            description='SHAREDLINK ${out}',
-                           pool=pool)
+                           pool=pool,
+                           **self._cached_command_args(self._link_memory_command(
+                               '%s -o ${out} -shared %s ${ldflags} ${in} ${extra_ldflags}' % (
+                                   ld, ' '.join(ldflags)))))
         self.generate_rule(name='strip',
                            command='strip --strip-unneeded -o ${out} ${in}',
                            description='STRIP ${out}')
+        if split_dwarf_enabled():
+            self.generate_rule(name='dwp',
+                               command='%s -e ${in} -o ${out}' % cc_config['dwp'],
+                               description='DWP ${out}')
+
+    def _generate_unity_rules(self, compiler, linker, compile_flags, compile_outputs):
+        """Generate rules for unity builds, see `cc_library_config.unity_build`.
+
+        The `unity_srcs` variable of the build is the sources included by the unity
+        source. If the unity source failed to compile, sources are compiled one by one
+        and the objects are combined by a relocatable link of the configured linker,
+        so the outputs are still the same.
+        """
+        self.generate_rule(name='unity',
+                           command=self._toolchain_command('unity', suffix='${out} ${unity_srcs}'),
+                           description='UNITY ${out}',
+                           restat=True)
+
+        def compile_command(output, source):
+            # The flags may contain any character, never use them as a format string
+            return ' '.join([compiler, '-o', output, '-MMD -MF', output + '.d', '-MT ${out}',
+                             compile_flags, source])
+
+        unity_command = compile_command('${out}', '${in}')
+        fallback_command = compile_command('${out}.$$i.o', '$$src')
+        command = ('%s || { echo "Unity build of ${in} failed, compile sources separately" >&2; '
+                   'i=0; objs=; for src in ${unity_srcs}; do i=$$((i+1)); '
+                   '%s || exit 1; objs="$$objs ${out}.$$i.o"; done; '
+                   '%s -r -nostdlib -o ${out} $$objs && cat ${out}.*.d > ${out}.d && '
+                   'rm -f $$objs ${out}.*.d && '
+                   'for dwo in ${dwo}; do test -e $$dwo || touch $$dwo; done; }') % (
+                       unity_command, fallback_command, linker)
+        self.generate_rule(name='cxxunity',
+                           description='CXX UNITY ${in}',
+                           depfile='${out}.d',
+                           deps='gcc',
+                           **self._cached_command_args(command, depfile='${out}.d',
+                                                       outputs=compile_outputs))
+
+    def _generate_link_pools(self):
+        """Generate link pools sized by the configuration and the recorded link memory.
+
+        Return the default pool of link rules.
+        """
+        link_config = config.get_section('link_config')
+        link_jobs, heavy_link_jobs = self.blade.job_controller.link_pool_depths(
+                self.blade.parallel_jobs_num(), link_config['link_jobs'],
+                link_config['heavy_link_memory'])
+        pool = None
+        if link_jobs:
+            console.info('tunes the parallel link jobs to be %s' % link_jobs)
+            pool = job_controller.LINK_POOL
+            self._add_rule(textwrap.dedent('''\
+                    pool %s
+                      depth = %s''') % (pool, link_jobs))
+        if heavy_link_jobs:
+            console.info('tunes the parallel heavy link jobs to be %s' % heavy_link_jobs)
+            self._add_rule(textwrap.dedent('''\
+                    pool %s
+                      depth = %s''') % (job_controller.HEAVY_LINK_POOL, heavy_link_jobs))
+        return pool
+
+    def _link_memory_command(self, command):
+        """Wrap the link command to record its peak memory and link on tmp.
+
+        The link command is appended after `--` as it is, so its arguments are parsed
+        only once by the shell, and the wrapper runs them directly.
+        """
+        cmd = ['PYTHONPATH=%s:$$PYTHONPATH' % self.blade_path,
+               '%s -m blade.job_controller' % sys.executable,
+               '--record-dir=%s' % job_controller.link_memory_dir(self.build_dir),
+               '--output=${out}']
+        if config.get_item('link_config', 'link_on_tmp'):
+            cmd.append('--tmp-dir=%s' % config.get_item('link_config', 'link_tmp_dir'))
+        cmd += ['--', command]
+        return ' '.join(cmd)
 
     def generate_proto_rules(self):
         proto_config = config.get_section('proto_library_config')
@@ -334,11 +452,12 @@ class NinjaScriptHeaderGenerator(ScriptHeaderGenerator):
                 javacflags =
                 '''))
         self.generate_rule(name='javac',
-                           command='rm -fr ${classes_dir} && mkdir -p ${classes_dir} && '
-                                   '%s && sleep 0.5 && '
-                                   '%s cf ${out} -C ${classes_dir} .' % (
-                                       ' '.join(cmd), jar),
-                           description='JAVAC ${in}')
+                           description='JAVAC ${in}',
+                           **self._cached_command_args(
+                               'rm -fr ${classes_dir} && mkdir -p ${classes_dir} && '
+                               '%s && sleep 0.5 && '
+                               '%s cf ${out} -C ${classes_dir} .%s' % (
+                                   ' '.join(cmd), jar, self._normalize_zip_command())))
 
     def generate_java_resource_rules(self):
         self.generate_rule(name='javaresource',
@@ -405,12 +524,13 @@ class NinjaScriptHeaderGenerator(ScriptHeaderGenerator):
         jar = self.get_java_command(java_config, 'jar')
         args = '%s ${out} ${in}' % jar
         self.generate_rule(name='javajar',
-                           command=self._toolchain_command('java_jar', suffix=args),
-                           description='JAVA JAR ${out}')
+                           description='JAVA JAR ${out}',
+                           **self._cached_command_args(
+                               self._toolchain_command('java_jar', suffix=args)))
         self.generate_java_test_rules()
         self.generate_rule(name='fatjar',
-                           command=self._toolchain_command('java_fatjar'),
-                           description='FAT JAR ${out}')
+                           description='FAT JAR ${out}',
+                           **self._cached_command_args(self._toolchain_command('java_fatjar')))
         self.generate_java_binary_rules()
         self.generate_scalac_rule(java_config)
         self.generate_scalatest_rule(java_config)
@@ -481,7 +601,7 @@ class NinjaScriptHeaderGenerator(ScriptHeaderGenerator):
         self.generate_rule(name='shelltest',
                            command=self._toolchain_command('shell_test'),
                            description='SHELL TEST ${out}')
-        args = '${out} ${in} ${testdata}'
+        args = '${testdata_modes} ${out} ${in} ${testdata}'
         self.generate_rule(name='shelltestdata',
                            command=self._toolchain_command('shell_testdata', suffix=args),
                            description='SHELL TEST DATA ${out}')
@@ -499,16 +619,24 @@ class NinjaScriptHeaderGenerator(ScriptHeaderGenerator):
         self.generate_rule(name='package',
                            command=self._toolchain_command('package', suffix=args),
                            description='PACKAGE ${out}')
+        tarflags = ''
+        if self.source_date_epoch is not None:
+            tarflags = '--mtime=@%d --owner=0 --group=0 --numeric-owner ' % self.source_date_epoch
         self.generate_rule(name='package_tar',
-                           command='tar -c -f ${out} ${tarflags} -C ${packageroot} ${entries}',
+                           command='tar -c -f ${out} %s${tarflags} -C ${packageroot} ${entries}' % (
+                               tarflags),
                            description='TAR ${out}')
         self.generate_rule(name='package_zip',
                            command='cd ${packageroot} && zip -q temp_archive.zip ${entries} && '
-                                   'cd - && mv ${packageroot}/temp_archive.zip ${out}',
+                                   'cd - && mv ${packageroot}/temp_archive.zip ${out}%s' % (
+                                       self._normalize_zip_command()),
                            description='ZIP ${out}')
 
     def generate_version_rules(self):
         revision, url = blade_util.load_scm(self.build_dir)
+        if config.get_item('cc_binary_config', 'version_stamping') == 'late':
+            self._generate_late_version_rules(revision, url)
+            return
         args = '--scm=${out} --revision=${revision} --url=${url} --profile=${profile} --compiler="${compiler}"'
         self.generate_rule(name='scm',
                            command=self._toolchain_command('scm', suffix=args),
@@ -523,12 +651,56 @@ class NinjaScriptHeaderGenerator(ScriptHeaderGenerator):
                 ''') % (scm, revision, url, self.options.profile, '%s %s' % (self.cc, self.cc_version)))
         self._add_rule(textwrap.dedent('''\
                 build %s: cxx %s
-                  cppflags = -w -O2
+                  cppflags = -w -O2 -g0
                   cxx_warnings =
                 ''') % (scm + '.o', scm))
 
+    def _generate_late_version_rules(self, revision, url):
+        """Link a placeholder of the scm info and patch it after linking.
+
+        The placeholder never changes, so binaries are not relinked on every
+        commit, only the small scm section in them is updated.
+        """
+        self.generate_rule(name='scm_placeholder',
+                           command=self._toolchain_command('scm_placeholder', suffix='--scm=${out}'),
+                           description='SCM PLACEHOLDER ${out}')
+        args = ('--section=${out} --revision=${revision} --url=${url} '
+                '--profile=${profile} --compiler="${compiler}"')
+        self.generate_rule(name='scm_section',
+                           command=self._toolchain_command('scm_section', suffix=args),
+                           description='SCM SECTION ${out}')
+        section = os.path.join(self.build_dir, 'scm.section')
+        objcopy = config.get_item('cc_binary_config', 'objcopy')
+        self.generate_rule(name='stampversion',
+                           command='%s --update-section .blade_scm=%s ${in} ${out}' % (
+                               objcopy, section),
+                           description='STAMP VERSION ${out}')
+        placeholder = os.path.join(self.build_dir, 'scm_placeholder.cc')
+        self._add_rule('build %s: scm_placeholder\n' % placeholder)
+        self._add_rule(textwrap.dedent('''\
+                build %s: cxx %s
+                  cppflags = -w -O2 -g0
+                  cxx_warnings =
+                ''') % (placeholder + '.o', placeholder))
+        self._add_rule(textwrap.dedent('''\
+                build %s: scm_section
+                  revision = %s
+                  url = %s
+                  profile = %s
+                  compiler = %s
+                ''') % (section, revision, url, self.options.profile,
+                        '%s %s' % (self.cc, self.cc_version)))
+
+    def _normalize_zip_command(self):
+        """The command to be appended to rules generating zip files by other tools. """
+        if self.source_date_epoch is None:
+            return ''
+        return ' && ' + self._toolchain_command('normalize_zip', suffix='${out}')
+
     def _toolchain_command(self, builder, prefix='', suffix=''):
         cmd = ['PYTHONPATH=%s:$$PYTHONPATH' % self.blade_path]
+        if self.source_date_epoch is not None:
+            cmd.append('SOURCE_DATE_EPOCH=%d' % self.source_date_epoch)
         if prefix:
             cmd.append(prefix)
         cmd.append('%s -m blade.toolchain %s' % (sys.executable, builder))
@@ -538,6 +710,24 @@ class NinjaScriptHeaderGenerator(ScriptHeaderGenerator):
             cmd.append('${out} ${in}')
         return ' '.join(cmd)
 
+    def _cached_command_args(self, command, depfile=None, outputs='${out}'):
+        """Wrap the command by the action cache if it is enabled.
+
+        Return the command arguments of `generate_rule`. The wrapped command is passed
+        in the rspfile, which is written by ninja with variables expanded verbatim, so
+        it runs the same as the direct command, with any quotes in the flags.
+        """
+        if not self.action_cache_dir:
+            return {'command': command}
+        cmd = ['PYTHONPATH=%s:$$PYTHONPATH' % self.blade_path,
+               '%s -m blade.action_cache' % sys.executable,
+               '--cache-dir=%s' % self.action_cache_dir]
+        if depfile:
+            cmd.append('--depfile=%s' % depfile)
+        cmd.append('--outputs %s' % outputs)
+        cmd.append('--command-file=${out}.rsp')
+        return {'command': ' '.join(cmd), 'rspfile': '${out}.rsp', 'rspfile_content': command}
+
     def generate(self):
         """Generate ninja rules. """
         self.generate_file_header()
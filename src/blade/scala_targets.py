@@ -139,11 +139,14 @@ class ScalaTest(ScalaFatLibrary):
     """ScalaTest"""
 
     def __init__(self, name, srcs, deps, resources, source_encoding,
-                 warnings, exclusions, testdata, kwargs):
+                 warnings, exclusions, testdata, shards, kwargs):
         ScalaFatLibrary.__init__(self, name, srcs, deps, resources, source_encoding,
                                  warnings, exclusions, kwargs)
         self.type = 'scala_test'
         self.data['testdata'] = var_to_list(testdata)
+        if not isinstance(shards, int) or shards < 0:
+            self.error_exit('"shards" must be a non-negative integer')
+        self.data['shards'] = shards
         scalatest_libs = config.get_item('scala_test_config', 'scalatest_libs')
         if scalatest_libs:
             self._add_hardcode_java_library(scalatest_libs)
@@ -160,7 +163,8 @@ class ScalaTest(ScalaFatLibrary):
         vars = {
             'packages_under_test': self._packages_under_test()
         }
-        self.ninja_build('scalatest', output, inputs=[jar] + dep_jars + maven_jars, variables=vars)
+        self.ninja_build('scalatest', output, inputs=[jar] + dep_jars + maven_jars,
+                         implicit_outputs=output + '.test_classes', variables=vars)
 
 
 def scala_library(name,
@@ -213,6 +217,7 @@ def scala_test(name,
                warnings=None,
                exclusions=[],
                testdata=[],
+               shards=0,
                **kwargs):
     """Build a scala test target
     Args:
@@ -226,6 +231,7 @@ def scala_test(name,
                        warnings=warnings,
                        exclusions=exclusions,
                        testdata=testdata,
+                       shards=shards,
                        kwargs=kwargs)
     build_manager.instance.register_target(target)
 
@@ -0,0 +1,477 @@
+# Copyright (c) 2020 Tencent Inc.
+# All rights reserved.
+#
+# Date:   April 16, 2020
+
+
+"""
+ This is the resident server module. The server of a workspace keeps the
+ loaded config, the build platform and the targets loaded from BUILD files
+ in memory, so the following commands only need to load the changed BUILD
+ files before analyzing and building.
+
+ The `blade` command with the `--server` option is a thin client, which sends
+ the command line, the environment and its stdio file descriptors to the
+ server over a unix socket in the workspace root dir, and starts the server
+ if it is not running.
+
+ For each command, the server loads the targets into its memory, then forks
+ a child process to analyze, generate and build them with the stdio of the
+ client, so the loaded targets in the server are never modified.
+
+ The server restarts itself by exec if the options or the environment which
+ affect the loading, the config files, the included files of BUILD files or
+ blade itself are changed. It exits after it is idle for a while.
+
+"""
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import errno
+import json
+import os
+import select
+import signal
+import socket
+import struct
+import subprocess
+import sys
+import time
+import traceback
+
+from blade import config
+from blade import console
+from blade import fast_build
+from blade.blade_util import blade_code_identity, file_stat, find_blade_root_dir
+from blade.blade_util import lock_file, unlock_file
+
+
+_SOCKET_FILE = '.blade_server.sock'
+_PID_FILE = '.blade_server.pid'
+_START_LOCK_FILE = '.blade_server.lock'
+
+# Environment variables to pass the listening socket and the pending request
+# to the server process
+_LISTEN_FD_ENV = 'BLADE_SERVER_LISTEN_FD'
+_REQUEST_ENV = 'BLADE_SERVER_REQUEST'
+
+# Options which affect the config or the loaded targets
+_LOADING_OPTIONS = (
+    'm', 'profile', 'debug_info_level', 'backend_builder', 'reproducible', 'load_local_config',
+    'generate_dynamic', 'generate_package', 'generate_java', 'generate_php',
+    'generate_python', 'generate_go', 'gprof', 'coverage',
+)
+
+# Seconds to wait for the started server
+_CONNECT_TIMEOUT = 10
+
+_MAX_FDS = 3
+
+
+def is_server_process():
+    return _LISTEN_FD_ENV in os.environ
+
+
+def use_server(argv):
+    """Whether the `--server` option is specified in the command line. """
+    if '--' in argv:
+        argv = argv[:argv.index('--')]
+    return '--server' in argv
+
+
+def _supported():
+    return hasattr(socket, 'AF_UNIX') and hasattr(socket.socket, 'sendmsg')
+
+
+def _send_message(sock, message):
+    sock.sendall(json.dumps(message).encode('utf-8') + b'\n')
+
+
+def _read_messages(sock):
+    """Yield the messages sent by the server. """
+    buf = b''
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            return
+        buf += data
+        while b'\n' in buf:
+            line, buf = buf.split(b'\n', 1)
+            yield json.loads(line.decode('utf-8'))
+
+
+###############################################################################
+# Client
+###############################################################################
+
+
+def _connect():
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(_SOCKET_FILE)
+        return sock
+    except socket.error:
+        sock.close()
+        return None
+
+
+def _start_server(blade_path):
+    """Start the server with a listening socket, return the connected socket. """
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        if os.path.exists(_SOCKET_FILE):
+            os.remove(_SOCKET_FILE)  # The server has exited
+        listener.bind(_SOCKET_FILE)
+        listener.listen(16)
+        fd = listener.fileno()
+        env = dict(os.environ)
+        env[_LISTEN_FD_ENV] = str(fd)
+        with open(os.devnull, 'r+') as devnull:
+            subprocess.Popen([sys.executable, blade_path], env=env, pass_fds=(fd,),
+                             stdin=devnull, stdout=devnull, stderr=devnull,
+                             close_fds=True, start_new_session=True)
+    finally:
+        listener.close()
+    deadline = time.time() + _CONNECT_TIMEOUT
+    while time.time() < deadline:
+        sock = _connect()
+        if sock:
+            return sock
+        time.sleep(0.1)
+    return None
+
+
+def _connect_or_start(blade_path):
+    sock = _connect()
+    if sock:
+        return sock
+    lock_fd, ret = lock_file(_START_LOCK_FILE)
+    try:
+        return _connect() or _start_server(blade_path)
+    finally:
+        if lock_fd != -1:
+            unlock_file(lock_fd)
+
+
+def run_client(blade_path, argv):
+    """Run the command by the server, return the exit code or None if it is not available. """
+    if not _supported():
+        console.warning('The resident server requires python 3, run the command directly')
+        return None
+    working_dir = os.getcwd()
+    blade_path = os.path.abspath(blade_path)
+    os.chdir(find_blade_root_dir(working_dir))
+    sock = _connect_or_start(blade_path)
+    os.chdir(working_dir)
+    if not sock:
+        console.warning('Failed to connect to the resident server, run the command directly')
+        return None
+
+    request = {'argv': argv, 'cwd': working_dir, 'env': dict(os.environ)}
+    data = json.dumps(request).encode('utf-8')
+    fds = struct.pack('%di' % _MAX_FDS, 0, 1, 2)
+    sock.sendmsg([struct.pack('!I', len(data))], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, fds)])
+    sock.sendall(data)
+
+    pid = [None]
+
+    def forward_signal(signum, frame):
+        if pid[0]:
+            try:
+                os.killpg(pid[0], signum)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGINT, forward_signal)
+    signal.signal(signal.SIGTERM, forward_signal)
+    exit_code = 1
+    for message in _read_messages(sock):
+        if 'pid' in message:
+            pid[0] = message['pid']
+        elif 'exit_code' in message:
+            exit_code = message['exit_code']
+    sock.close()
+    return exit_code
+
+
+###############################################################################
+# Server
+###############################################################################
+
+
+def _recv_request(conn):
+    """Receive the request and the stdio file descriptors of the client. """
+    fds_size = socket.CMSG_LEN(_MAX_FDS * struct.calcsize('i'))
+    header, ancdata, flags, addr = conn.recvmsg(4, fds_size)
+    fds = []
+    for level, kind, data in ancdata:
+        if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+            fds += struct.unpack('%di' % (len(data) // struct.calcsize('i')),
+                                 data[:len(data) - len(data) % struct.calcsize('i')])
+    if len(header) != 4 or len(fds) != _MAX_FDS:
+        for fd in fds:
+            os.close(fd)
+        return None
+    size = struct.unpack('!I', header)[0]
+    data = b''
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    request = json.loads(data.decode('utf-8'))
+    request['fds'] = fds
+    return request
+
+
+class BladeServer(object):
+    """Serve commands of the workspace with the targets loaded in memory. """
+
+    def __init__(self, blade_path, listener):
+        self._blade_path = blade_path
+        self._root_dir = os.getcwd()
+        self._listener = listener
+        self._code_identity = blade_code_identity(blade_path)
+        self._devnull = os.open(os.devnull, os.O_RDWR)
+        # Key of the options, the environment and the config of the loaded state
+        self._state_key = None
+        # Stats of the loaded BUILD files and included files
+        self._build_files = {}
+        self._included_files = {}
+        # Stats of dirs walked by the globs of each loaded source dir
+        self._globbed_dirs = {}
+
+    def _redirect_stdio(self, fds):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for i, fd in enumerate(fds):
+            os.dup2(fd, i)
+
+    def _restore_stdio(self, request):
+        self._redirect_stdio([self._devnull] * _MAX_FDS)
+        for fd in request['fds']:
+            os.close(fd)
+
+    def _setup_request(self, request):
+        os.environ.clear()
+        os.environ.update(request['env'])
+        os.chdir(request['cwd'])
+        self._redirect_stdio(request['fds'])
+        console.enable_color(sys.stdout.isatty() and
+                             os.environ.get('TERM') not in ('emacs', 'dumb'))
+
+    def _request_state_key(self, options):
+        env = [os.environ.get(name) for name in fast_build.BUILD_ENVS]
+        loading_options = [getattr(options, name, None) for name in _LOADING_OPTIONS]
+        config_files = [file_stat(path) for path in config.config_files(self._root_dir)]
+        return json.dumps([env, loading_options, config_files])
+
+    def _is_stale(self, state_key):
+        """Whether the loaded state can't be used by the request. """
+        if self._state_key is None:
+            return False
+        if (state_key != self._state_key or
+                blade_code_identity(self._blade_path) != self._code_identity):
+            return True
+        return any(file_stat(path) != stat for path, stat in self._included_files.items())
+
+    def _is_source_dir_changed(self, source_dir, stat):
+        """Whether the BUILD file or the entries of any dir walked by its globs are changed. """
+        if file_stat(os.path.join(source_dir, 'BUILD')) != stat:
+            return True
+        globbed_dirs = self._globbed_dirs.get(source_dir, {})
+        return any(file_stat(d) != dir_stat for d, dir_stat in globbed_dirs.items())
+
+    def _invalidate_changed_dirs(self):
+        """Unload targets of the changed BUILD files and the changed globs. """
+        from blade import build_manager
+        from blade.load_build_files import get_globbed_dirs
+        if build_manager.instance is None:
+            return
+        changed_dirs = [source_dir for source_dir, stat in self._build_files.items()
+                        if self._is_source_dir_changed(source_dir, stat)]
+        if changed_dirs:
+            console.debug('Reload BUILD files in %s' % ', '.join(sorted(changed_dirs)))
+            build_manager.instance.invalidate_source_dirs(changed_dirs)
+            for source_dir in changed_dirs:
+                del self._build_files[source_dir]
+                self._globbed_dirs.pop(source_dir, None)
+                get_globbed_dirs().pop(source_dir, None)
+
+    def _record_loaded_files(self):
+        from blade import build_manager
+        from blade.load_build_files import get_globbed_dirs, get_included_files
+        globbed_dirs = get_globbed_dirs()
+        for source_dir in build_manager.instance.get_loaded_source_dirs():
+            if source_dir not in self._build_files:
+                self._build_files[source_dir] = file_stat(os.path.join(source_dir, 'BUILD'))
+                self._globbed_dirs[source_dir] = dict(
+                        (d, file_stat(d)) for d in globbed_dirs.get(source_dir, ()))
+        for path in get_included_files():
+            if path not in self._included_files:
+                self._included_files[path] = file_stat(path)
+
+    def _restart(self, request=None):
+        """Restart the server by exec to discard the loaded state.
+
+        The pending request is passed to the new server process to be handled.
+        """
+        env = dict(os.environ)
+        env[_LISTEN_FD_ENV] = str(self._listener.fileno())
+        fds = [self._listener.fileno()]
+        if request:
+            conn = request['conn'].fileno()
+            env[_REQUEST_ENV] = json.dumps({'argv': request['argv'], 'cwd': request['cwd'],
+                                            'env': request['env'], 'fds': request['fds'],
+                                            'conn': conn})
+            fds += [conn] + request['fds']
+        for fd in fds:
+            os.set_inheritable(fd, True)
+        self._redirect_stdio([self._devnull] * _MAX_FDS)
+        os.chdir(self._root_dir)
+        console.debug('Restart the resident server')
+        os.execve(sys.executable, [sys.executable, self._blade_path], env)
+
+    def _finish(self, conn, request, exit_code):
+        """Reply the exit code to the client and restore the state of the server. """
+        self._restore_stdio(request)
+        os.chdir(self._root_dir)
+        try:
+            _send_message(conn, {'exit_code': exit_code})
+        except socket.error:
+            pass  # The client has exited
+        conn.close()
+
+    def _load(self, request, options, targets):
+        """Load targets of the request into the build manager. """
+        from blade import blade_main
+        state_key = self._request_state_key(options)
+        if self._is_stale(state_key):
+            self._restart(request)
+        if self._state_key is None:
+            blade_main.load_config(options, self._root_dir)
+            blade_main.adjust_config_by_options(config, options)
+            self._state_key = state_key
+        self._invalidate_changed_dirs()
+        build_dir = blade_main.setup_build_dir(options)
+        blade_main.load_command_targets(request['command'], options, targets,
+                                        self._blade_path, build_dir)
+        self._record_loaded_files()
+        return build_dir
+
+    def _handle(self, conn, request):
+        """Load the targets and run the command in a child process. """
+        from blade import blade_main
+        self._setup_request(request)
+        try:
+            command, options, targets = blade_main.setup_command(request['argv'])
+        except SystemExit as e:  # Bad command line
+            self._finish(conn, request, e.code)
+            return
+        if (options.profiling or getattr(options, 'watch', False) or
+                (command == 'dump' and options.dump_config)):
+            # Run by the client itself
+            self._finish(conn, request, None)
+            return
+        request = dict(request, command=command, conn=conn)
+        try:
+            build_dir = self._load(request, options, targets)
+        except SystemExit as e:
+            exit_code = e.code
+        except Exception:  # pylint: disable=broad-except
+            console.error(traceback.format_exc())
+            exit_code = 1
+        else:
+            exit_code = self._run(conn, command, options, build_dir)
+            self._finish(conn, request, exit_code)
+            return
+        # The loaded state may be incomplete after errors
+        self._finish(conn, request, exit_code)
+        self._restart()
+
+    def _run(self, conn, command, options, build_dir):
+        """Run the command in a child process with the loaded targets, return the exit code. """
+        from blade import blade_main
+        pid = os.fork()
+        if pid == 0:
+            os.setpgid(0, 0)
+            self._listener.close()
+            conn.close()
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            exit_code = blade_main.run_main(blade_main.run_loaded_command,
+                                            command, options, build_dir)
+            console.flush()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit((exit_code or 0) & 0xff)
+        try:
+            os.setpgid(pid, pid)
+        except OSError:
+            pass  # The child has set it or exited
+        try:
+            _send_message(conn, {'pid': pid})
+        except socket.error:
+            os.killpg(pid, signal.SIGTERM)  # The client has exited
+        status = os.waitpid(pid, 0)[1]
+        if os.WIFSIGNALED(status):
+            return 128 + os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+    def run(self, pending_request=None):
+        # Interrupts are sent to the process group of the command by the client
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        with open(_PID_FILE, 'w') as f:
+            f.write('%d\n' % os.getpid())
+        try:
+            if pending_request:
+                conn = socket.socket(fileno=pending_request.pop('conn'))
+                self._handle(conn, pending_request)
+            self._serve_forever()
+        finally:
+            self._exit()
+
+    def _serve_forever(self):
+        while True:
+            idle_timeout = config.get_item('global_config', 'server_idle_timeout')
+            readable = select.select([self._listener], [], [], idle_timeout)[0]
+            if not readable:
+                return
+            conn = self._listener.accept()[0]
+            try:
+                request = _recv_request(conn)
+            except (socket.error, ValueError):
+                request = None
+            if request is None:
+                conn.close()
+                continue
+            self._handle(conn, request)
+
+    def _exit(self):
+        """Remove the socket file if it is not taken over by a new server. """
+        pid_file = os.path.join(self._root_dir, _PID_FILE)
+        try:
+            with open(pid_file) as f:
+                if int(f.read()) != os.getpid():
+                    return
+            os.remove(os.path.join(self._root_dir, _SOCKET_FILE))
+            os.remove(pid_file)
+        except (IOError, OSError, ValueError) as e:
+            if getattr(e, 'errno', None) != errno.ENOENT:
+                console.debug('Failed to clean the resident server: %s' % e)
+
+
+def serve(blade_path):
+    """The main entry of the server process. """
+    listen_fd = int(os.environ.pop(_LISTEN_FD_ENV))
+    pending_request = os.environ.pop(_REQUEST_ENV, None)
+    listener = socket.socket(fileno=listen_fd)
+    os.set_inheritable(listen_fd, False)
+    if pending_request:
+        pending_request = json.loads(pending_request)
+        for fd in [pending_request['conn']] + pending_request['fds']:
+            os.set_inheritable(fd, False)
+    BladeServer(blade_path, listener).run(pending_request)
+    return 0
@@ -62,8 +62,11 @@ class ShellTest(Target):
         """
         self.data['testdata'], self.data['locations'] = [], []
         for td in testdata:
+            mode = ''
             if isinstance(td, tuple):
-                src, dst = td
+                src, dst = td[0], td[1]
+                if len(td) > 2:
+                    mode = td[2]
             elif isinstance(td, str):
                 src, dst = td, ''
             else:
@@ -72,7 +75,7 @@ class ShellTest(Target):
             m = LOCATION_RE.search(src)
             if m:
                 key, type = self._add_location_reference_target(m)
-                self.data['locations'].append((key, type, dst))
+                self.data['locations'].append((key, type, dst, mode))
             else:
                 self.data['testdata'].append(td)
 
@@ -82,8 +85,8 @@ class ShellTest(Target):
         output = self._target_file_path(self.name)
         self.ninja_build('shelltest', output, inputs=srcs)
         targets = self.blade.get_build_targets()
-        inputs, testdata = [], []
-        for key, type, dst in self.data['locations']:
+        inputs, testdata, modes = [], [], []
+        for key, type, dst, mode in self.data['locations']:
             path = targets[key]._get_target_file(type)
             if not path:
                 self.warning('Location %s %s is missing. Ignored.' % (key, type))
@@ -93,10 +96,13 @@ class ShellTest(Target):
                     testdata.append(os.path.basename(path))
                 else:
                     testdata.append(dst)
+                modes.append(mode)
         if inputs:
             output = self._target_file_path(self.name + '.testdata')
-            self.ninja_build('shelltestdata', output, inputs=inputs,
-                             variables={'testdata': ' '.join(testdata)})
+            vars = {'testdata': ' '.join(testdata)}
+            if any(modes):
+                vars['testdata_modes'] = '--modes=' + ','.join(modes)
+            self.ninja_build('shelltestdata', output, inputs=inputs, variables=vars)
 
 
 def sh_test(name,
@@ -0,0 +1,207 @@
+# Copyright (c) 2020 Tencent Inc.
+# All rights reserved.
+#
+# Date:   March 18, 2020
+
+
+"""
+ This is the test result cache module, passed test results and their logs
+ are saved into the cache, and can be reused by any workspace if all inputs
+ of the test are the same.
+
+"""
+
+from __future__ import absolute_import
+
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from blade import config
+from blade import console
+
+try:
+    import hashlib as md5
+except ImportError:
+    import md5
+
+
+# Don't trust the stat of a file modified so recently, it may be modified again
+# in the same timestamp granularity without changing its size
+_RACY_SECONDS = 2
+
+
+def _file_digest(path):
+    m = md5.md5()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(1024 * 1024)
+            if not data:
+                break
+            m.update(data)
+    return m.hexdigest()
+
+
+class FileDigests(object):
+    """Digests of file contents, which are persisted with the stats of the files.
+
+    So only new or modified files are read and hashed again in the next run.
+    It is thread safe.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._digests = {}  # {path: [mtime, size, inode, digest]}
+        self._modified = False
+        try:
+            with open(path) as f:
+                self._digests = json.load(f)
+        except (IOError, ValueError):
+            pass
+
+    def digest(self, path):
+        """Return the digest of the file, or None if it doesn't exist. """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        stat = [st.st_mtime, st.st_size, st.st_ino]
+        entry = self._digests.get(path)
+        if entry and entry[:3] == stat:
+            return entry[3]
+        digest = _file_digest(path)
+        if time.time() - st.st_mtime > _RACY_SECONDS:
+            self._digests[path] = stat + [digest]
+            self._modified = True
+        return digest
+
+    def save(self):
+        if not self._modified:
+            return
+        temp_file = self._path + '.tmp'
+        try:
+            with open(temp_file, 'w') as f:
+                json.dump(self._digests, f)
+            os.rename(temp_file, self._path)
+        except (IOError, OSError) as e:
+            console.debug('Failed to save file digests: %s' % e)
+
+
+def _update_digest(m, path, digests):
+    """Update the digest by the content of the file or all files under the dir. """
+    if not os.path.isdir(path):
+        m.update((digests.digest(path) or '<missing>').encode('utf-8'))
+        return
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+            f = os.path.join(root, name)
+            m.update(os.path.relpath(f, path).encode('utf-8'))
+            m.update((digests.digest(f) or '<missing>').encode('utf-8'))
+
+
+def calculate_key(name, files, env, args, digests):
+    """Calculate the cache key of a test.
+
+    Args:
+        name: str, full name of the test
+        files: [(tag, path)], the binary, runtime dependencies and testdata.
+               tag is a string which identifies the file to the test, such as
+               the path in the runfiles dir.
+        env: dict, the environments of the test
+        args: [str], the command line arguments
+        digests: FileDigests, the digests of file contents
+    """
+    m = md5.md5()
+    m.update(json.dumps([name, sorted(env.items()), args]).encode('utf-8'))
+    for tag, path in sorted(files):
+        m.update(tag.encode('utf-8'))
+        _update_digest(m, path, digests)
+    return m.hexdigest()
+
+
+class DirectoryTestCacheBackend(object):
+    """Save test results into a local or shared file system directory.
+
+    Each entry is a dir named by the key, which contains a result.json and a
+    test.log file. Entries are written into a temporary dir and then renamed,
+    so concurrent readers and writers in different workspaces never see a
+    partial entry.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key[:2], key)
+
+    def get(self, key):
+        """Return (result dict, log file path) of the cached test, or None if missed. """
+        entry_dir = self._entry_dir(key)
+        try:
+            with open(os.path.join(entry_dir, 'result.json')) as f:
+                result = json.load(f)
+        except (IOError, ValueError):
+            return None
+        return result, os.path.join(entry_dir, 'test.log')
+
+    def put(self, key, result, log_file):
+        """Save the result dict and the log file of a passed test into the cache. """
+        entry_dir = self._entry_dir(key)
+        if os.path.exists(entry_dir):
+            return
+        parent_dir = os.path.dirname(entry_dir)
+        if not os.path.isdir(parent_dir):
+            try:
+                os.makedirs(parent_dir)
+            except OSError:
+                pass  # Created by others concurrently
+        temp_dir = tempfile.mkdtemp(prefix='.%s.' % key, dir=parent_dir)
+        try:
+            if os.path.exists(log_file):
+                shutil.copyfile(log_file, os.path.join(temp_dir, 'test.log'))
+            with open(os.path.join(temp_dir, 'result.json'), 'w') as f:
+                json.dump(result, f)
+            os.rename(temp_dir, entry_dir)
+        except OSError:
+            # The entry may be created by others concurrently
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+_BACKENDS = {
+    'dir': lambda: DirectoryTestCacheBackend(
+        os.path.expanduser(config.get_item('test_cache_config', 'dir'))),
+}
+
+
+def backend_names():
+    return list(_BACKENDS.keys())
+
+
+def register_backend(name, factory):
+    """Register a new kind of backend.
+
+    factory is a callable returns the backend object, which has the same get
+    and put methods as DirectoryTestCacheBackend.
+    """
+    _BACKENDS[name] = factory
+
+
+def create_backend():
+    """Create the configured backend, return None if the cache is disabled. """
+    name = config.get_item('test_cache_config', 'backend')
+    if not name:
+        return None
+    if name not in _BACKENDS:
+        console.warning('Unknown test cache backend "%s", can only be in %s' % (
+            name, backend_names()))
+        return None
+    try:
+        return _BACKENDS[name]()
+    except EnvironmentError as e:
+        console.warning('Failed to create test cache backend "%s": %s' % (name, e))
+    return None
@@ -16,28 +16,46 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import heapq
 import os
 import re
+import shutil
 import subprocess
+import threading
 import time
 from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 
 from blade import binary_runner
+from blade import cc_coverage
 from blade import config
 from blade import console
-from blade.blade_util import md5sum, iteritems
-from blade.test_scheduler import TestScheduler
+from blade import test_cache
+from blade.blade_util import cpu_count, md5sum, iteritems
+from blade.test_scheduler import TestRunJob, TestScheduler
 # pylint: disable=unused-import
 from blade.test_scheduler import TestRunResult  # Used by eval
 
 # Used by eval when loading test history
 _TEST_HISTORY_FILE = '.blade.test.stamp'
 _TEST_EXPIRE_TIME = 86400  # 1 day
+_FLAKINESS_HISTORY_SIZE = 20  # Number of recent runs to calculate the flakiness
 
 
 TestJob = namedtuple('TestJob',
         ['reason', 'binary_md5', 'testdata_md5', 'env_md5', 'args'])
-TestHistoryItem = namedtuple('TestHistoryItem', ['job', 'result'])
+# runs: exit codes of all attempts in each of the recent runs, such as [(0,), (1, 0)]
+TestHistoryItem = namedtuple('TestHistoryItem', ['job', 'result', 'runs'])
+# Keep compatible with the test history saved by old versions
+TestHistoryItem.__new__.__defaults__ = ((),)
+
+
+def _flakiness(runs):
+    """The ratio of runs in which the test both failed and passed in its attempts. """
+    if not runs:
+        return 0.0
+    flaky_runs = [r for r in runs if 0 in r and any(code != 0 for code in r)]
+    return float(len(flaky_runs)) / len(runs)
 
 
 def _filter_out_ignored_envs(names):
@@ -59,8 +77,12 @@ def _diff_env(a, b):
 
 class TestRunner(binary_runner.BinaryRunner):
     """Run specified tests and collect the results"""
-    def __init__(self, targets, options, target_database, direct_targets, skip_tests):
-        """Init method. """
+    def __init__(self, targets, options, target_database, direct_targets, skip_tests,
+                 affected_tests=None):
+        """Init method.
+
+        affected_tests: keys of tests affected by the changed files, None means all tests.
+        """
         # pylint: disable=too-many-locals, too-many-statements
         binary_runner.BinaryRunner.__init__(self, targets, options, target_database)
         self.direct_targets = direct_targets
@@ -69,6 +91,7 @@ class TestRunner(binary_runner.BinaryRunner):
         self.test_jobs = {}  # dict{key : TestJob}
 
         self.skip_tests = skip_tests  # Tests to be skipped
+        self.affected_tests = affected_tests
         self.skipped_tests = []
 
         # Test history is the key to implement incremental test.
@@ -76,6 +99,19 @@ class TestRunner(binary_runner.BinaryRunner):
         # and be updated and saved to file back after test.
         self.test_history = {}  # {key, dict{}}
 
+        # Passed results can be reused across workspaces by the test cache
+        self.test_cache = None
+        if not options.coverage:
+            self.test_cache = test_cache.create_backend()
+        self.cache_keys = {}  # dict{key : cache key}
+        self._file_digests = None
+        self.cached_run_results = {}  # dict{key : TestRunResult}
+
+        # Shards of tests which are split by test classes
+        self.test_shards = {}  # dict{key : [(shard key, [class names])]}
+        self._shard_envs = {}  # dict{key : environments shared by all shards}
+        self._shard_env_lock = threading.Lock()
+
         self._load_test_history()
         self._update_test_history()
 
@@ -91,6 +127,8 @@ class TestRunner(binary_runner.BinaryRunner):
 
         if 'items' not in self.test_history:
             self.test_history['items'] = {}
+        if 'class_durations' not in self.test_history:
+            self.test_history['class_durations'] = {}
 
     def _update_test_history(self):
         old_env = self.test_history.get('env', {})
@@ -107,16 +145,22 @@ class TestRunner(binary_runner.BinaryRunner):
         self.test_history['env'] = new_env
         self.env_md5 = md5sum(str(sorted(iteritems(new_env))))
 
-    def _save_test_history(self, passed_run_results, failed_run_results):
+    def _save_test_history(self, passed_run_results, failed_run_results, attempts):
         """update test history and save it to file. """
-        self._merge_run_results_to_history(passed_run_results)
-        self._merge_run_results_to_history(failed_run_results)
+        self._merge_run_results_to_history(passed_run_results, attempts)
+        self._merge_run_results_to_history(failed_run_results, attempts)
         with open(_TEST_HISTORY_FILE, 'w') as f:
             print(str(self.test_history), file=f)
 
-    def _merge_run_results_to_history(self, run_results):
+    def _merge_run_results_to_history(self, run_results, attempts):
         for key, run_result in iteritems(run_results):
-            self.test_history['items'][key] = TestHistoryItem(self.test_jobs[key], run_result)
+            history = self.test_history['items'].get(key)
+            runs = list(history.runs) if history else []
+            runs.append(tuple(r.exit_code for r in attempts.get(key, [run_result])))
+            self.test_history['items'][key] = TestHistoryItem(
+                    job=self.test_jobs[key],
+                    result=run_result,
+                    runs=runs[-_FLAKINESS_HISTORY_SIZE:])
 
     def _get_test_target_md5sum(self, target):
         """Get test target md5sum. """
@@ -227,6 +271,8 @@ class TestRunner(binary_runner.BinaryRunner):
         for target in self.targets.values():
             if not target.type.endswith('_test'):
                 continue
+            if self.affected_tests is not None and target.key not in self.affected_tests:
+                continue
             binary_md5, testdata_md5 = self._get_test_target_md5sum(target)
             reason = self._run_reason(target, binary_md5, testdata_md5)
             if reason:
@@ -304,8 +350,37 @@ class TestRunner(binary_runner.BinaryRunner):
             if subprocess.call(cmd_str, shell=True) != 0:
                 console.warning('Failed to generate java coverage report')
 
+    def _cc_objs_dirs(self, targets):
+        """Object dirs of the tests and their dependencies which contain gcov data. """
+        objs_dirs = set()
+        for target in targets:
+            for key in [target.key] + target.expanded_deps:
+                dep = self.target_database.get(key)
+                if not dep:
+                    continue
+                objs_dir = os.path.join(self.build_dir, dep.path, dep.name + '.objs')
+                if os.path.isdir(objs_dir):
+                    objs_dirs.add(objs_dir)
+        return sorted(objs_dirs)
+
+    def _generate_cc_coverage_report(self):
+        """Run lcov to generate c/c++ coverage report of the tests ran. """
+        objs_dirs = self._cc_objs_dirs(self.targets[key] for key in self.test_jobs
+                                       if key not in self.cached_run_results)
+        if not objs_dirs:
+            return
+        cc_test_config = config.get_section('cc_test_config')
+        jobs = cc_test_config['coverage_jobs'] or cpu_count()
+        reporter = cc_coverage.CcCoverageReporter(cc_test_config['lcov_path'],
+                                                  cc_test_config['genhtml_path'],
+                                                  os.getcwd(), jobs)
+        reporter.generate_report(objs_dirs,
+                                 os.path.join(self.build_dir, 'cc_coverage.info'),
+                                 os.path.join(self.build_dir, 'cc_coverage_report'))
+
     def _generate_coverage_report(self):
         self._generate_jacoco_coverage_report()
+        self._generate_cc_coverage_report()
 
     def _show_banner(self, text):
         pads = int((76 - len(text)) / 2)
@@ -324,12 +399,12 @@ class TestRunner(binary_runner.BinaryRunner):
         tests = []
         for key, result in iteritems(run_results):
             reason = self.test_jobs[key].reason
-            tests.append((key, result.cost_time, reason, result.exit_code))
+            tests.append((key, result.cost_time, result.prepare_time, reason, result.exit_code))
         tests.sort(key=lambda x: x[1])
         output_function = console.error if is_error else console.info
-        for key, costtime, reason, result in tests:
-            output_function('%s:%s triggered by %s, exit(%s), cost %.2f s' % (
-                            key[0], key[1], reason, result, costtime), prefix=False)
+        for key, costtime, preparetime, reason, result in tests:
+            output_function('%s:%s triggered by %s, exit(%s), cost %.2f s, prepare %.2f s' % (
+                            key[0], key[1], reason, result, costtime, preparetime), prefix=False)
 
     def _collect_slow_tests(self, run_results):
         return [(result.cost_time, key) for key, result in iteritems(run_results)
@@ -347,6 +422,9 @@ class TestRunner(binary_runner.BinaryRunner):
         """Show tests summary. """
         self._show_banner('Testing Summary')
         console.info('%d tests scheduled to run by scheduler.' % (len(self.test_jobs)))
+        if self.cached_run_results:
+            console.info('%d tests passed by reusing cached results.' %
+                         len(self.cached_run_results))
         if self.skipped_tests:
             console.info('%d tests skipped when doing incremental test.' %
                          len(self.skipped_tests))
@@ -368,7 +446,25 @@ class TestRunner(binary_runner.BinaryRunner):
             msg.append('%d cancelled' % cancelled_tests)
         console.error(', '.join(msg) + '.')
 
-    def _show_tests_result(self, passed_run_results, failed_run_results):
+    def _show_flaky_tests(self, attempts):
+        """Show tests which were retried in this run and their flakiness. """
+        flaky_tests = []
+        for key, results in iteritems(attempts):
+            if len(results) <= 1:
+                continue
+            history = self.test_history['items'].get(key)
+            runs = history.runs if history else ()
+            flaky_tests.append((_flakiness(runs), len(runs), key, results))
+        if not flaky_tests:
+            return
+        console.warning('%d tests were retried:' % len(flaky_tests))
+        for flakiness, num_of_runs, key, results in sorted(flaky_tests, reverse=True):
+            status = 'passed' if results[-1].exit_code == 0 else 'failed'
+            console.warning('//%s:%s %s after %d attempts, flakiness %.2f in last %d runs' % (
+                            key[0], key[1], status, len(results), flakiness, num_of_runs),
+                            prefix=False)
+
+    def _show_tests_result(self, passed_run_results, failed_run_results, attempts):
         """Show test details and summary according to the options. """
         if self.options.show_details:
             self._show_banner('Testing Details')
@@ -378,36 +474,321 @@ class TestRunner(binary_runner.BinaryRunner):
                 self._show_run_results(passed_run_results)
         if self.options.show_tests_slower_than is not None:
             self._show_slow_tests(passed_run_results, failed_run_results)
+        self._show_flaky_tests(attempts)
         if failed_run_results:  # Always show details of failed tests
             console.error('failed tests:')
             self._show_run_results(failed_run_results, is_error=True)
         self._show_tests_summary(passed_run_results, failed_run_results)
 
+    def _test_cache_env(self):
+        """The environments in the test cache key.
+
+        Only the configured environments are used, and the path of the workspace
+        is replaced, so the key can match across workspaces.
+        """
+        root_dir = os.getcwd()
+        env = {}
+        for name in config.get_item('test_cache_config', 'envs'):
+            if name in os.environ:
+                env[name] = os.environ[name].replace(root_dir, '<root>')
+        return env
+
+    def _test_cache_key(self, target, env):
+        """Calculate the test cache key by the content of all inputs of the test. """
+        files = [('binary', os.path.abspath(self._executable(target)))]
+        if target.data.get('dynamic_link'):
+            for dep in target.expanded_deps:
+                dep_target = self.targets[dep]
+                if 'cc_library' in dep_target.type:
+                    lib_path = os.path.join(self.build_dir, dep_target.path,
+                                            'lib%s.so' % dep_target.name)
+                    files.append((os.path.relpath(lib_path, self.build_dir), lib_path))
+        for src, dest, mode in self._runfiles_entries(target):
+            files.append((dest, src))
+        return test_cache.calculate_key(target.fullname, files, env, self.options.args,
+                                        self._file_digests)
+
+    def _lookup_test_cache(self, key, env):
+        """Return (cache key, cached entry or None) of the test.
+
+        It is called in a thread pool, the files are hashed and the cache is
+        looked up in parallel.
+        """
+        target = self.target_database[key]
+        try:
+            cache_key = self._test_cache_key(target, env)
+        except (EnvironmentError, SystemExit) as e:
+            console.warning('//%s: Failed to calculate test cache key: %s' % (
+                            target.fullname, e))
+            return None, None
+        if target.data.get('always_run'):
+            return cache_key, None
+        return cache_key, self.test_cache.get(cache_key)
+
+    def _reuse_cached_results(self, test_keys):
+        """Reuse passed results in the test cache, return keys of tests still need to run. """
+        if not self.test_cache or not test_keys:
+            return test_keys
+        self._file_digests = test_cache.FileDigests(
+                os.path.join(self.build_dir, '.blade_test_digests.json'))
+        env = self._test_cache_env()
+        pool = ThreadPool(min(len(test_keys), cpu_count()))
+        try:
+            lookups = pool.map(lambda key: self._lookup_test_cache(key, env), test_keys)
+        finally:
+            pool.close()
+            pool.join()
+        self._file_digests.save()
+        result = []
+        for key, (cache_key, cached) in zip(test_keys, lookups):
+            if not cached:
+                if cache_key:
+                    self.cache_keys[key] = cache_key
+                result.append(key)
+                continue
+            target = self.target_database[key]
+            cached_result, cached_log = cached
+            log_file = self._test_log_path(target)
+            if os.path.exists(cached_log):
+                shutil.copyfile(cached_log, log_file)
+            elif os.path.exists(log_file):
+                os.remove(log_file)  # Not the log of the cached result
+            console.info('//%s passed, reused the cached result, log: %s' % (
+                         target.fullname, log_file))
+            self.cached_run_results[key] = TestRunResult(exit_code=0,
+                                                         start_time=time.time(),
+                                                         cost_time=cached_result['cost_time'],
+                                                         prepare_time=0)
+        return result
+
+    def _save_results_to_cache(self, passed_run_results, attempts):
+        """Save passed results into the test cache, flaky tests are not saved. """
+        if not self.test_cache:
+            return
+        for key, run_result in iteritems(passed_run_results):
+            if key not in self.cache_keys or len(attempts.get(key, [])) > 1:
+                continue
+            target = self.target_database[key]
+            log_file = self._test_log_path(target)
+            if not os.path.exists(log_file):
+                continue  # The output is not saved when it is shown on the console directly
+            result = {
+                'name': target.fullname,
+                'cost_time': run_result.cost_time,
+                'start_time': run_result.start_time,
+            }
+            try:
+                self.test_cache.put(self.cache_keys[key], result, log_file)
+            except EnvironmentError as e:
+                console.warning('//%s: Failed to save test result into cache: %s' % (
+                                target.fullname, e))
+
+    def _test_log_path(self, target):
+        """Returns the path of the file to save the output of the test. """
+        return '%s.log' % self._executable(target)
+
+    def _prepare_test_env(self, target):
+        """Prepare the runfiles and environments to run the test.
+
+        It is called by the test scheduler in its worker threads, so the
+        preparation of different tests is overlapped with each other and
+        with the running tests.
+        """
+        test_env = self._prepare_env(target)
+        if console.color_enabled():
+            test_env['GTEST_COLOR'] = 'yes'
+        else:
+            test_env['GTEST_COLOR'] = 'no'
+        test_env['GTEST_OUTPUT'] = 'xml'
+        test_env['HEAPCHECK'] = target.data.get('heap_check', '')
+        pprof_path = config.get_item('cc_test_config', 'pprof_path')
+        if pprof_path:
+            test_env['PPROF_PATH'] = os.path.abspath(pprof_path)
+        if self.options.coverage:
+            test_env['BLADE_COVERAGE'] = 'true'
+        return test_env
+
+    def _prepare_job_env(self, target):
+        """Prepare the test environments, which are prepared only once for all shards. """
+        if target.key not in self.test_shards:
+            return self._prepare_test_env(target)
+        with self._shard_env_lock:
+            if target.key not in self._shard_envs:
+                self._shard_envs[target.key] = self._prepare_test_env(target)
+            return self._shard_envs[target.key]
+
+    def _split_test_classes(self, target):
+        """Split the test classes into shards, return None if the test is not sharded.
+
+        Classes are assigned to the least loaded shard in the descending order of
+        their durations in the last run, the duration of a new class is estimated
+        as the average of others.
+        """
+        shards = target.data.get('shards', 0)
+        if shards <= 1:
+            return None
+        classes_file = '%s.test_classes' % self._executable(target)
+        try:
+            with open(classes_file) as f:
+                classes = [line.strip() for line in f if line.strip()]
+        except IOError as e:
+            console.warning('//%s: Failed to load test classes, run it without sharding: %s' % (
+                            target.fullname, e))
+            return None
+        if len(classes) <= 1:
+            return None
+        durations = self.test_history['class_durations'].get(target.key, {})
+        known_durations = [durations[c] for c in classes if c in durations]
+        default_duration = 1.0
+        if known_durations:
+            default_duration = sum(known_durations) / len(known_durations)
+
+        def duration(cls):
+            return durations.get(cls, default_duration)
+
+        heap = [(0.0, i, []) for i in range(min(shards, len(classes)))]
+        for cls in sorted(classes, key=duration, reverse=True):
+            load, index, shard = heapq.heappop(heap)
+            shard.append(cls)
+            heapq.heappush(heap, (load + duration(cls), index, shard))
+        return [shard for load, index, shard in sorted(heap, key=lambda s: s[1])]
+
+    def _test_run_jobs(self, target):
+        """Generate the jobs to run the test, one job for each shard. """
+        cmd = [os.path.abspath(self._executable(target))]
+        cmd += self.options.args
+        run_dir = self._runfiles_dir(target)
+        shards = self._split_test_classes(target)
+        if not shards:
+            return [TestRunJob(key=target.key, name=target.fullname, target=target,
+                               run_dir=run_dir, log_file=self._test_log_path(target),
+                               cmd=cmd, env=None)]
+        jobs = []
+        self.test_shards[target.key] = []
+        for i, classes in enumerate(shards):
+            shard_key = (target.path, '%s/%d' % (target.name, i))
+            self.test_shards[target.key].append((shard_key, classes))
+            jobs.append(TestRunJob(
+                key=shard_key,
+                name='%s (shard %d/%d)' % (target.fullname, i + 1, len(shards)),
+                target=target,
+                run_dir=run_dir,
+                log_file='%s.shard%d.log' % (self._executable(target), i),
+                cmd=cmd,
+                env={'BLADE_TEST_CLASSES': ' '.join(classes)}))
+        return jobs
+
+    def _merge_shard_results(self, passed_run_results, failed_run_results, attempts):
+        """Merge results of shards into the results of their tests.
+
+        The test passed only if all of its shards passed, its cost time is the
+        elapsed time from the first shard started to the last one finished.
+        """
+        for key, shards in iteritems(self.test_shards):
+            target = self.target_database[key]
+            results = []
+            shard_attempts = []
+            for shard_key, classes in shards:
+                result = (passed_run_results.pop(shard_key, None) or
+                          failed_run_results.pop(shard_key, None))
+                shard_attempts.append(attempts.pop(shard_key, []))
+                if result:
+                    results.append(result)
+                    self._update_class_durations(key, classes, result)
+            if len(results) != len(shards):
+                continue  # Some shards are cancelled
+            exit_code = 0
+            for result in results:
+                if result.exit_code != 0:
+                    exit_code = result.exit_code
+                    break
+            start_time = min(r.start_time for r in results)
+            merged = TestRunResult(
+                exit_code=exit_code,
+                start_time=start_time,
+                cost_time=max(r.start_time + r.cost_time for r in results) - start_time,
+                prepare_time=max(r.prepare_time for r in results))
+            if exit_code == 0:
+                passed_run_results[key] = merged
+            else:
+                failed_run_results[key] = merged
+            # The most retried shard represents the flakiness of the test
+            attempts[key] = max(shard_attempts, key=len)
+            self._merge_shard_logs(target, len(shards))
+
+    def _update_class_durations(self, key, classes, result):
+        """Estimate durations of test classes by the cost time of their shard. """
+        durations = self.test_history['class_durations'].setdefault(key, {})
+        for cls in classes:
+            durations[cls] = result.cost_time / len(classes)
+
+    def _merge_shard_logs(self, target, num_of_shards):
+        """Concatenate logs of all shards into the log of the test.
+
+        The log of the test is removed if any shard has no log, such as when the
+        output is shown on the console directly, so an incomplete log is never cached.
+        """
+        log_file = self._test_log_path(target)
+        shard_logs = ['%s.shard%d.log' % (self._executable(target), i)
+                      for i in range(num_of_shards)]
+        if not all(os.path.exists(shard_log) for shard_log in shard_logs):
+            if os.path.exists(log_file):
+                os.remove(log_file)
+            return
+        with open(log_file, 'wb') as log:
+            for shard_log in shard_logs:
+                with open(shard_log, 'rb') as f:
+                    shutil.copyfileobj(f, log)
+
+    def _test_priority(self, key):
+        """The priority of the test, tests with smaller value should run earlier.
+
+        Historically failing tests run first, then recently changed tests, and
+        longer tests run earlier among tests with the same level.
+        """
+        history = self.test_history['items'].get(key)
+        if not history:
+            return (1, 0)  # New test
+        job = self.test_jobs[key]
+        if history.result.exit_code != 0 or _flakiness(history.runs) > 0:
+            level = 0
+        elif (job.binary_md5 != history.job.binary_md5 or
+              job.testdata_md5 != history.job.testdata_md5):
+            level = 1
+        else:
+            level = 2
+        return (level, -history.result.cost_time)
+
+    def _max_failures(self):
+        """Number of failed tests to stop running remaining tests, 0 means never. """
+        if self.options.max_failures > 0:
+            return self.options.max_failures
+        return 1 if self.options.fail_fast else 0
+
     def run(self):
         """Run all the test target programs. """
         self._collect_test_jobs()
+        test_keys = list(self.test_jobs)
+        if self.options.prioritize:
+            test_keys.sort(key=self._test_priority)
+        test_keys = self._reuse_cached_results(test_keys)
         tests_run_list = []
-        for target_key in self.test_jobs:
+        for target_key in test_keys:
             target = self.target_database[target_key]
-            test_env = self._prepare_env(target)
-            cmd = [os.path.abspath(self._executable(target))]
-            cmd += self.options.args
-            if console.color_enabled():
-                test_env['GTEST_COLOR'] = 'yes'
-            else:
-                test_env['GTEST_COLOR'] = 'no'
-            test_env['GTEST_OUTPUT'] = 'xml'
-            test_env['HEAPCHECK'] = target.data.get('heap_check', '')
-            pprof_path = config.get_item('cc_test_config', 'pprof_path')
-            if pprof_path:
-                test_env['PPROF_PATH'] = os.path.abspath(pprof_path)
-            if self.options.coverage:
-                test_env['BLADE_COVERAGE'] = 'true'
-            tests_run_list.append((target, self._runfiles_dir(target), test_env, cmd))
-
-        console.notice('%d tests to run' % len(tests_run_list))
+            tests_run_list += self._test_run_jobs(target)
+
+        console.notice('%d tests to run' % len(test_keys))
+        if self.test_shards:
+            console.notice('%d tests are split into %d shards' % (
+                len(self.test_shards), sum(len(s) for s in self.test_shards.values())))
+        if self.options.coverage:
+            cc_coverage.reset_counters(self._cc_objs_dirs(self.target_database[key]
+                                                          for key in test_keys))
         console.flush()
-        scheduler = TestScheduler(tests_run_list, self.options.test_jobs)
+        scheduler = TestScheduler(tests_run_list, self.options.test_jobs,
+                                  self._prepare_job_env,
+                                  max_retries=self.options.max_retries,
+                                  fail_fast=self._max_failures())
         try:
             scheduler.schedule_jobs()
         except KeyboardInterrupt:
@@ -421,7 +802,11 @@ class TestRunner(binary_runner.BinaryRunner):
         self._clean_env()
 
         passed_run_results, failed_run_results = scheduler.get_results()
-        self._save_test_history(passed_run_results, failed_run_results)
-        self._show_tests_result(passed_run_results, failed_run_results)
+        attempts = scheduler.get_attempts()
+        self._merge_shard_results(passed_run_results, failed_run_results, attempts)
+        self._save_results_to_cache(passed_run_results, attempts)
+        passed_run_results.update(self.cached_run_results)
+        self._save_test_history(passed_run_results, failed_run_results, attempts)
+        self._show_tests_result(passed_run_results, failed_run_results, attempts)
 
         return 0 if len(passed_run_results) == len(self.test_jobs) else 1
@@ -13,6 +13,8 @@
 
 from __future__ import absolute_import
 
+import heapq
+import os
 import signal
 import subprocess
 import threading
@@ -29,7 +31,17 @@ from blade import blade_util
 from blade import config
 from blade import console
 
-TestRunResult = namedtuple('TestRunResult', ['exit_code', 'start_time', 'cost_time'])
+TestRunResult = namedtuple('TestRunResult',
+                           ['exit_code', 'start_time', 'cost_time', 'prepare_time'])
+# Keep compatible with the test history saved by old versions
+TestRunResult.__new__.__defaults__ = (0,)
+
+# A test job to be scheduled.
+# key: key of the result, which is the key of the target, or (path, 'name/index') of a shard
+# name: name of the job to be shown
+# env: extra environments to run the test
+TestRunJob = namedtuple('TestRunJob',
+                        ['key', 'name', 'target', 'run_dir', 'log_file', 'cmd', 'env'])
 
 # dict{-signo : signame}
 _SIGNAL_MAP = dict([
@@ -39,93 +51,108 @@ _SIGNAL_MAP = dict([
 
 
 class WorkerThread(threading.Thread):
-    def __init__(self, id, job_queue, job_handler, redirect):
+    def __init__(self, id, job_queue, job_handler, redirect, scheduler):
         """Init methods for this thread. """
         threading.Thread.__init__(self)
         self.thread_id = id
-        self.running = True
         self.job_queue = job_queue
         self.job_handler = job_handler
         self.redirect = redirect
-        self.job_start_time, self.job_timeout = 0, 0
-        self.job_process = None
-        self.job_name = ''
-        self.job_is_timeout = False
-        self.job_lock = threading.Lock()
+        self.scheduler = scheduler
         console.info('blade test executor %d starts to work' % self.thread_id)
 
-    def _process(self):
-        """Private handler to handle one job. """
-        console.info('blade worker %d starts to process' % self.thread_id)
-        console.info('blade worker %d finish' % self.thread_id)
-
-    def terminate(self):
-        """Terminate the worker. """
-        self.running = False
-
-    def cleanup_job(self):
-        """Clean up job data. """
-        self.job_start_time, self.job_timeout = 0, 0
-        self.job_process = None
-        self.job_name = ''
-        self.job_is_timeout = False
-
-    def set_job_data(self, p, name, timeout):
-        """Set the popen object and name if the job is run in a subprocess. """
-        self.job_process, self.job_name, self.job_timeout = p, name, timeout
-
-    def check_job_timeout(self, now):
-        """Check whether the job is timeout or not.
+    def run(self):
+        """executes and runs here.
 
-        This method simply checks job timeout and returns immediately.
-        The caller should invoke this method repeatedly so that a job
-        which takes a very long time would be timeout sooner or later.
+        The worker blocks on the job queue and exits when it takes the sentinel
+        `None` out, so there is no busy polling when the queue is empty.
         """
         try:
-            self.job_lock.acquire()
-            if (not self.job_is_timeout and self.job_start_time and
-                    self.job_timeout is not None and
-                    self.job_name and self.job_process is not None):
-                if self.job_start_time + self.job_timeout < now:
-                    self.job_is_timeout = True
-                    console.error('//%s: TIMEOUT\n' % self.job_name)
-                    self.job_process.terminate()
-        finally:
-            self.job_lock.release()
-
-    def run(self):
-        """executes and runs here. """
-        try:
-            if self.job_handler:
-                job_queue = self.job_queue
-                while not job_queue.empty() and self.running:
-                    try:
-                        job = job_queue.get_nowait()
-                    except queue.Empty:
-                        continue
-                    self.job_start_time = time.time()
-                    self.job_handler(job, self.redirect, self)
-                    try:
-                        self.job_lock.acquire()
-                        self.cleanup_job()
-                    finally:
-                        self.job_lock.release()
-            else:
-                self._process()
+            while True:
+                job = self.job_queue.get()
+                if job is None:
+                    break
+                self.job_handler(job, self.redirect, self)
         except:  # pylint: disable=bare-except
             traceback.print_exc()
+        finally:
+            self.scheduler.worker_exited(self)
+
+
+def _read_log_tail(path, max_lines):
+    """Read the last max_lines lines of the log file.
+
+    Return the tail text and whether the log is truncated.
+    """
+    block_size = 4096
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        offset = size
+        content = b''
+        while offset > 0 and content.count(b'\n') <= max_lines:
+            if size - offset >= _MAX_LOG_TAIL_BYTES:
+                break
+            read_size = min(block_size, offset)
+            offset -= read_size
+            f.seek(offset)
+            content = f.read(read_size) + content
+    lines = content.splitlines(True)
+    truncated = offset > 0 or len(lines) > max_lines
+    if offset > 0 and lines:
+        lines = lines[1:]  # The first line may be incomplete
+    lines = lines[-max_lines:] if max_lines > 0 else []
+    return b''.join(lines).decode('utf-8', 'replace'), truncated
+
+
+class _RunningJob(object):
+    """A running test process which may be killed when reaches its deadline.
+
+    The deadline is None if the test has no timeout.
+    """
+
+    def __init__(self, name, process, deadline):
+        self.name = name
+        self.process = process
+        self.deadline = deadline
+        self.finished = False
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
 
 
 _MAX_WORKER_THREADS = 16
 
+# Limit the size of the log tail to be shown in case of too long lines
+_MAX_LOG_TAIL_BYTES = 64 * 1024
+
+# The Condition.wait without timeout will block signals in python 2, which makes
+# blade can't be terminated by Ctrl-C, so we always wait with a timeout.
+_MAX_WAIT_TIME = 3600
+
 
 class TestScheduler(object):
-    """Schedule specified tests to be ran in multiple test threads"""
+    """Schedule specified tests to be ran in multiple test threads.
 
-    def __init__(self, tests_list, num_jobs):
-        """init method. """
+    The main thread sleeps on a condition variable and is woken up either when
+    a worker exits or when the nearest deadline in the timer heap expires, so
+    neither test completion nor test timeout is detected by periodic polling.
+    """
+
+    def __init__(self, tests_list, num_jobs, prepare_env, max_retries=0, fail_fast=0):
+        """init method.
+
+        prepare_env: callable(target) -> env, prepares the runfiles of the test
+                     and returns the environments to run it. It is called in the
+                     worker threads just before each test runs.
+        max_retries: max times to retry a failed test.
+        fail_fast: cancel all remaining tests after so many tests failed, 0 means never.
+        """
         self.tests_list = tests_list
         self.num_jobs = num_jobs
+        self.prepare_env = prepare_env
+        self.max_retries = max_retries
+        self.fail_fast = fail_fast
 
         self.job_queue = queue.Queue(0)
         self.exclusive_job_queue = queue.Queue(0)
@@ -134,9 +161,26 @@ class TestScheduler(object):
         # dict{key, {}}
         self.passed_run_results = {}
         self.failed_run_results = {}
+        # dict{key, [TestRunResult of each attempt]}
+        self.attempts = {}
 
         self.num_of_ran_tests = 0
 
+        # Guards the timer heap and the alive workers set, and is notified
+        # when any of them changed.
+        self._event = threading.Condition()
+        self._deadlines = []  # heap of _RunningJob
+        self._running_jobs = set()
+        self._alive_workers = set()
+
+        # Number of jobs which are not finished in the queue being processed,
+        # retried jobs are put back into the queue, so the end sentinels can only
+        # be put after all of the jobs are finished.
+        self._unfinished_jobs = 0
+        self._num_of_workers = 0
+        self._cancelled = False
+        self._cancelled_tests = set()  # Names of running tests terminated by fail fast
+
     def _get_workers_num(self):
         """get the number of thread workers. """
         cpu_count = blade_util.cpu_count()
@@ -161,112 +205,281 @@ class TestScheduler(object):
         if console.verbosity_le('quiet'):
             console.show_progress_bar(self.num_of_ran_tests, len(self.tests_list))
 
-    def _run_job_redirect(self, job, job_thread):
-        """run job and redirect the output. """
-        target, run_dir, test_env, cmd = job
-        test_name = target.fullname
+    def _job_started(self, p, name, timeout):
+        """Register a just started test process and its deadline. """
+        deadline = None if timeout is None else time.time() + timeout
+        running_job = _RunningJob(name, p, deadline)
+        with self._event:
+            self._running_jobs.add(running_job)
+            if self._cancelled:
+                # Started after the cancellation
+                self._terminate_job(running_job)
+            if deadline is not None:
+                heapq.heappush(self._deadlines, running_job)
+                self._event.notify()
+        return running_job
+
+    def _job_finished(self, running_job):
+        """Mark the job as finished, its heap entry will be discarded lazily. """
+        with self._event:
+            running_job.finished = True
+            self._running_jobs.discard(running_job)
+
+    def _terminate_job(self, running_job):
+        """Terminate a running job because of cancellation, called with self._event held. """
+        self._cancelled_tests.add(running_job.name)
+        try:
+            running_job.process.terminate()
+        except OSError:
+            pass  # Already exited
+
+    def _cancel_all_jobs(self, job_queue):
+        """Stop dispatching pending jobs and terminate running jobs.
+
+        job_queue: the queue being processed, from which the workers will get
+                   the end sentinels.
+        """
+        self._cancelled = True
+        self._cancel_pending_jobs(self.job_queue, 0)
+        self._cancel_pending_jobs(self.exclusive_job_queue, 0)
+        for i in range(self._num_of_workers):
+            job_queue.put(None)
+        with self._event:
+            for running_job in self._running_jobs:
+                self._terminate_job(running_job)
+
+    def worker_exited(self, worker):
+        with self._event:
+            self._alive_workers.discard(worker)
+            self._event.notify()
+
+    def _show_job_log(self, test_name, log_file, result, returncode):
+        """Show the tail of the test log if the test failed. """
+        if returncode == 0:
+            console.info('//%s finished: %s, log: %s\n' % (test_name, result, log_file))
+            return
+        tail_lines = config.get_item('global_config', 'test_log_tail_lines')
+        try:
+            tail, truncated = _read_log_tail(log_file, tail_lines)
+        except EnvironmentError as e:
+            tail, truncated = 'Error reading log: %s' % e, False
+        msg = ['Output of //%s:' % test_name]
+        if truncated:
+            msg.append('...(truncated, see the full log in %s)' % log_file)
+        msg.append(tail.rstrip('\n'))
+        msg.append('//%s finished: %s, log: %s\n' % (test_name, result, log_file))
+        console.error('\n'.join(msg), prefix=False)
+        console.flush()
+
+    def _run_job_redirect(self, job, test_env, job_thread):
+        """run job and redirect the output to the log file.
+
+        The output is written to the log file by the test process directly,
+        and only its tail is read back and shown if the test failed.
+        """
+        target, test_name, cmd = job.target, job.name, job.cmd
         shell = target.data.get('run_in_shell', False)
         if shell:
             cmd = subprocess.list2cmdline(cmd)
         timeout = target.data.get('test_timeout')
         self._show_progress(cmd)
-        p = subprocess.Popen(cmd,
-                             env=test_env,
-                             cwd=run_dir,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT,
-                             close_fds=True,
-                             shell=shell)
-        job_thread.set_job_data(p, test_name, timeout)
-        stdout = p.communicate()[0]
+        with open(job.log_file, 'wb') as log:
+            p = subprocess.Popen(cmd,
+                                 env=test_env,
+                                 cwd=job.run_dir,
+                                 stdout=log,
+                                 stderr=subprocess.STDOUT,
+                                 close_fds=True,
+                                 shell=shell)
+            running_job = self._job_started(p, test_name, timeout)
+            p.wait()
+        self._job_finished(running_job)
         result = self._get_result(p.returncode)
-        msg = 'Output of //%s:\n%s\n//%s finished: %s\n' % (
-            test_name, stdout, test_name, result)
-        if console.verbosity_le('quiet') and p.returncode != 0:
-            console.error(msg, prefix=False)
-        else:
-            console.info(msg)
-            console.flush()
+        self._show_job_log(test_name, job.log_file, result, p.returncode)
 
         return p.returncode
 
-    def _run_job(self, job, job_thread):
+    def _run_job(self, job, test_env, job_thread):
         """run job, do not redirect the output. """
-        target, run_dir, test_env, cmd = job
-        test_name = target.fullname
+        target, test_name, cmd = job.target, job.name, job.cmd
         shell = target.data.get('run_in_shell', False)
         if shell:
             cmd = subprocess.list2cmdline(cmd)
         timeout = target.data.get('test_timeout')
         self._show_progress(cmd)
-        p = subprocess.Popen(cmd, env=test_env, cwd=run_dir, close_fds=True, shell=shell)
-        job_thread.set_job_data(p, test_name, timeout)
+        try:
+            # The output is not saved, never leave the log of the last run as of this run
+            os.remove(job.log_file)
+        except OSError:
+            pass
+        p = subprocess.Popen(cmd, env=test_env, cwd=job.run_dir, close_fds=True, shell=shell)
+        running_job = self._job_started(p, test_name, timeout)
         p.wait()
+        self._job_finished(running_job)
         result = self._get_result(p.returncode)
         console.info('//%s finished : %s\n' % (test_name, result))
 
         return p.returncode
 
+    def _prepare_job_env(self, target):
+        """Prepare the test environment, return None if failed. """
+        try:
+            return self.prepare_env(target)
+        except (EnvironmentError, SystemExit) as e:
+            # Some errors are reported by console.error_exit, don't let them kill the worker.
+            console.error('//%s: Prepare test environment error: %s' % (target.fullname, str(e)))
+        return None
+
     def _process_job(self, job, redirect, job_thread):
         """process routine.
 
-        Each test is a tuple (target, run_dir, env, cmd)
+        Each test is a TestRunJob
 
         """
-        target = job[0]
+        retried = False
+        try:
+            run_result = self._run_job_attempt(job, redirect, job_thread)
+            retried = self._record_run_result(job, run_result, job_thread.job_queue)
+        finally:
+            if not retried:
+                self._job_done(job_thread.job_queue)
+
+    def _run_job_attempt(self, job, redirect, job_thread):
+        """Run the test once, return the TestRunResult. """
+        target = job.target
+        prepare_start_time = time.time()
+        test_env = self._prepare_job_env(target)
+        if test_env is not None and job.env:
+            test_env = dict(test_env)
+            test_env.update(job.env)
         start_time = time.time()
+        prepare_time = start_time - prepare_start_time
 
-        try:
-            if redirect:
-                returncode = self._run_job_redirect(job, job_thread)
-            else:
-                returncode = self._run_job(job, job_thread)
-        except OSError as e:
-            console.error('//%s: Create test process error: %s' % (target.fullname, str(e)))
+        if test_env is None:
             returncode = 255
+        else:
+            try:
+                if redirect:
+                    returncode = self._run_job_redirect(job, test_env, job_thread)
+                else:
+                    returncode = self._run_job(job, test_env, job_thread)
+            except OSError as e:
+                console.error('//%s: Create test process error: %s' % (job.name, str(e)))
+                returncode = 255
 
         cost_time = time.time() - start_time
 
-        run_result = TestRunResult(exit_code=returncode,
-                                   start_time=start_time, cost_time=cost_time)
+        return TestRunResult(exit_code=returncode,
+                             start_time=start_time,
+                             cost_time=cost_time,
+                             prepare_time=prepare_time)
 
+    def _record_run_result(self, job, run_result, job_queue):
+        """Record the result of an attempt, return whether the test is retried.
+
+        A failed test is put back to the end of the queue to be retried, so it
+        will be ran by the first idle worker after other pending tests.
+        """
         with self.run_result_lock:
-            if returncode == 0:
-                self.passed_run_results[target.key] = run_result
+            if job.name in self._cancelled_tests:
+                return False
+            attempts = self.attempts.setdefault(job.key, [])
+            attempts.append(run_result)
+            if (run_result.exit_code != 0 and len(attempts) <= self.max_retries and
+                    not self._cancelled):
+                console.warning('//%s failed, retry %d/%d' % (
+                    job.name, len(attempts), self.max_retries))
+                job_queue.put(job)
+                return True
+            if run_result.exit_code == 0:
+                self.passed_run_results[job.key] = run_result
             else:
-                self.failed_run_results[target.key] = run_result
+                self.failed_run_results[job.key] = run_result
             self.num_of_ran_tests += 1
-
-    def _join_thread(self, t):
-        """Join thread and keep signal awareable"""
-        # The Thread.join without timeout will block signals, which makes
-        # blade can't be terminated by Ctrl-C
-        while t.isAlive():
-            t.join(1)
-
-    def _wait_worker_threads(self, threads):
-        """Wait for worker threads to complete. """
-        test_timeout = config.get_item('global_config', 'test_timeout')
+            if (self.fail_fast and not self._cancelled and
+                    len(self.failed_run_results) >= self.fail_fast):
+                console.error('%d tests failed, cancel all remaining tests' %
+                              len(self.failed_run_results))
+                self._cancel_all_jobs(job_queue)
+        return False
+
+    def _job_done(self, job_queue):
+        """Let the workers exit after all jobs in the queue are finished. """
+        with self.run_result_lock:
+            self._unfinished_jobs -= 1
+            if self._unfinished_jobs == 0:
+                for i in range(self._num_of_workers):
+                    job_queue.put(None)
+
+    def _kill_expired_jobs(self, now):
+        """Terminate all jobs whose deadline passed, return the nearest deadline. """
+        while self._deadlines:
+            running_job = self._deadlines[0]
+            if running_job.finished:
+                heapq.heappop(self._deadlines)
+                continue
+            if running_job.deadline > now:
+                return running_job.deadline
+            heapq.heappop(self._deadlines)
+            console.error('//%s: TIMEOUT\n' % running_job.name)
+            try:
+                running_job.process.terminate()
+            except OSError:
+                pass  # Already exited
+        return None
+
+    def _wait_worker_threads(self, threads, job_queue):
+        """Wait for worker threads to complete.
+
+        job_queue: the queue being processed, from which the workers will get
+                   the end sentinels.
+        """
         try:
-            while threads:
-                time.sleep(1)  # Check every second
-                now = time.time()
-                dead_threads = []
-                for t in threads:
-                    if t.isAlive():
-                        if test_timeout is not None:
-                            t.check_job_timeout(now)
-                    else:
-                        dead_threads.append(t)
-
-                for dt in dead_threads:
-                    threads.remove(dt)
+            with self._event:
+                while self._alive_workers:
+                    now = time.time()
+                    deadline = self._kill_expired_jobs(now)
+                    wait_time = _MAX_WAIT_TIME
+                    if deadline is not None:
+                        wait_time = min(deadline - now, wait_time)
+                    self._event.wait(wait_time)
         except KeyboardInterrupt:
             console.debug('KeyboardInterrupt: Terminate workers...')
-            for t in threads:
-                t.terminate()
+            self._cancelled = True
+            self._cancel_pending_jobs(self.job_queue, 0)
+            self._cancel_pending_jobs(self.exclusive_job_queue, 0)
+            for i in range(len(threads)):
+                job_queue.put(None)
             raise
 
+    def _cancel_pending_jobs(self, job_queue, num_of_workers):
+        """Discard all pending jobs in the queue and let the workers exit. """
+        try:
+            while True:
+                job_queue.get_nowait()
+        except queue.Empty:
+            pass
+        for i in range(num_of_workers):
+            job_queue.put(None)
+
+    def _start_workers(self, job_queue, first_id, num_of_workers, redirect):
+        """Start workers, each of which exits after its got the end sentinel. """
+        threads = []
+        self._unfinished_jobs = job_queue.qsize()
+        self._num_of_workers = num_of_workers
+        if self._unfinished_jobs == 0:
+            for i in range(num_of_workers):
+                job_queue.put(None)
+        for i in range(num_of_workers):
+            t = WorkerThread(first_id + i, job_queue, self._process_job, redirect, self)
+            # Don't block the interpreter exit on Ctrl-C
+            t.daemon = True
+            with self._event:
+                self._alive_workers.add(t)
+            t.start()
+            threads.append(t)
+        return threads
+
     def schedule_jobs(self):
         """scheduler. """
         if not self.tests_list:
@@ -276,26 +489,23 @@ class TestScheduler(object):
         console.info('spawn %d worker(s) to run tests' % num_of_workers)
 
         for i in self.tests_list:
-            target = i[0]
-            if target.data.get('exclusive'):
+            if i.target.data.get('exclusive'):
                 self.exclusive_job_queue.put(i)
             else:
                 self.job_queue.put(i)
         quiet = console.verbosity_le('quiet')
         redirect = num_of_workers > 1 or quiet
-        threads = []
-        for i in range(num_of_workers):
-            t = WorkerThread(i, self.job_queue, self._process_job, redirect)
-            t.start()
-            threads.append(t)
-        self._wait_worker_threads(threads)
+        threads = self._start_workers(self.job_queue, 0, num_of_workers, redirect)
+        self._wait_worker_threads(threads, self.job_queue)
 
         if not self.exclusive_job_queue.empty():
             console.info('spawn 1 worker to run exclusive tests')
-            last_t = WorkerThread(num_of_workers, self.exclusive_job_queue,
-                                  self._process_job, quiet)
-            last_t.start()
-            self._wait_worker_threads([last_t])
+            threads = self._start_workers(self.exclusive_job_queue, num_of_workers, 1, quiet)
+            self._wait_worker_threads(threads, self.exclusive_job_queue)
 
     def get_results(self):
         return self.passed_run_results, self.failed_run_results
+
+    def get_attempts(self):
+        """Results of all attempts of each test, dict{key, [TestRunResult]}. """
+        return self.attempts
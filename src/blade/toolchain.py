@@ -27,6 +27,7 @@ from __future__ import absolute_import
 from __future__ import print_function
 
 import getpass
+import gzip
 import os
 import shutil
 import socket
@@ -67,9 +68,19 @@ def parse_command_line(argv):
     return options, args
 
 
+def _scm_build_info():
+    """Return the build time, builder and host name to be embedded. """
+    epoch = blade_util.source_date_epoch()
+    if epoch is not None:
+        # Don't embed volatile information in reproducible builds
+        return time.asctime(time.gmtime(epoch)), 'unknown', 'unknown'
+    return time.asctime(), getpass.getuser(), socket.gethostname()
+
+
 def generate_scm(scm, revision, url, profile, compiler, args):
     """Generate `scm.c` file"""
     version = '%s@%s' % (url, revision)
+    build_time, builder, host = _scm_build_info()
     with open(scm, 'w') as f:
         f.write(textwrap.dedent(r'''\
                 /* This file was generated by blade */
@@ -87,12 +98,99 @@ def generate_scm(scm, revision, url, profile, compiler, args):
                 }}''') % (version,
                           version,
                           profile,
-                          time.asctime(),
-                          getpass.getuser(),
-                          socket.gethostname(),
+                          build_time,
+                          builder,
+                          host,
                           compiler))
 
 
+# In the late version stamping mode, all scm info is in this section of the binary,
+# and is patched after linking. Each field is a fixed size and NUL padded string.
+_SCM_SECTION = '.blade_scm'
+_SCM_SECTION_FIELDS = [
+    ('kBladeScmVersion', 2048),
+    ('kBuildType', 32),
+    ('kBuildTime', 64),
+    ('kBuilderName', 64),
+    ('kHostName', 256),
+    ('kCompiler', 256),
+]
+
+
+def _scm_section_content(values):
+    """Return the content of the scm section, values is {field: value}. """
+    content = []
+    for name, size in _SCM_SECTION_FIELDS:
+        value = values.get(name, '').encode('utf-8')[:size - 1]
+        content.append(value + b'\0' * (size - len(value)))
+    return b''.join(content)
+
+
+def _asm_string(data):
+    """Escape bytes as the string of the `.ascii` assembler directive. """
+    chars = []
+    for c in bytearray(data):
+        if 32 <= c < 127 and chr(c) not in '"\\':
+            chars.append(chr(c))
+        else:
+            chars.append('\\%03o' % c)
+    return ''.join(chars)
+
+
+def generate_scm_placeholder(scm, args):
+    """Generate `scm_placeholder.cc` file for the late version stamping.
+
+    The scm info is defined in the scm section by assembly, so the fields are in
+    a fixed layout. Keep the symbols same as the `scm.cc` file.
+    """
+    content = _scm_section_content(dict((name, 'unknown') for name, size in _SCM_SECTION_FIELDS))
+    asm = ['.pushsection %s,"a",@progbits' % _SCM_SECTION]
+    offset = 0
+    for name, size in _SCM_SECTION_FIELDS:
+        asm += [
+            '.globl %s' % name,
+            '.type %s, @object' % name,
+            '.size %s, %d' % (name, size),
+            '%s:' % name,
+            '.ascii "%s"' % _asm_string(content[offset:offset + size]),
+        ]
+        offset += size
+    asm.append('.popsection')
+    with open(scm, 'w') as f:
+        f.write(textwrap.dedent('''\
+                /* This file was generated by blade */
+                extern "C" {
+                namespace binary_version {
+                %s
+                asm(
+                %s
+                );
+                extern const int kSvnInfoCount = 1;
+                extern const char* const kSvnInfo[] = {kBladeScmVersion};
+                extern const int kScmInfoCount = 1;
+                extern const char* const kScmInfo[] = {kBladeScmVersion};
+                }}
+                ''') % (
+                    '\n'.join('extern const char %s[];' % name for name, size in _SCM_SECTION_FIELDS),
+                    '\n'.join('"%s\\n"' % line.replace('\\', '\\\\').replace('"', '\\"')
+                              for line in asm)))
+
+
+def generate_scm_section(section, revision, url, profile, compiler, args):
+    """Generate the content of the scm section to be patched into binaries. """
+    build_time, builder, host = _scm_build_info()
+    content = _scm_section_content({
+        'kBladeScmVersion': '%s@%s\n' % (url, revision),
+        'kBuildType': profile,
+        'kBuildTime': build_time,
+        'kBuilderName': builder,
+        'kHostName': host,
+        'kCompiler': compiler,
+    })
+    with open(section, 'wb') as f:
+        f.write(content)
+
+
 _PACKAGE_MANIFEST = 'MANIFEST.TXT'
 
 
@@ -107,8 +205,9 @@ def archive_package_sources(package, sources, destinations):
 
 def generate_zip_package(path, sources, destinations):
     zip = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
-    manifest = archive_package_sources(zip.write, sources, destinations)
-    zip.writestr(_PACKAGE_MANIFEST, '\n'.join(manifest) + '\n')
+    manifest = archive_package_sources(
+            lambda src, dst: blade_util.zip_write(zip, src, dst), sources, destinations)
+    blade_util.zip_writestr(zip, _PACKAGE_MANIFEST, '\n'.join(manifest) + '\n')
     zip.close()
 
 
@@ -121,16 +220,40 @@ _TAR_WRITE_MODES = {
 }
 
 
+def _reproducible_tar_filter(epoch):
+    """Return the filter of tar members which normalizes the timestamp and ownership. """
+    def tar_filter(tarinfo):
+        tarinfo.mtime = epoch
+        tarinfo.uid = tarinfo.gid = 0
+        tarinfo.uname = tarinfo.gname = ''
+        return tarinfo
+    return tar_filter
+
+
 def generate_tar_package(path, sources, destinations, suffix):
     mode = _TAR_WRITE_MODES[suffix]
-    tar = tarfile.open(path, mode, dereference=True)
-    manifest = archive_package_sources(tar.add, sources, destinations)
+    epoch = blade_util.source_date_epoch()
+    tar_filter = None
+    gz = None
+    if epoch is not None:
+        tar_filter = _reproducible_tar_filter(epoch)
+        if mode == 'w:gz':
+            # The gzip header contains a timestamp too
+            gz = gzip.GzipFile(path, 'wb', mtime=epoch)
+    if gz:
+        tar = tarfile.open(mode='w', fileobj=gz, dereference=True)
+    else:
+        tar = tarfile.open(path, mode, dereference=True)
+    manifest = archive_package_sources(
+            lambda src, dst: tar.add(src, dst, filter=tar_filter), sources, destinations)
     manifest_path = '%s.MANIFEST' % path
     m = open(manifest_path, 'w')
     m.write('\n'.join(manifest) + '\n\n')
     m.close()
-    tar.add(manifest_path, _PACKAGE_MANIFEST)
+    tar.add(manifest_path, _PACKAGE_MANIFEST, filter=tar_filter)
     tar.close()
+    if gz:
+        gz.close()
 
 
 def generate_package(args):
@@ -161,6 +284,23 @@ def generate_securecc_object(args):
             shutil.copy(phony_obj, obj)
 
 
+def generate_unity(args):
+    """Generate the unity source which includes all sources to be compiled together.
+
+    It is also used to generate the stub header of a precompiled header.
+    The file is not rewritten if its content is not changed, to avoid recompiling.
+    """
+    unity, sources = args[0], args[1:]
+    content = '// This file was generated by blade\n%s' % ''.join(
+        '#include "%s"\n' % src for src in sources)
+    if os.path.exists(unity):
+        with open(unity) as f:
+            if f.read() == content:
+                return
+    with open(unity, 'w') as f:
+        f.write(content)
+
+
 def _generate_resource_index(targets, sources, name, path):
     """Generate resource index description file for a cc resource library"""
     header, source = targets
@@ -247,10 +387,15 @@ def generate_java_jar(args):
 
     if classes_jar:
         shutil.copy2(classes_jar, target)
+        ret = 0
         if resources:
-            return archive_resources(resources_dir, resources, False)
+            ret = archive_resources(resources_dir, resources, False)
     else:
-        return archive_resources(resources_dir, resources, True)
+        ret = archive_resources(resources_dir, resources, True)
+    epoch = blade_util.source_date_epoch()
+    if not ret and epoch is not None:
+        blade_util.normalize_zip(target, epoch)
+    return ret
 
 
 def generate_java_resource(args):
@@ -279,6 +424,13 @@ def _get_all_test_class_names_in_jar(jar):
     return test_class_names
 
 
+def _write_test_class_names(script, test_class_names):
+    """Write test class names into a file, which is used to split the test into shards. """
+    with open('%s.test_classes' % script, 'w') as f:
+        for name in test_class_names:
+            print(name, file=f)
+
+
 def _jacoco_test_coverage_flag(jacocoagent, packages_under_test):
     if packages_under_test and jacocoagent:
         jacocoagent = os.path.abspath(jacocoagent)
@@ -294,7 +446,8 @@ def _jacoco_test_coverage_flag(jacocoagent, packages_under_test):
 def generate_java_test(script, main_class, jacocoagent, packages_under_test, args):
     jars = args
     test_jar = jars[0]
-    test_classes = ' '.join(_get_all_test_class_names_in_jar(test_jar))
+    test_class_names = _get_all_test_class_names_in_jar(test_jar)
+    _write_test_class_names(script, test_class_names)
     with open(script, 'w') as f:
         coverage_flags = _jacoco_test_coverage_flag(jacocoagent, packages_under_test)
         f.write(textwrap.dedent('''\
@@ -305,8 +458,14 @@ def generate_java_test(script, main_class, jacocoagent, packages_under_test, arg
                     coverage_options="%s"
                 fi
 
-                exec java $coverage_options -classpath %s %s %s $@''') % (
-                coverage_flags, ':'.join(jars), main_class, test_classes))
+                # Run a part of test classes if it is a shard
+                test_classes="%s"
+                if [ -n "$BLADE_TEST_CLASSES" ]; then
+                    test_classes="$BLADE_TEST_CLASSES"
+                fi
+
+                exec java $coverage_options -classpath %s %s $test_classes $@''') % (
+                coverage_flags, ' '.join(test_class_names), ':'.join(jars), main_class))
     os.chmod(script, 0o755)
 
 
@@ -329,16 +488,15 @@ def generate_one_jar(onejar, main_class, bootjar, args):
     name_list = zip_file.namelist()
     for name in name_list:
         if not name.lower().endswith('manifest.mf'):  # Exclude manifest
-            onejar.writestr(name, zip_file.read(name))
+            blade_util.zip_writestr(onejar, name, zip_file.read(name))
             jar_path_set.add(name)
     zip_file.close()
 
     # Main jar and dependencies
-    onejar.write(main_jar, os.path.join('main',
-                                        os.path.basename(main_jar)))
+    blade_util.zip_write(onejar, main_jar, os.path.join('main', os.path.basename(main_jar)))
     for dep in jars:
         dep_name = os.path.basename(dep)
-        onejar.write(dep, os.path.join('lib', dep_name))
+        blade_util.zip_write(onejar, dep, os.path.join('lib', dep_name))
 
     # Copy resources to the root of target onejar
     for jar in [main_jar] + jars:
@@ -349,21 +507,30 @@ def generate_one_jar(onejar, main_class, bootjar, args):
                 continue
             if name not in jar_path_set:
                 jar_path_set.add(name)
-                onejar.writestr(name, jar.read(name))
+                blade_util.zip_writestr(onejar, name, jar.read(name))
         jar.close()
 
     # Manifest
     # Note that the manifest file must end with a new line or carriage return
-    onejar.writestr(os.path.join('META-INF', 'MANIFEST.MF'),
-                    textwrap.dedent('''\
-                            Manifest-Version: 1.0
-                            Main-Class: com.simontuffs.onejar.Boot
-                            One-Jar-Main-Class: %s
+    blade_util.zip_writestr(onejar, os.path.join('META-INF', 'MANIFEST.MF'),
+                            textwrap.dedent('''\
+                                    Manifest-Version: 1.0
+                                    Main-Class: com.simontuffs.onejar.Boot
+                                    One-Jar-Main-Class: %s
 
-                            ''') % main_class)
+                                    ''') % main_class)
     onejar.close()
 
 
+def normalize_zip(args):
+    """Normalize the timestamps of zip files generated by other tools in reproducible builds. """
+    epoch = blade_util.source_date_epoch()
+    if epoch is None:
+        return
+    for path in args:
+        blade_util.normalize_zip(path, epoch)
+
+
 def generate_java_binary(args):
     script, onejar = args
     basename = os.path.basename(onejar)
@@ -387,12 +554,12 @@ def generate_scala_test(script, java, scala, jacocoagent, packages_under_test, a
     jars = args
     test_jar = jars[0]
     test_class_names = _get_all_test_class_names_in_jar(test_jar)
+    _write_test_class_names(script, test_class_names)
     scala, java = os.path.abspath(scala), os.path.abspath(java)
     java_args = ''
     coverage_flags = _jacoco_test_coverage_flag(jacocoagent, packages_under_test)
     if coverage_flags:
         java_args = '-J%s' % coverage_flags
-    run_args = 'org.scalatest.run ' + ' '.join(test_class_names)
     with open(script, 'w') as f:
         text = textwrap.dedent('''\
                 #!/bin/sh
@@ -402,8 +569,14 @@ def generate_scala_test(script, java, scala, jacocoagent, packages_under_test, a
                     coverage_options="%s"
                 fi
 
-                JAVACMD=%s exec %s "$coverage_options" -classpath %s %s $@
-                ''') % (java_args, java, scala, ':'.join(jars), run_args)
+                # Run a part of test classes if it is a shard
+                test_classes="%s"
+                if [ -n "$BLADE_TEST_CLASSES" ]; then
+                    test_classes="$BLADE_TEST_CLASSES"
+                fi
+
+                JAVACMD=%s exec %s "$coverage_options" -classpath %s org.scalatest.run $test_classes $@
+                ''') % (java_args, ' '.join(test_class_names), java, scala, ':'.join(jars))
         f.write(text)
     os.chmod(script, 0o755)
 
@@ -424,16 +597,17 @@ def generate_shell_test(args):
     os.chmod(wrapper, 0o755)
 
 
-def generate_shell_testdata(args):
+def generate_shell_testdata(args, modes=''):
     path = args[0]
     testdata = args[1:]
     assert len(testdata) % 2 == 0
-    middle = len(testdata) / 2
+    middle = len(testdata) // 2
     sources = testdata[:middle]
     destinations = testdata[middle:]
+    modes = modes.split(',') if modes else [''] * middle
     with open(path, 'w') as f:
         for i in range(middle):
-            f.write('%s %s\n' % (os.path.abspath(sources[i]), destinations[i]))
+            f.write(('%s %s %s' % (os.path.abspath(sources[i]), destinations[i], modes[i])).rstrip() + '\n')
 
 
 def generate_python_library(pylib, basedir, args):
@@ -464,7 +638,7 @@ def _pybin_add_pylib(pybin, libname, dirs, dirs_with_init_py):
         for libsrc, digest in data['srcs']:
             arcname = os.path.relpath(libsrc, pylib_base_dir)
             _update_init_py_dirs(arcname, dirs, dirs_with_init_py)
-            pybin.write(libsrc, arcname)
+            blade_util.zip_write(pybin, libsrc, arcname)
 
 
 def _pybin_add_zip(pybin, libname, filter, dirs, dirs_with_init_py):
@@ -474,7 +648,7 @@ def _pybin_add_zip(pybin, libname, filter, dirs, dirs_with_init_py):
             if filter(name):
                 if dirs is not None and dirs_with_init_py is not None:
                     _update_init_py_dirs(name, dirs, dirs_with_init_py)
-                pybin.writestr(name, lib.read(name))
+                blade_util.zip_writestr(pybin, name, lib.read(name))
 
 
 def _pybin_add_egg(pybin, libname):
@@ -513,8 +687,8 @@ def generate_python_binary(pybin, basedir, mainentry, args):
     # Insert __init__.py into each dir if missing
     dirs_missing_init_py = dirs - dirs_with_init_py
     for dir in sorted(dirs_missing_init_py):
-        pybin_zip.writestr(os.path.join(dir, '__init__.py'), '')
-    pybin_zip.writestr('__init__.py', '')
+        blade_util.zip_writestr(pybin_zip, os.path.join(dir, '__init__.py'), '')
+    blade_util.zip_writestr(pybin_zip, '__init__.py', '')
     pybin_zip.close()
 
     with open(pybin, 'rb') as f:
@@ -531,8 +705,11 @@ def generate_python_binary(pybin, basedir, mainentry, args):
 
 toolchains = {
     'scm': generate_scm,
+    'scm_placeholder': generate_scm_placeholder,
+    'scm_section': generate_scm_section,
     'package': generate_package,
     'securecc_object': generate_securecc_object,
+    'unity': generate_unity,
     'resource_index': generate_resource_index,
     'java_jar': generate_java_jar,
     'java_resource': generate_java_resource,
@@ -545,6 +722,7 @@ toolchains = {
     'shell_testdata': generate_shell_testdata,
     'python_library': generate_python_library,
     'python_binary': generate_python_binary,
+    'normalize_zip': normalize_zip,
 }
 
 
@@ -0,0 +1,190 @@
+# Copyright (c) 2020 Tencent Inc.
+# All rights reserved.
+#
+# Date:   April 20, 2020
+
+
+"""
+ This is the file watcher module of the watch mode, which waits for the
+ changes of files in the watched dirs.
+
+ Inotify is used on linux, by ctypes to avoid any extra dependency, and the
+ dirs are polled on other systems. A burst of changes, such as saving many
+ files in an editor or switching a git branch, are merged into one change.
+
+"""
+
+from __future__ import absolute_import
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+from blade import console
+
+
+# Wait for so long after the last change to merge a burst of changes
+_DEBOUNCE_SECONDS = 0.3
+
+_POLL_INTERVAL = 1.0
+
+# Inotify constants in <sys/inotify.h>
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_Q_OVERFLOW = 0x00004000
+_IN_ONLYDIR = 0x01000000
+_IN_CLOEXEC = 0o2000000
+
+# IN_CREATE is for new dirs, new files are also reported by IN_CLOSE_WRITE
+_WATCH_MASK = (_IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE |
+               _IN_DELETE | _IN_DELETE_SELF | _IN_ONLYDIR)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+def _is_ignored(name):
+    """Hidden files, editor backups and swap files never affect the building. """
+    return (name.startswith('.') or name.startswith('#') or name.endswith('~') or
+            name.endswith(('.swp', '.swx')) or name == '4913')
+
+
+class _InotifyWatcher(object):
+    """Watch dirs by inotify. """
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = self._libc.inotify_init1(_IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+        self._wds = {}  # wd: dir
+
+    def set_dirs(self, dirs):
+        watched = set(self._wds.values())
+        for d in set(dirs) - watched:
+            wd = self._libc.inotify_add_watch(self._fd, d.encode('utf-8'), _WATCH_MASK)
+            if wd < 0:
+                console.debug('Failed to watch %s: %s' % (d, os.strerror(ctypes.get_errno())))
+                continue
+            self._wds[wd] = d
+        for wd, d in list(self._wds.items()):
+            if d not in dirs:
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._wds[wd]
+
+    def read(self, timeout):
+        """Return the changed paths in the timeout, None means too many changes to tell. """
+        if not select.select([self._fd], [], [], timeout)[0]:
+            return set()
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return set()
+            raise
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b'\0').decode('utf-8', 'replace')
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                return None
+            d = self._wds.get(wd)
+            if d is None:
+                continue
+            if mask & _IN_DELETE_SELF:
+                changed.add(d)
+            elif name and not _is_ignored(name):
+                changed.add(os.path.normpath(os.path.join(d, name)))
+        return changed
+
+    def close(self):
+        os.close(self._fd)
+
+
+class _PollingWatcher(object):
+    """Watch dirs by comparing the stats of files periodically. """
+
+    def __init__(self):
+        self._dirs = set()
+        self._stats = {}
+
+    def _scan(self, d):
+        stats = {}
+        try:
+            names = os.listdir(d)
+        except OSError:
+            return stats
+        for name in names:
+            if _is_ignored(name):
+                continue
+            path = os.path.normpath(os.path.join(d, name))
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            stats[path] = (st.st_mtime, st.st_size)
+        return stats
+
+    def set_dirs(self, dirs):
+        self._dirs = set(dirs)
+        self._stats = {}
+        for d in self._dirs:
+            self._stats.update(self._scan(d))
+
+    def read(self, timeout):
+        time.sleep(min(timeout, _POLL_INTERVAL))
+        stats = {}
+        for d in self._dirs:
+            stats.update(self._scan(d))
+        changed = set(path for path in set(stats) | set(self._stats)
+                      if stats.get(path) != self._stats.get(path))
+        self._stats = stats
+        return changed
+
+    def close(self):
+        pass
+
+
+class FileWatcher(object):
+    """Wait for changes of files in the watched dirs. """
+
+    def __init__(self):
+        try:
+            self._watcher = _InotifyWatcher()
+        except (AttributeError, OSError, TypeError):
+            console.debug('Inotify is not available, watch files by polling')
+            self._watcher = _PollingWatcher()
+
+    def set_dirs(self, dirs):
+        """Set the dirs to be watched, the changes of files in their subdirs are ignored. """
+        self._watcher.set_dirs(set(d for d in map(os.path.normpath, dirs) if os.path.isdir(d)))
+
+    def wait(self):
+        """Wait for changes, return the changed paths, or None if they are unknown. """
+        changed = set()
+        while not changed:
+            changed = self._watcher.read(3600)
+            if changed is None:
+                return None
+        # Merge the following changes until it is quiet
+        while True:
+            more = self._watcher.read(_DEBOUNCE_SECONDS)
+            if more is None:
+                return None
+            if not more:
+                return changed
+            changed |= more
+
+    def close(self):
+        self._watcher.close()
@@ -0,0 +1,89 @@
+# Copyright (c) 2020 Tencent Inc.
+# All rights reserved.
+#
+# Date:   April 24, 2020
+
+
+"""
+ This is the test module for the runfiles of the binary runner.
+
+"""
+
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append('..')
+from blade import binary_runner
+from blade import build_manager
+
+
+class _BuildManager(object):
+    def get_build_path(self):
+        return 'build64_release'
+
+
+class _Target(object):
+    def __init__(self, testdata):
+        self.path = 'foo'
+        self.name = 'foo_test'
+        self.fullname = 'foo:foo_test'
+        self.expanded_deps = []
+        self.data = {'testdata': testdata}
+
+
+class TestRunfiles(unittest.TestCase):
+    """Test that the reused runfiles dir is restored before every run. """
+    def setUp(self):
+        """setup method. """
+        self.cur_dir = os.getcwd()
+        self.root_dir = tempfile.mkdtemp()
+        os.chdir(self.root_dir)
+        os.makedirs('foo/dir')
+        os.makedirs('build64_release/foo')
+        for path in ('foo/data.txt', 'foo/dir/a.txt'):
+            with open(path, 'w') as f:
+                f.write('data\n')
+        self.saved_instance = build_manager.instance
+        build_manager.instance = _BuildManager()
+        self.runner = binary_runner.BinaryRunner([], None, {})
+        self.runfiles_dir = 'build64_release/foo/foo_test.runfiles'
+
+    def tearDown(self):
+        """tear down method. """
+        build_manager.instance = self.saved_instance
+        os.chdir(self.cur_dir)
+        shutil.rmtree(self.root_dir)
+
+    def _path(self, name):
+        return os.path.join(self.runfiles_dir, name)
+
+    def testRestoreRunfiles(self):
+        """Test that removed or modified runfiles are placed again, and others are kept. """
+        target = _Target(['data.txt', ('dir', 'sub/dd', 'hardlink'),
+                          ('data.txt', 'copied.txt', 'copy'), ('data.txt', 'kept.txt', 'copy')])
+        self.runner._prepare_runfiles(target)
+        self.assertTrue(os.path.islink(self._path('data.txt')))
+        kept_inode = os.stat(self._path('kept.txt')).st_ino
+
+        shutil.rmtree(self._path('sub'))
+        os.remove(self._path('data.txt'))
+        with open(self._path('copied.txt'), 'a') as f:
+            f.write('modified\n')
+        with open(self._path('new.txt'), 'w') as f:
+            f.write('new\n')
+        self.runner._prepare_runfiles(target)
+
+        self.assertTrue(os.path.islink(self._path('data.txt')))
+        self.assertTrue(os.path.samefile('foo/dir/a.txt', self._path('sub/dd/a.txt')))
+        with open(self._path('copied.txt')) as f:
+            self.assertEqual('data\n', f.read())
+        self.assertEqual(kept_inode, os.stat(self._path('kept.txt')).st_ino)
+        self.assertFalse(os.path.exists(self._path('new.txt')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -16,12 +16,15 @@ import sys
 import unittest
 
 sys.path.append('..')
+from binary_runner_test import TestRunfiles
 from cc_binary_test import TestCcBinary
 from cc_library_test import TestCcLibrary
 from cc_plugin_test import TestCcPlugin
 from cc_test_test import TestCcTest
+from fast_build_test import TestFastBuild
 from gen_rule_test import TestGenRule
 from java_test import TestJava
+from job_controller_test import TestJobController
 from lex_yacc_test import TestLexYacc
 from load_builds_test import TestLoadBuilds
 from proto_library_test import TestProtoLibrary
@@ -30,6 +33,9 @@ from query_target_test import TestQuery
 from resource_library_test import TestResourceLibrary
 from swig_library_test import TestSwigLibrary
 from target_dependency_test import TestDepsAnalyzing
+from test_cache_test import TestTestCache
+from test_scheduler_test import TestTestScheduler
+from watcher_test import TestFileWatcher
 
 from html_test_runner import HTMLTestRunner
 from test_target_test import TestTestRunner
@@ -53,7 +59,13 @@ def _main():
         unittest.defaultTestLoader.loadTestsFromTestCase(TestDepsAnalyzing),
         unittest.defaultTestLoader.loadTestsFromTestCase(TestQuery),
         unittest.defaultTestLoader.loadTestsFromTestCase(TestTestRunner),
-        unittest.defaultTestLoader.loadTestsFromTestCase(TestPrebuildCcLibrary)
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestPrebuildCcLibrary),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestTestCache),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestJobController),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestFastBuild),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestFileWatcher),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestTestScheduler),
+        unittest.defaultTestLoader.loadTestsFromTestCase(TestRunfiles),
         ])
 
     generate_html = len(sys.argv) > 1 and sys.argv[1].startswith('html')
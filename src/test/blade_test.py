@@ -42,14 +42,19 @@ class TargetTest(unittest.TestCase):
 
     def tearDown(self):
         """tear down method. """
-        try:
-            os.remove(self.build_output_file)
-            os.remove('./build.ninja')
-        except OSError:
-            pass
+        for path in (self.build_output_file, './build.ninja', 'BLADE_ROOT.local'):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
         os.chdir(self.cur_dir)
 
+    def writeLocalConfig(self, content):
+        """Write the BLADE_ROOT.local config file, which is removed in tearDown. """
+        with open('BLADE_ROOT.local', 'w') as f:
+            f.write(content)
+
     def dryRun(self, extra_args=''):
         # We can use pipe to capture stdout, but keep the output file make it
         # easy debugging.
@@ -66,6 +71,21 @@ class TargetTest(unittest.TestCase):
             sys.stderr.write('Failed while dry running:\n%s\n' % str(sys.exc_info()))
         return False
 
+    def generateRules(self):
+        """Generate the build script, return the variables of its rules by the rule names. """
+        self.assertTrue(self.dryRun('--stop-after=generate'))
+        rules, variables = {}, {}
+        with io.open('build.ninja', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('rule '):
+                    variables = rules.setdefault(line.split()[1], {})
+                elif line.startswith('  ') and ' = ' in line:
+                    name, value = line.strip().split(' = ', 1)
+                    variables[name] = value
+                else:
+                    variables = {}  # Variables of builds and pools
+        return rules
+
     def printOutput(self):
         """Helper method for debugging"""
         print(''.join(self.build_output))
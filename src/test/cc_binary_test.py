@@ -37,6 +37,60 @@ class TestCcBinary(blade_test.TargetTest):
         self.assertIn('liblowercase.a', string_main_depends_libs)
         self.assertIn('libuppercase.a', string_main_depends_libs)
 
+    def testLateVersionStamping(self):
+        """Test that the scm info is stamped into a copy of the linked binary. """
+        self.writeLocalConfig("cc_binary_config(version_stamping='late')\n")
+        self.assertTrue(self.dryRun())
+
+        link_line = self.findCommand(['-o build64_release/test_cc_binary/string_main_prog.unstamped '])
+        stamp_line = self.findCommand(['objcopy', '--update-section'])
+
+        self.assertIn('scm_placeholder.cc.o', link_line)
+        self.assertNotIn('scm.cc.o', link_line)
+        self.assertIn('.blade_scm=build64_release/scm.section', stamp_line)
+        self.assertIn('test_cc_binary/string_main_prog.unstamped '
+                      'build64_release/test_cc_binary/string_main_prog', stamp_line)
+
+    def testSplitDwarf(self):
+        """Test that the .dwo files are packaged into the .dwp file of the binary. """
+        self.writeLocalConfig("cc_config(split_dwarf=True, dwp='llvm-dwp')\n")
+        self.assertTrue(self.dryRun())
+
+        com_string_line = self.findCommand(['string_main.cpp.o', '-c'])
+        dwp_line = self.findCommand(['llvm-dwp'])
+
+        self.assertIn('-gsplit-dwarf', com_string_line)
+        self.assertIn('-e build64_release/test_cc_binary/string_main_prog '
+                      '-o build64_release/test_cc_binary/string_main_prog.dwp', dwp_line)
+
+    def testLinkPool(self):
+        """Test that the parallel links are limited by the link pool. """
+        self.writeLocalConfig("link_config(link_jobs=1)\n")
+        self.assertTrue(self.dryRun())
+
+        link_line = self.findCommand(['string_main_prog ', '-Wl,--whole-archive'])
+
+        self.assertTrue(self.findCommand(['tunes the parallel link jobs to be 1']))
+        self.assertIn('liblowercase.a', link_line)
+
+    def testActionCacheCommand(self):
+        """Test that the command wrapped by the action cache is the same as the direct one. """
+        flags = ("cc_config(cppflags=['-DNAME=\\'\"blade\"\\''], "
+                 "linkflags=[\"-Wl,-rpath,'$$ORIGIN/../lib'\"])\n")
+        self.writeLocalConfig(flags)
+        direct_rules = self.generateRules()
+        self.writeLocalConfig(flags + "action_cache_config(enabled=True)\n")
+        cached_rules = self.generateRules()
+
+        for name in ('cc', 'cxx', 'ar', 'link'):
+            self.assertIn('-m blade.action_cache', cached_rules[name]['command'])
+            self.assertEqual(direct_rules[name]['command'], cached_rules[name]['rspfile_content'])
+        self.assertIn("""-DNAME='"blade"'""", cached_rules['cxx']['rspfile_content'])
+        # The link command is wrapped as it is, without quoting it again
+        link_command = direct_rules['link']['command']
+        self.assertIn('-m blade.job_controller', link_command)
+        self.assertIn(" -- g++ -o ${out} -Wl,-rpath,'$$ORIGIN/../lib' ${ldflags}", link_command)
+
 
 if __name__ == '__main__':
     blade_test.run(TestCcBinary)
@@ -11,6 +11,8 @@
 """
 
 
+import os
+
 import blade_test
 
 
@@ -45,6 +47,30 @@ class TestCcLibrary(blade_test.TargetTest):
         self.assertIn('liblowercase.so', string_depends_libs)
         self.assertIn('libuppercase.so', string_depends_libs)
 
+    def testPrecompiledHeader(self):
+        """Test that the pch is compiled once and included by the sources of the target. """
+        self.assertTrue(self.dryRun())
+
+        stub_line = self.findCommand(['blade.toolchain unity', 'pch_string.h'])
+        pch_line = self.findCommand(['-x c++-header', 'pch_string.h.gch'])
+        com_pch_line = self.findCommand(['-c', 'pch_string.cpp.o'])
+        com_string_line = self.findCommand(['-c', 'blade_string.cpp.o'])
+
+        self.assertTrue(stub_line.rstrip().endswith(' ../../../../test_cc_library/pch_string.h'))
+        self.assertTrue(pch_line.rstrip().endswith('/test_cc_library/pch_string.h'))
+        self.assertIn('-Winvalid-pch -include build64_release/pch/', com_pch_line)
+        self.assertNotIn('-Winvalid-pch', com_string_line)
+
+    def testReproducible(self):
+        """Test that the path of the workspace is mapped out of the outputs. """
+        self.writeLocalConfig("global_config(reproducible=True)\n")
+        self.assertTrue(self.dryRun())
+
+        com_string_line = self.findCommand(['-c', 'blade_string.cpp.o'])
+
+        self.assertIn('-fdebug-prefix-map=%s=.' % os.getcwd(), com_string_line)
+        self.assertIn('-ffile-prefix-map=%s=.' % os.getcwd(), com_string_line)
+
 
 if __name__ == '__main__':
     blade_test.run(TestCcLibrary)
@@ -11,6 +11,8 @@
 """
 
 
+import os
+
 import blade_test
 
 
@@ -37,6 +39,29 @@ class TestCcTest(blade_test.TargetTest):
         self.assertIn('liblowercase.a', string_main_depends_libs)
         self.assertIn('libuppercase.a', string_main_depends_libs)
 
+    def testSplitDwarf(self):
+        """Test that no .dwp file is generated for tests. """
+        self.writeLocalConfig("cc_config(split_dwarf=True, dwp='llvm-dwp')\n")
+        self.assertTrue(self.dryRun())
+
+        com_string_line = self.findCommand(['string_test.cpp.o', '-c'])
+
+        self.assertIn('-gsplit-dwarf', com_string_line)
+        self.assertFalse([line for line in self.build_output if 'llvm-dwp' in line])
+
+    def testUnityBuild(self):
+        """Test that the sources of a test opted in are compiled in one unity source. """
+        self.writeLocalConfig("cc_config(cppflags=['-DRATIO=100%'])\n")
+        self.assertTrue(self.dryRun())
+
+        unity_line = self.findCommand(['__unity_0.cc.o', '-c'])
+
+        self.assertIn('test_cc_test/unity_a.cpp test_cc_test/unity_b.cpp', unity_line)
+        self.assertIn('-DRATIO=100%', unity_line)
+        # The objects of the fallback are combined by the configured linker
+        self.assertIn(' %s -r -nostdlib -o ' % os.environ.get('LD', 'g++'), unity_line)
+        self.assertFalse([line for line in self.build_output if 'unity_a.cpp.o' in line])
+
 
 if __name__ == '__main__':
     blade_test.run(TestCcTest)
@@ -0,0 +1,117 @@
+# Copyright (c) 2020 Tencent Inc.
+# All rights reserved.
+#
+# Date:   April 22, 2020
+
+
+"""
+ This is the test module for the fast build path.
+
+"""
+
+
+import fcntl
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append('..')
+from blade import fast_build
+
+
+class _Exec(Exception):
+    pass
+
+
+class TestFastBuild(unittest.TestCase):
+    """Test that the retained build script is used only if nothing affects it. """
+    def setUp(self):
+        """setup method. """
+        self.cur_dir = os.getcwd()
+        self.blade_path = os.path.abspath('../../blade')
+        self.root_dir = os.path.realpath(tempfile.mkdtemp())
+        os.chdir(self.root_dir)
+        os.makedirs('build64_release')
+        os.makedirs('foo/data')
+        for path in ('BLADE_ROOT', 'foo/BUILD'):
+            with open(path, 'w') as f:
+                f.write('')
+        self.saved_execvp = os.execvp
+        os.execvp = self._execvp
+        self.executed = None
+
+    def tearDown(self):
+        """tear down method. """
+        os.execvp = self.saved_execvp
+        os.chdir(self.cur_dir)
+        shutil.rmtree(self.root_dir)
+
+    def _execvp(self, path, args):
+        if path != 'ninja':  # Used by subprocess of python 2
+            return self.saved_execvp(path, args)
+        # The workspace must be locked by the ninja to be executed
+        fd = os.open(os.path.join(self.root_dir, fast_build._LOCK_FILE), os.O_RDWR)
+        try:
+            self.assertRaises(IOError, fcntl.flock, fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        finally:
+            os.close(fd)
+        self.executed = args
+        raise _Exec()
+
+    def _save(self, expires=None):
+        with open('build.ninja', 'w') as f:
+            f.write('')
+        fast_build.save(self.blade_path, ['build', 'foo/...'], os.path.join(self.root_dir, 'foo'),
+                        'build64_release', ['BLADE_ROOT', 'foo/BUILD'], ['foo', 'foo/data'],
+                        ['ninja'], expires)
+
+    def _try_exec(self):
+        self.executed = None
+        os.chdir(os.path.join(self.root_dir, 'foo'))
+        try:
+            fast_build.try_exec(self.blade_path, ['build', 'foo/...'])
+        except _Exec:
+            pass
+        self.assertEqual(os.path.realpath(os.getcwd()), self.root_dir if self.executed else
+                         os.path.join(self.root_dir, 'foo'))
+        os.chdir(self.root_dir)
+        return self.executed
+
+    def testUnchanged(self):
+        """Test that the retained build script is executed with the workspace locked. """
+        self._save()
+        self.assertEqual(['ninja', '-f', 'build64_release/fast_build.ninja'], self._try_exec())
+
+    def testChanged(self):
+        """Test that any change of the recorded files and dirs makes the record stale. """
+        self._save()
+        with open('foo/data/new.txt', 'w') as f:
+            f.write('')
+        self.assertFalse(self._try_exec())
+
+        os.remove('foo/data/new.txt')
+        self._save()
+        with open('foo/BUILD', 'w') as f:
+            f.write('cc_library(name="foo")\n')
+        self.assertFalse(self._try_exec())
+
+    def testLockedOrExpired(self):
+        """Test that the whole pipeline is run when it is locked or expired. """
+        self._save(time.time() - 1)
+        self.assertFalse(self._try_exec())
+
+        self._save(time.time() + 3600)
+        fd = os.open(fast_build._LOCK_FILE, os.O_CREAT | os.O_RDWR)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            self.assertFalse(self._try_exec())
+        finally:
+            os.close(fd)
+        self.assertTrue(self._try_exec())
+
+
+if __name__ == '__main__':
+    unittest.main()
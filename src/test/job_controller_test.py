@@ -0,0 +1,91 @@
+# Copyright (c) 2020 Tencent Inc.
+# All rights reserved.
+#
+# Date:   April 10, 2020
+
+
+"""
+ This is the test module for the job controller.
+
+"""
+
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append('..')
+from blade import job_controller
+
+
+class TestJobController(unittest.TestCase):
+    """Test the sizing of parallel jobs. """
+    def setUp(self):
+        """setup method. """
+        self.build_dir = tempfile.mkdtemp()
+        self.saved_peak = job_controller.children_peak_memory
+        self.peak = None
+        job_controller.children_peak_memory = lambda: self.peak
+
+    def tearDown(self):
+        """tear down method. """
+        job_controller.children_peak_memory = self.saved_peak
+        shutil.rmtree(self.build_dir)
+
+    def _controller(self):
+        return job_controller.JobController(self.build_dir, 0, 0, None)
+
+    def _record_link(self, output, peak):
+        record_dir = job_controller.link_memory_dir(self.build_dir)
+        if not os.path.isdir(record_dir):
+            os.makedirs(record_dir)
+        with open(job_controller._link_memory_record(record_dir, output), 'w') as f:
+            json.dump([output, peak], f)
+
+    def testLoadOfLastBuildIsNotCounted(self):
+        """Test that the load remained from the last build is not counted as external. """
+        controller = self._controller()
+        self.assertEqual(8.0, controller._external_load(8.0))
+        now = time.time()
+        controller.update_history(now - 600, 8)
+        controller = self._controller()
+        self.assertLess(controller._external_load(8.0), 1.0)
+        controller._history['last_build'] = [now - 1200, now - 600, 8]
+        self.assertGreater(controller._external_load(8.0), 7.9)
+
+    def testLinkPeakIsNotJobMemory(self):
+        """Test that the peak memory of links is learned by the link pools only. """
+        controller = self._controller()
+        self._record_link('foo/bar', 4 * 1024 ** 3)
+        self.peak = 4 * 1024 ** 3
+        controller.update_history(time.time(), 8)
+        controller = self._controller()
+        self.assertEqual(job_controller._DEFAULT_JOB_MEMORY, controller.job_memory())
+        self.assertEqual({'foo/bar': 4 * 1024 ** 3}, controller._history['link_memory'])
+
+        self.peak = 1024 ** 3
+        controller.update_history(time.time(), 8)
+        self.assertEqual(1024 ** 3, self._controller().job_memory())
+
+    def testLinkPoolDepths(self):
+        """Test that the link pools are sized by the recorded link memory. """
+        saved_memory = job_controller.available_memory
+        job_controller.available_memory = lambda: 16 * 1024 ** 3
+        try:
+            controller = self._controller()
+            self.assertEqual((4, None), controller.link_pool_depths(8, 4, 8 * 1024 ** 3))
+            controller._history['link_memory'] = {'a': 4 * 1024 ** 3, 'b': 10 * 1024 ** 3}
+            link_depth, heavy_depth = controller.link_pool_depths(8, None, 8 * 1024 ** 3)
+            self.assertEqual((2, 1), (link_depth, heavy_depth))
+            self.assertTrue(controller.is_heavy_link('b'))
+            self.assertFalse(controller.is_heavy_link('a'))
+        finally:
+            job_controller.available_memory = saved_memory
+
+
+if __name__ == '__main__':
+    unittest.main()
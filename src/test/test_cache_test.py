@@ -0,0 +1,102 @@
+# Copyright (c) 2020 Tencent Inc.
+# All rights reserved.
+#
+# Date:   March 18, 2020
+
+
+"""
+ This is the test module for the test result cache.
+
+"""
+
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append('..')
+from blade import test_cache
+
+
+class TestTestCache(unittest.TestCase):
+    """Test the test cache key and the dir backend. """
+    def setUp(self):
+        """setup method. """
+        self.temp_dir = tempfile.mkdtemp()
+        self.digests_file = os.path.join(self.temp_dir, 'digests.json')
+        self.binary = self._write('binary', 'binary')
+        self.testdata = os.path.join(self.temp_dir, 'testdata')
+        os.mkdir(self.testdata)
+        self._write('testdata/a.txt', 'a')
+
+    def tearDown(self):
+        """tear down method. """
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, name, content, old=True):
+        path = os.path.join(self.temp_dir, name)
+        with open(path, 'w') as f:
+            f.write(content)
+        if old:  # Make the digest trustable to be saved
+            mtime = time.time() - 3600
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def _key(self, env=None, args=None, digests=None):
+        files = [('binary', self.binary), ('testdata', self.testdata)]
+        digests = digests or test_cache.FileDigests(self.digests_file)
+        return test_cache.calculate_key('foo:bar_test', files, env or {}, args or [], digests)
+
+    def testKeyChangesWithInputs(self):
+        """Test that the key changes with the content of any input. """
+        key = self._key()
+        self.assertEqual(key, self._key())
+        self.assertNotEqual(key, self._key(env={'LANG': 'C'}))
+        self.assertNotEqual(key, self._key(args=['--gtest_filter=*']))
+        self._write('testdata/a.txt', 'b')
+        self.assertNotEqual(key, self._key())
+        self._write('testdata/a.txt', 'a')
+        self.assertEqual(key, self._key())
+        self._write('testdata/b.txt', 'b')
+        self.assertNotEqual(key, self._key())
+
+    def testDigestsArePersisted(self):
+        """Test that unchanged files are not hashed again in the next run. """
+        digests = test_cache.FileDigests(self.digests_file)
+        key = self._key(digests=digests)
+        digests.save()
+        self.assertTrue(os.path.exists(self.digests_file))
+        digests = test_cache.FileDigests(self.digests_file)
+        saved = test_cache._file_digest
+        test_cache._file_digest = lambda path: self.fail('%s is hashed again' % path)
+        try:
+            self.assertEqual(key, self._key(digests=digests))
+        finally:
+            test_cache._file_digest = saved
+
+    def testRecentlyModifiedFilesAreNotPersisted(self):
+        """Test that the digests of just modified files are not trusted by stat. """
+        self._write('binary', 'new binary', old=False)
+        digests = test_cache.FileDigests(self.digests_file)
+        self.assertTrue(digests.digest(self.binary))
+        digests.save()
+        self.assertNotIn(self.binary, test_cache.FileDigests(self.digests_file)._digests)
+
+    def testDirectoryBackend(self):
+        """Test that a put result can be get. """
+        backend = test_cache.DirectoryTestCacheBackend(os.path.join(self.temp_dir, 'cache'))
+        key = self._key()
+        self.assertEqual(None, backend.get(key))
+        log = self._write('test.log', 'passed')
+        backend.put(key, {'cost_time': 1.0}, log)
+        result, cached_log = backend.get(key)
+        self.assertEqual(1.0, result['cost_time'])
+        with open(cached_log) as f:
+            self.assertEqual('passed', f.read())
+
+
+if __name__ == '__main__':
+    unittest.main()
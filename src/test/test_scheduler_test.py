@@ -0,0 +1,143 @@
+# Copyright (c) 2020 Tencent Inc.
+# All rights reserved.
+#
+# Date:   March 10, 2020
+
+
+"""
+ This is the test module for the test scheduler.
+
+"""
+
+
+import errno
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.append('..')
+from blade import test_scheduler
+
+
+class _Target(object):
+    def __init__(self, name, **data):
+        self.fullname = 'test:' + name
+        self.data = data
+
+
+class TestTestScheduler(unittest.TestCase):
+    """Test that tests are scheduled, ran and reported correctly. """
+    def setUp(self):
+        """setup method. """
+        self.run_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        """tear down method. """
+        shutil.rmtree(self.run_dir)
+
+    def _prepare_env(self, target):
+        if target.data.get('broken_env'):
+            raise EnvironmentError(errno.ENOENT, 'No such file or directory', 'testdata')
+        return dict(os.environ)
+
+    def _job(self, name, script, **data):
+        target = _Target(name, **data)
+        log_file = os.path.join(self.run_dir, name + '.log')
+        return test_scheduler.TestRunJob(key=('test', name), name=target.fullname, target=target,
+                                         run_dir=self.run_dir, log_file=log_file,
+                                         cmd=['sh', '-c', script], env=None)
+
+    def _schedule(self, jobs, num_jobs=2, **kwargs):
+        scheduler = test_scheduler.TestScheduler(jobs, num_jobs, self._prepare_env, **kwargs)
+        start_time = time.time()
+        scheduler.schedule_jobs()
+        self.assertLess(time.time() - start_time, 20)
+        return scheduler
+
+    def testResults(self):
+        """Test that the results of passed and failed tests are collected. """
+        jobs = [self._job('a', 'exit 0'), self._job('b', 'exit 1'),
+                self._job('c', 'exit 0', exclusive=True)]
+        passed, failed = self._schedule(jobs).get_results()
+        self.assertEqual(set([('test', 'a'), ('test', 'c')]), set(passed))
+        self.assertEqual([('test', 'b')], list(failed))
+        self.assertEqual(1, failed[('test', 'b')].exit_code)
+
+    def testPrepareError(self):
+        """Test that a test whose environment can't be prepared fails without running. """
+        jobs = [self._job('a', 'exit 0', broken_env=True), self._job('b', 'exit 0')]
+        passed, failed = self._schedule(jobs).get_results()
+        self.assertEqual([('test', 'b')], list(passed))
+        self.assertEqual(255, failed[('test', 'a')].exit_code)
+
+    def testLog(self):
+        """Test that the output of a test is written into its log, and the tail is read back. """
+        jobs = [self._job('a', 'seq 1 10; exit 1'), self._job('b', 'exit 0')]
+        self._schedule(jobs)
+        log_file = os.path.join(self.run_dir, 'a.log')
+        with open(log_file) as f:
+            self.assertEqual(''.join('%d\n' % i for i in range(1, 11)), f.read())
+        self.assertEqual(('8\n9\n10\n', True), test_scheduler._read_log_tail(log_file, 3))
+        self.assertEqual((''.join('%d\n' % i for i in range(1, 11)), False),
+                         test_scheduler._read_log_tail(log_file, 10))
+
+    def testNoStaleLog(self):
+        """Test that the log of the last run is removed when the output is not redirected. """
+        log_file = os.path.join(self.run_dir, 'a.log')
+        with open(log_file, 'w') as f:
+            f.write('stale\n')
+        self._schedule([self._job('a', 'exit 0')], num_jobs=1)
+        self.assertFalse(os.path.exists(log_file))
+
+    def testRetry(self):
+        """Test that a failed test is retried until it passed. """
+        jobs = [self._job('flaky', 'test -e flag || { touch flag; exit 1; }')]
+        scheduler = self._schedule(jobs, max_retries=2)
+        passed, failed = scheduler.get_results()
+        self.assertEqual([('test', 'flaky')], list(passed))
+        self.assertFalse(failed)
+        self.assertEqual([1, 0], [r.exit_code for r in scheduler.get_attempts()[('test', 'flaky')]])
+
+    def testTimeout(self):
+        """Test that a test is terminated when it reaches its timeout. """
+        jobs = [self._job('slow', 'exec sleep 30', test_timeout=0.5)]
+        passed, failed = self._schedule(jobs).get_results()
+        self.assertFalse(passed)
+        self.assertNotEqual(0, failed[('test', 'slow')].exit_code)
+
+    def testFailFast(self):
+        """Test that the running and pending tests are cancelled after too many failures. """
+        jobs = [self._job('slow', 'exec sleep 30'), self._job('fail', 'sleep 0.5; exit 1'),
+                self._job('pending', 'exit 0')]
+        passed, failed = self._schedule(jobs, fail_fast=1).get_results()
+        self.assertFalse(passed)
+        self.assertEqual([('test', 'fail')], list(failed))
+
+
+    def testInterruptExclusive(self):
+        """Test that the workers of exclusive tests exit when it is interrupted. """
+        jobs = [self._job('a', 'exit 0'), self._job('b', 'sleep 0.5', exclusive=True),
+                self._job('c', 'exit 0', exclusive=True)]
+        scheduler = test_scheduler.TestScheduler(jobs, 2, self._prepare_env)
+        kill_expired_jobs = scheduler._kill_expired_jobs
+        workers = []
+
+        def interrupt(now):
+            # The exclusive worker is numbered after the 2 workers of normal tests
+            workers.extend(w for w in scheduler._alive_workers if w.thread_id >= 2)
+            if workers:
+                raise KeyboardInterrupt()
+            return kill_expired_jobs(now)
+
+        scheduler._kill_expired_jobs = interrupt
+        self.assertRaises(KeyboardInterrupt, scheduler.schedule_jobs)
+        for worker in workers:
+            worker.join(10)
+            self.assertFalse(worker.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
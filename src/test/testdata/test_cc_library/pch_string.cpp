@@ -0,0 +1,5 @@
+#include "test_cc_library/pch_string.h"
+
+std::string pch_string() {
+    return "pch";
+}
@@ -0,0 +1 @@
+#include <string>
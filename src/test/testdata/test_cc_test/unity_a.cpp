@@ -0,0 +1,3 @@
+int unity_a() {
+    return 1;
+}
@@ -0,0 +1,5 @@
+int unity_a();
+
+int main() {
+    return unity_a() - 1;
+}
@@ -0,0 +1,68 @@
+# Copyright (c) 2020 Tencent Inc.
+# All rights reserved.
+#
+# Date:   April 20, 2020
+
+
+"""
+ This is the test module for the file watcher of the watch mode.
+
+"""
+
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.append('..')
+from blade import watcher
+
+
+class TestFileWatcher(unittest.TestCase):
+    """Test the changes reported by the file watcher. """
+    def setUp(self):
+        """setup method. """
+        self.watched_dir = tempfile.mkdtemp()
+        self.file_watcher = watcher.FileWatcher()
+
+    def tearDown(self):
+        """tear down method. """
+        self.file_watcher.close()
+        shutil.rmtree(self.watched_dir)
+
+    def _path(self, name):
+        return os.path.join(self.watched_dir, name)
+
+    def _write(self, name, content=''):
+        with open(self._path(name), 'w') as f:
+            f.write(content)
+
+    def _checkChanges(self):
+        self._write('a.cc')
+        self.file_watcher.set_dirs([self.watched_dir, self._path('missing')])
+
+        self._write('a.cc.swp')
+        self._write('a.cc', 'int a;')
+        self.assertEqual(set([self._path('a.cc')]), self.file_watcher.wait())
+
+        os.mkdir(self._path('sub'))
+        self.assertEqual(set([self._path('sub')]), self.file_watcher.wait())
+
+        os.remove(self._path('a.cc'))
+        self.assertEqual(set([self._path('a.cc')]), self.file_watcher.wait())
+
+    def testChanges(self):
+        """Test that modified, created and removed entries are reported. """
+        self._checkChanges()
+
+    def testPollingChanges(self):
+        """Test the watcher for systems without inotify. """
+        self.file_watcher.close()
+        self.file_watcher._watcher = watcher._PollingWatcher()
+        self._checkChanges()
+
+
+if __name__ == '__main__':
+    unittest.main()